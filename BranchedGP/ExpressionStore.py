@@ -0,0 +1,205 @@
+"""
+Expression matrices stored as binary arrays and read one gene at a time, and helpers
+reading and transforming genes of arrays, scipy.sparse matrices and stores alike.
+
+A store is a directory holding
+
+    expression.npy  genes x cells expression, so that every gene is contiguous on disk
+    genes.npy       gene names
+    time.npy        pseudotime of every cell
+    state.npy       state (global branching label) of every cell
+
+The expression is opened as a memory map. Reading a gene touches only the pages of that
+gene, and the pages are file backed so the operating system can drop them again, so a
+process fitting genes from a store holds the data of the genes it is fitting rather than
+the whole matrix. Stores are written by WriteStore from arrays or by ConvertCSV, which
+streams a CSV in chunks of cells without ever holding the matrix in memory.
+
+Count matrices are mostly zeros and often come as scipy.sparse matrices. GetGenes
+densifies only the genes asked for, and LogTransform keeps a sparse matrix sparse.
+"""
+import os
+
+import numpy as np
+import scipy.sparse
+
+
+def WriteStore(path, genes, GPt, GPy, globalBranching, dtype=np.float64):
+    """
+    Write a store from arrays
+    :param path: store directory, created if needed
+    :param genes: gene names, one per column of GPy
+    :param GPt: pseudotime of every cell
+    :param GPy: cells x genes expression
+    :param globalBranching: state of every cell
+    :param dtype: floating point type of the stored expression
+    """
+    assert GPy.shape == (GPt.size, len(genes)), "GPy must be cells x genes"
+    assert globalBranching.size == GPt.size, "need one state per cell"
+    os.makedirs(path, exist_ok=True)
+    _WriteCellInfo(path, genes, GPt, globalBranching)
+    expression = np.lib.format.open_memmap(
+        os.path.join(path, "expression.npy"), "w+", dtype, (len(genes), GPt.size)
+    )
+    expression[:] = GPy.T
+    expression.flush()
+
+
+def ConvertCSV(
+    expression,
+    path,
+    cellInfo=None,
+    timeColumn="Time",
+    stateColumn="MonocleState",
+    chunkSize=1000,
+    dtype=np.float64,
+):
+    """
+    Convert a cells x genes CSV, as read by cli.ReadData, into a store. The CSV is parsed
+    chunkSize cells at a time and every chunk is written straight to the memory map.
+    :param expression: CSV of cells x genes, cell names first
+    :param path: store directory, created if needed
+    :param cellInfo: CSV holding the time and state columns, if not in the expression file
+    :return: the opened ExpressionStore
+    """
+    import pandas as pd
+
+    header = pd.read_csv(expression, index_col=[0], nrows=0).columns
+    genes = [c for c in header if c not in [timeColumn, stateColumn]]
+    with open(expression) as f:
+        N = sum(1 for line in f if line.strip()) - 1
+    os.makedirs(path, exist_ok=True)
+    Y = np.lib.format.open_memmap(
+        os.path.join(path, "expression.npy"), "w+", dtype, (len(genes), N)
+    )
+    info = []
+    start = 0
+    for chunk in pd.read_csv(expression, index_col=[0], chunksize=chunkSize):
+        Y[:, start : start + chunk.shape[0]] = chunk[genes].values.T
+        if cellInfo is None:
+            info.append(chunk[[c for c in [timeColumn, stateColumn] if c in header]])
+        start += chunk.shape[0]
+    Y.flush()
+    del Y
+    if start != N:
+        raise NameError("Expected %g cells in %s, read %g" % (N, expression, start))
+    info = pd.concat(info) if cellInfo is None else pd.read_csv(cellInfo, index_col=[0])
+    for c in [timeColumn, stateColumn]:
+        if c not in info.columns:
+            raise NameError("Column %s not found in cell information" % c)
+    if info.shape[0] != N:
+        raise NameError(
+            "Cell information has %g cells, expression has %g" % (info.shape[0], N)
+        )
+    _WriteCellInfo(
+        path,
+        genes,
+        info[timeColumn].values.astype(float),
+        info[stateColumn].values.astype(int),
+    )
+    return ExpressionStore(path)
+
+
+def _WriteCellInfo(path, genes, GPt, globalBranching):
+    np.save(os.path.join(path, "genes.npy"), np.array([str(g) for g in genes]))
+    np.save(os.path.join(path, "time.npy"), np.asarray(GPt, dtype=float))
+    np.save(os.path.join(path, "state.npy"), np.asarray(globalBranching, dtype=int))
+
+
+def IsStore(path):
+    """ True if path is a store directory """
+    return os.path.isfile(os.path.join(path, "expression.npy"))
+
+
+class ExpressionStore:
+    """
+    Lazily read expression of a store. store[:, genes] returns the cells x genes float64
+    array of the given gene indices like indexing GPy would, centred per gene if center.
+    Pickling a store only sends its path, so worker processes open the memory map
+    themselves and read the genes they fit.
+    """
+
+    def __init__(self, path, center=False):
+        if not IsStore(path):
+            raise NameError("%s is not an expression store" % path)
+        self.path = path
+        self.center = center
+        self.genes = list(np.load(os.path.join(path, "genes.npy")))
+        self.GPt = np.load(os.path.join(path, "time.npy"))
+        self.globalBranching = np.load(os.path.join(path, "state.npy"))
+        self.expression = np.load(os.path.join(path, "expression.npy"), mmap_mode="r")
+        assert self.expression.shape == (len(self.genes), self.GPt.size)
+        self.shape = (self.GPt.size, len(self.genes))
+
+    def __getstate__(self):
+        return {"path": self.path, "center": self.center}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __getitem__(self, key):
+        (cells, genes) = key
+        assert cells == slice(None), "a store is read by whole genes"
+        if isinstance(genes, (int, np.integer)):
+            return self[:, [genes]][:, 0]
+        Y = np.array(self.expression[genes], dtype=float).T
+        if self.center:
+            Y -= Y.mean(0)
+        return Y
+
+    def GetGene(self, gene):
+        """ N x 1 expression of a gene given by name or index """
+        if not isinstance(gene, (int, np.integer)):
+            gene = self.genes.index(gene)
+        return self[:, [gene]]
+
+    def IterGenes(self, genesPerBatch=1):
+        """ Yield the names and N x genesPerBatch expression of consecutive genes """
+        for start in range(0, len(self.genes), genesPerBatch):
+            idx = list(range(start, min(start + genesPerBatch, len(self.genes))))
+            yield [self.genes[g] for g in idx], self[:, idx]
+
+
+def GetGenes(GPy, genes, center=False):
+    """
+    Dense cells x genes float64 expression of some genes
+    :param GPy: cells x genes expression, an array, scipy.sparse matrix or ExpressionStore.
+        A sparse matrix is best given in CSC format, where selecting genes is cheap.
+    :param genes: list of gene indices or a slice
+    :param center: subtract the mean of every gene
+    """
+    if scipy.sparse.issparse(GPy):
+        if GPy.format not in ["csc", "csr"]:
+            GPy = GPy.tocsc()
+        Y = GPy[:, genes].toarray().astype(float)
+    else:
+        Y = np.array(GPy[:, genes], dtype=float)
+    if center:
+        Y -= Y.mean(0)
+    return Y
+
+
+def LogTransform(Y):
+    """
+    log(1 + y / max(y)) of every gene, scaled to a maximum of 1, for all genes at once.
+    Zeros stay zero, so a scipy.sparse matrix is transformed in place of its nonzeros and
+    returned in CSC format. Genes that are all zero are left at zero.
+    :param Y: cells x genes nonnegative counts, an array or scipy.sparse matrix
+    """
+    if scipy.sparse.issparse(Y):
+        Y = scipy.sparse.csc_matrix(Y, dtype=float, copy=True)
+        Y.sum_duplicates()
+        gene = np.repeat(np.arange(Y.shape[1]), np.diff(Y.indptr))
+        Y.data = np.log1p(Y.data / _GeneMax(Y)[gene])
+        Y.data /= _GeneMax(Y)[gene]
+        return Y
+    Y = np.log1p(np.asarray(Y, dtype=float) / _GeneMax(Y))
+    return Y / _GeneMax(Y)
+
+
+def _GeneMax(Y):
+    """ Largest value of every gene, 1 for genes that are all zero """
+    ymax = np.asarray(Y.max(0).toarray() if scipy.sparse.issparse(Y) else Y.max(0))
+    ymax = ymax.astype(float).ravel()
+    ymax[ymax == 0] = 1
+    return ymax
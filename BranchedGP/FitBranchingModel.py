@@ -1,13 +1,32 @@
+import dataclasses
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import gpflow
 import numpy as np
+import scipy.optimize
+import scipy.sparse
+import tensorflow as tf
 import tensorflow_probability as tfp
 from gpflow.utilities import set_trainable, to_default_float
 
 from . import BranchingTree as bt
-from . import VBHelperFunctions, assigngp_dense, assigngp_denseSparse
+from . import (
+    ExpressionStore,
+    VBHelperFunctions,
+    assigngp_batch,
+    assigngp_dense,
+    assigngp_denseSparse,
+    assigngp_svi,
+)
 from . import branch_kernParamGPflow as bk
 
 
+class BudgetError(ValueError):
+    """ The memory or time budget of a fit cannot be met, see EstimateCost """
+
+
 def FitModel(
     bConsider,
     GPt,
@@ -22,15 +41,34 @@ def FitModel(
     maxiter=100,
     fPredict=True,
     fixHyperparameters=False,
+    fBatch=False,
+    n_jobs=1,
+    seed=42,
+    fContinuation=False,
+    fPrune=False,
+    pruneIter=10,
+    pruneRate=2,
+    fCAVI=False,
+    fPlaceInducingPoints=False,
+    MTolerance=None,
+    MMax=100,
+    fFloat32=False,
+    memoryBudget=None,
+    timeBudget=None,
+    flopRate=5e9,
+    fReturnModel=False,
 ):
     """
     Fit BGP model
     :param bConsider: list of candidate branching points
     :param GPt: pseudotime
-    :param GPy: gene expression. Should be 0 mean for best performance.
+    :param GPy: gene expression, N x 1 array or scipy.sparse matrix. Should be 0 mean for
+        best performance.
     :param globalBranching: cell labels
     :param priorConfidence: prior confidence on cell labels
-    :param M: number of inducing points
+    :param M: number of inducing points, 0 for the dense model or "auto" to choose the
+        dense model or the number of inducing points that fit memoryBudget and timeBudget
+        (see ChooseModelSize)
     :param likvar: initial value for Gaussian noise variance
     :param kerlen: initial value for kernel length scale
     :param kervar: initial value for kernel variance
@@ -38,9 +76,64 @@ def FitModel(
     :param maxiter: maximum number of iterations for optimisation
     :param fPredict: compute predictive mean and variance
     :param fixHyperparameters: should kernel hyperparameters be kept fixed or optimised?
+    :param fBatch: fit all candidate branching points at once in a single batched model
+        (see assigngp_batch.AssignGPBatch) rather than one after the other. Every
+        candidate is optimised and stopped on its own (see OptimiseBatch) from the initial
+        hyperparameters, as with workers below.
+    :param n_jobs: number of worker processes the candidate branching points are spread
+        over, -1 for one per core. With n_jobs=1 the branching points are fitted one after
+        the other in this process, each starting from the hyperparameters optimised at
+        the previous one. Workers start every branching point from the initial
+        hyperparameters, so after the first candidate the log likelihoods of the two
+        paths differ by as much as the optimiser depends on its starting point.
+    :param seed: random seed for the initial conditions; worker tasks are seeded from it
+    :param fContinuation: sweep the sorted candidate branching points, warm starting each
+        from the hyperparameters and assignment fitted at the previous one. A point whose
+        bound is higher at the initial conditions than at the warm start starts cold.
+        Warm starts save iterations where neighbouring fits are alike, not uniformly.
+    :param fPrune: prune hopeless candidate branching points by successive halving: all
+        candidates get pruneIter iterations, then the best 1/pruneRate of them get
+        pruneRate times more, and so on up to maxiter. The log likelihood of a pruned
+        candidate is the partial bound at the time it was pruned. The last candidate,
+        the no-branching reference of the Bayes factor, is never pruned.
+    :param pruneIter: iteration budget of the first successive halving round
+    :param pruneRate: fraction of candidates dropped and budget growth per round
+    :param fCAVI: optimise with closed-form assignment updates alternating with
+        hyperparameter steps (see OptimiseCAVI) rather than jointly with L-BFGS. maxiter
+        then counts alternations.
+    :param fPlaceInducingPoints: place the M inducing points on the trunk before and the
+        branches after every candidate branching point, at quantiles of the pseudotime
+        (see VBHelperFunctions.GetBranchingInducingPoints), rather than spreading them
+        uniformly over all three functions as by default
+    :param MTolerance: choose the number of inducing points automatically. All candidate
+        branching points are fitted with M inducing points, then M is doubled and every
+        candidate refitted starting from its previous optimum, until no log likelihood
+        changes by more than MTolerance or M reaches MMax.
+    :param MMax: largest number of inducing points tried when MTolerance is given
+    :param fFloat32: build and fit the models in single precision, halving their memory.
+        The Cholesky factorisations get jitter scaled to the precision, see
+        VBHelperFunctions.GetJitter. Sparse bounds stay within about one log likelihood
+        unit of float64; the 3N x 3N dense kernel needs more jitter, which lowers its
+        bound by up to a few units when the noise variance is small. See
+        benchmarks/compare_float32.py.
+    :param memoryBudget: bytes the fit may add to the process. With M="auto" the default
+        is the physical memory of the machine, where the platform reports it.
+    :param timeBudget: seconds the fit may take. If a budget is given and the fit is
+        estimated to exceed it (see EstimateCost), BudgetError is raised before fitting.
+    :param flopRate: floating point operations per second used to estimate fit times
+    :param fReturnModel: also return modelRecord, the model at the most likely branching
+        point as plain arrays (see GetModelRecord). SaveModel writes it and
+        BuildModelFromRecord or LoadModel turn it back into a model ready to predict.
     :return: dictionary of log likelihood, GPflow model, Phi matrix, predictive set of points,
-    mean and variance, hyperparameter values, posterior on branching time
+    mean and variance, hyperparameter values, posterior on branching time, number of
+    optimiser iterations per candidate branching point and which candidates were pruned.
+    With MTolerance also the chosen M and MTrajectory, the M and log likelihood of every
+    candidate at each step. With M="auto" also the chosen M. With fReturnModel also
+    modelRecord.
     """
+    if scipy.sparse.issparse(GPy):
+        GPy = ExpressionStore.GetGenes(GPy, slice(None))
+    arguments = dict(locals())
     assert isinstance(bConsider, list), "Candidate B must be list"
     assert GPt.ndim == 1
     assert GPy.ndim == 2
@@ -50,24 +143,580 @@ def FitModel(
     assert (
         globalBranching.size == GPy.size
     ), "state space must be same size as number of cells"
+    assert not (
+        (M == "auto" or memoryBudget is not None or timeBudget is not None)
+        and (fBatch or n_jobs != 1)
+    ), "budgets are estimated for models fitted one after the other in this process"
+    if M == "auto":
+        assert MTolerance is None, "M is either chosen to fit the budgets or grown"
+        M = ChooseModelSize(
+            GPt.size,
+            len(bConsider),
+            maxiter,
+            memoryBudget,
+            timeBudget,
+            fFloat32,
+            flopRate,
+        )
+        if fDebug:
+            print("Chose M=%g for the budgets" % M)
+        d = FitModel(**dict(arguments, M=M))
+        d["M"] = M
+        return d
+    if memoryBudget is not None or timeBudget is not None:
+        cost = EstimateCost(GPt.size, M, len(bConsider), maxiter, fFloat32, flopRate)
+        if memoryBudget is not None and cost["memory"] > memoryBudget:
+            raise BudgetError(
+                "Fitting %g cells with M=%g needs about %.3g GB, over the budget of "
+                "%.3g GB" % (GPt.size, M, cost["memory"] / 1e9, memoryBudget / 1e9)
+            )
+        if timeBudget is not None and cost["seconds"] > timeBudget:
+            raise BudgetError(
+                "Fitting %g cells with M=%g takes about %.3g seconds, over the budget of "
+                "%.3g seconds" % (GPt.size, M, cost["seconds"], timeBudget)
+            )
     assert M >= 0, "at least 0 or more inducing points should be given"
+    assert n_jobs == -1 or n_jobs >= 1, "n_jobs must be -1 or a positive integer"
+    assert not (fBatch and n_jobs != 1), "fBatch and n_jobs are alternatives"
+    assert not (
+        fContinuation and (fBatch or n_jobs != 1)
+    ), "continuation fits the branching points one after the other"
+    assert not (
+        fPrune and (fBatch or n_jobs != 1 or fContinuation)
+    ), "pruning fits the branching points one after the other"
+    assert pruneIter >= 1 and pruneRate > 1, "invalid pruning schedule"
+    assert not (fCAVI and fBatch), "the batched model has no closed-form updates"
+    assert MTolerance is None or (
+        M >= 3 and MMax > M
+    ), "choosing M needs at least one initial inducing point per function and MMax > M"
+    assert MTolerance is None or not (
+        fBatch or n_jobs != 1 or fContinuation or fPrune
+    ), "choosing M fits the branching points one after the other"
+    assert not (fFloat32 and n_jobs != 1), "float32 fits the models in this process"
+    if fFloat32:
+        with gpflow.config.as_context(GetFloat32Config()):
+            return FitModel(**dict(arguments, fFloat32=False))
     phiInitial, phiPrior = GetInitialConditionsAndPrior(
-        globalBranching, priorConfidence, infPriorPhi=True
+        globalBranching, priorConfidence, infPriorPhi=True, seed=seed
     )
 
     XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(GPt)
-    ptb = np.min([np.min(GPt[globalBranching == 2]), np.min(GPt[globalBranching == 3])])
-    tree = bt.BinaryBranchingTree(0, 1, fDebug=False)
-    tree.add(None, 1, np.ones((1, 1)) * ptb)  # B can be anything here
-    (fm, _) = tree.GetFunctionBranchTensor()
+    modelArgs = dict(
+        GPt=GPt,
+        GPy=GPy,
+        globalBranching=globalBranching,
+        XExpanded=XExpanded,
+        indices=indices,
+        phiInitial=phiInitial,
+        phiPrior=phiPrior,
+        M=M,
+        likvar=likvar,
+        kerlen=kerlen,
+        kervar=kervar,
+        fDebug=fDebug,
+        fixHyperparameters=fixHyperparameters,
+        fPlaceInducingPoints=fPlaceInducingPoints,
+    )
+    if fBatch:
+        d = _FitModelsBatch(
+            bConsider,
+            GPt,
+            GPy,
+            XExpanded,
+            indices,
+            phiInitial,
+            phiPrior,
+            M=M,
+            likvar=likvar,
+            kerlen=kerlen,
+            kervar=kervar,
+            fDebug=fDebug,
+            maxiter=maxiter,
+            fPredict=fPredict,
+            fixHyperparameters=fixHyperparameters,
+            fPlaceInducingPoints=fPlaceInducingPoints,
+        )[0]
+        return _AddModelRecord(d, modelArgs) if fReturnModel else d
+    if n_jobs != 1:
+        d = _FitModelParallel(
+            bConsider, modelArgs, n_jobs, seed, maxiter, fPredict, fDebug, fCAVI
+        )
+        return _AddModelRecord(d, modelArgs) if fReturnModel else d
+    m = _BuildModel(**modelArgs)
 
-    kb = bk.BranchKernelParam(
-        gpflow.kernels.Matern32(1), fm, b=np.zeros((1, 1))
-    ) + gpflow.kernels.White(1)
-    kb.kernels[1].variance.assign(
-        1e-6
-    )  # controls the discontinuity magnitude, the gap at the branching point
-    set_trainable(kb.kernels[1].variance, False)  # jitter for numerics
+    # optimization
+    results = [None] * len(bConsider)
+    pruned = np.zeros(len(bConsider), dtype=bool)
+    # with continuation the grid is swept in order, each point starting from its fitted neighbour
+    order = np.argsort(bConsider) if fContinuation else range(len(bConsider))
+    phiStart = phiInitial
+    # hyperparameters the model was built with, the cold start of every point
+    coldState = GetModelState(m)
+    MTrajectory = None
+    try:
+        if MTolerance is not None:
+            results, MTrajectory = _FitModelGrowM(
+                m, bConsider, modelArgs, maxiter, fPredict, fCAVI, MTolerance, MMax
+            )
+        elif fPrune:
+            results, pruned = _FitModelPruned(
+                m, bConsider, phiInitial, maxiter, fPredict, pruneIter, pruneRate, fCAVI
+            )
+        else:
+            for ib in order:
+                state = None
+                if fContinuation:
+                    (phiStart, state) = _GetContinuationStart(
+                        m, bConsider[ib], phiStart, phiInitial, coldState
+                    )
+                r = _FitBranchingPoint(
+                    m, bConsider[ib], phiStart, maxiter, fPredict, state, fCAVI=fCAVI
+                )
+                results[ib] = r
+                if fContinuation:
+                    # hyperparameters carry over in the model, the assignment is remapped
+                    phiStart = GetContinuationPhi(
+                        r["Phi"], bConsider[ib], GPt, phiInitial
+                    )
+    except Exception as ex:
+        print(f"Unexpected error: {ex} {'-' * 60}\nCaused by model: {m} {'-' * 60}")
+        ll = np.array([0.0 if r is None else r["loglik"] for r in results])
+        ll[0] = np.nan
+        # return model so can inspect model
+        return {
+            "loglik": ll,
+            "model": m,
+            "Phi": np.nan,
+            "prediction": {"xtest": np.nan, "mu": np.nan, "var": np.nan},
+            "hyperparameters": np.nan,
+            "posteriorB": np.nan,
+        }
+    ll = np.array([r["loglik"] for r in results])
+    iterations = np.array([r["iterations"] for r in results])
+    iw = np.argmax(ll)
+    postB = GetPosteriorB(ll, bConsider)
+    if fDebug:
+        print(
+            "BGP Maximum at b=%.2f" % bConsider[iw],
+            "CI= [%.2f, %.2f]" % (postB["B_CI"][0], postB["B_CI"][1]),
+        )
+        print(
+            "Objective traced %g times for %g branching points"
+            % (m.traceCount, len(bConsider))
+        )
+        print("Optimiser iterations per branching point %s" % str(iterations))
+    assert np.allclose(bConsider[iw], postB["Bmode"]), "%s-%s" % str(
+        postB["B_CI"], bConsider[iw]
+    )
+    d = {
+        "loglik": ll,
+        "Phi": results[iw]["Phi"],  # 'model': m,
+        "prediction": results[iw]["prediction"],
+        "hyperparameters": results[iw]["hyperparameters"],  # winning hyperparameters
+        "posteriorB": postB,
+        "iterations": iterations,
+        "pruned": pruned,
+    }
+    if MTrajectory is not None:
+        d["M"] = MTrajectory["M"][-1]
+        d["MTrajectory"] = MTrajectory
+        if fDebug:
+            print("Chose M=%g, log likelihoods %s" % (d["M"], MTrajectory["loglik"]))
+    if fReturnModel:
+        _AddModelRecord(d, dict(modelArgs, M=d.get("M", M)))
+    return d
+
+
+def FitModels(
+    bConsider,
+    GPt,
+    GPy,
+    globalBranching,
+    priorConfidence=0.80,
+    M=10,
+    likvar=1.0,
+    kerlen=2.0,
+    kervar=5.0,
+    fDebug=False,
+    maxiter=100,
+    fPredict=True,
+    fixHyperparameters=False,
+    seed=42,
+    fPlaceInducingPoints=False,
+    genesPerBatch=None,
+    center=False,
+    fReturnModel=False,
+):
+    """
+    Fit independent BGP models to many genes at once. Every gene and candidate branching
+    point is a problem of a single batched model (see assigngp_batch.AssignGPBatch) so
+    kernel, bound and optimiser run over all genes together. Each problem has its own
+    L-BFGS line search and stopping test (see OptimiseBatch) and starts from the initial
+    hyperparameters, as the candidates of FitModel with n_jobs != 1 do. FitModel with
+    n_jobs=1 starts each candidate from the hyperparameters fitted at the previous one,
+    so the two agree once the fits converge, to the tolerance of the optimiser, but not
+    when maxiter stops them early, nor for genes whose bound has several local optima
+    (for example genes without signal), where the two starts can reach different ones.
+    :param bConsider: list of candidate branching points
+    :param GPt: pseudotime
+    :param GPy: gene expression, cells x genes array, scipy.sparse matrix (preferably CSC)
+        or ExpressionStore. Each gene should be 0 mean for best performance.
+    :param globalBranching: cell labels
+    :param seed: random seed for the initial conditions
+    :param genesPerBatch: number of genes fitted together in one batched model. If None,
+        all genes of an array and 50 genes of a scipy.sparse matrix or ExpressionStore,
+        whose genes are only read densely batch by batch.
+    :param center: subtract the mean of every gene as its batch is read
+    :param fReturnModel: also return the modelRecord of every gene, see FitModel
+    See FitModel for the remaining parameters.
+    :return: list with one FitModel dictionary per gene
+    """
+    assert isinstance(bConsider, list), "Candidate B must be list"
+    assert GPt.ndim == 1
+    assert len(GPy.shape) == 2
+    assert GPt.size == GPy.shape[0], "pseudotime and gene expression must have N cells"
+    assert (
+        globalBranching.size == GPt.size
+    ), "state space must be same size as number of cells"
+    assert M >= 0, "at least 0 or more inducing points should be given"
+    G = GPy.shape[1]
+    if genesPerBatch is None:
+        genesPerBatch = max(G, 1) if isinstance(GPy, np.ndarray) else 50
+    assert genesPerBatch >= 1, "genesPerBatch must be a positive integer"
+    if scipy.sparse.issparse(GPy) and GPy.format != "csc":
+        GPy = GPy.tocsc()  # cheap selection of genes
+    phiInitial, phiPrior = GetInitialConditionsAndPrior(
+        globalBranching, priorConfidence, infPriorPhi=True, seed=seed
+    )
+    XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(GPt)
+    results = []
+    for start in range(0, G, genesPerBatch):
+        Y = ExpressionStore.GetGenes(
+            GPy, slice(start, min(start + genesPerBatch, G)), center
+        )
+        batch = _FitModelsBatch(
+            bConsider,
+            GPt,
+            Y,
+            XExpanded,
+            indices,
+            phiInitial,
+            phiPrior,
+            M=M,
+            likvar=likvar,
+            kerlen=kerlen,
+            kervar=kervar,
+            fDebug=fDebug,
+            maxiter=maxiter,
+            fPredict=fPredict,
+            fixHyperparameters=fixHyperparameters,
+            fPlaceInducingPoints=fPlaceInducingPoints,
+        )
+        if fReturnModel:
+            modelArgs = dict(
+                GPt=GPt,
+                globalBranching=globalBranching,
+                XExpanded=XExpanded,
+                indices=indices,
+                phiInitial=phiInitial,
+                phiPrior=phiPrior,
+                M=M,
+                likvar=likvar,
+                kerlen=kerlen,
+                kervar=kervar,
+                fDebug=fDebug,
+                fixHyperparameters=fixHyperparameters,
+                fPlaceInducingPoints=fPlaceInducingPoints,
+            )
+            for g, d in enumerate(batch):
+                _AddModelRecord(d, dict(modelArgs, GPy=Y[:, [g]]))
+        results += batch
+    return results
+
+
+def FitModelAdaptive(
+    GPt,
+    GPy,
+    globalBranching,
+    bRange=None,
+    numInitial=5,
+    tolerance=0.01,
+    probThreshold=1e-3,
+    maxFits=50,
+    bNoBranching=None,
+    priorConfidence=0.80,
+    M=10,
+    likvar=1.0,
+    kerlen=2.0,
+    kervar=5.0,
+    fDebug=False,
+    maxiter=100,
+    fPredict=True,
+    fixHyperparameters=False,
+    seed=42,
+    fPlaceInducingPoints=False,
+):
+    """
+    Fit BGP model, searching the branching point by coarse-to-fine refinement rather than
+    over a fixed grid. A uniform grid of numInitial points is fitted first; then every
+    interval between neighbouring fitted points that is wider than tolerance and touches a
+    point of posterior probability above probThreshold is split at its midpoint, until no
+    such interval remains or maxFits fits have been used. The no-branching point
+    bNoBranching is fitted last, as the last candidate of FitModel, so that the result can
+    be passed to CalculateBranchingEvidence with its bConsider.
+    :param bRange: [lower, upper] range of the branching point, the range of GPt by default
+    :param numInitial: number of points of the initial uniform grid
+    :param tolerance: resolution of the branching point in the high posterior region
+    :param probThreshold: posterior probability above which a point is refined around
+    :param maxFits: maximum number of model fits, including the no-branching point
+    :param bNoBranching: branching point after every cell, meaning no branching. By
+        default a tenth of the pseudotime range after the last cell (1.1 for pseudotime
+        in [0, 1]).
+    See FitModel for the remaining parameters.
+    :return: FitModel dictionary over the fitted branching points bConsider, the
+    no-branching point last, with the number of fits used and the number of fits of a
+    uniform grid at resolution tolerance. posteriorB is the posterior over the branching
+    points of bRange.
+    """
+    assert GPt.ndim == 1
+    assert GPy.ndim == 2
+    assert (
+        GPt.size == GPy.size
+    ), "pseudotime and gene expression data must be the same size"
+    assert (
+        globalBranching.size == GPy.size
+    ), "state space must be same size as number of cells"
+    assert M >= 0, "at least 0 or more inducing points should be given"
+    assert numInitial >= 2, "need at least two initial points"
+    assert maxFits > numInitial, "need a fit for every initial point and no branching"
+    if bRange is None:
+        bRange = [np.min(GPt), np.max(GPt)]
+    assert bRange[0] < bRange[1], "empty range for the branching point"
+    if bNoBranching is None:
+        bNoBranching = np.max(GPt) + 0.1 * (np.max(GPt) - np.min(GPt))
+    assert bNoBranching > max(bRange[1], np.max(GPt)), "no-branching point too early"
+    phiInitial, phiPrior = GetInitialConditionsAndPrior(
+        globalBranching, priorConfidence, infPriorPhi=True, seed=seed
+    )
+    XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(GPt)
+    m = _BuildModel(
+        GPt,
+        GPy,
+        globalBranching,
+        XExpanded,
+        indices,
+        phiInitial,
+        phiPrior,
+        M,
+        likvar,
+        kerlen,
+        kervar,
+        fDebug,
+        fixHyperparameters,
+        fPlaceInducingPoints,
+    )
+    fitted = dict()  # branching point -> result of _FitBranchingPoint
+    candidates = list(np.linspace(bRange[0], bRange[1], numInitial))
+    try:
+        while len(candidates) > 0:
+            # one fit is kept for the no-branching point
+            for b in candidates[: maxFits - 1 - len(fitted)]:
+                fitted[b] = _FitBranchingPoint(m, b, phiInitial, maxiter, fPredict)
+            if len(fitted) >= maxFits - 1:
+                break
+            bConsider = sorted(fitted.keys())
+            ll = np.array([fitted[b]["loglik"] for b in bConsider])
+            p = np.exp(ll - np.max(ll)) * GetGridWeights(bConsider)
+            p /= p.sum()
+            # split wide intervals next to high posterior points, most probable first
+            splits = [
+                i
+                for i in range(len(bConsider) - 1)
+                if bConsider[i + 1] - bConsider[i] > tolerance
+                and max(p[i], p[i + 1]) > probThreshold
+            ]
+            splits.sort(key=lambda i: -max(p[i], p[i + 1]))
+            candidates = [0.5 * (bConsider[i] + bConsider[i + 1]) for i in splits]
+            if fDebug:
+                print(
+                    "Adaptive search: %g fits, refining %s" % (len(fitted), candidates)
+                )
+        b = bNoBranching
+        fitted[b] = _FitBranchingPoint(m, b, phiInitial, maxiter, fPredict)
+    except Exception as ex:
+        print(f"Unexpected error: {ex} {'-' * 60}\nCaused by model: {m} {'-' * 60}")
+        # the points fitted so far and the failed point b, whose log likelihood is nan
+        bConsider = sorted(set(fitted.keys()) | {b})
+        return {
+            "loglik": np.array(
+                [fitted[bc]["loglik"] if bc in fitted else np.nan for bc in bConsider]
+            ),
+            "bConsider": bConsider,
+            "model": m,
+            "Phi": np.nan,
+            "prediction": {"xtest": np.nan, "mu": np.nan, "var": np.nan},
+            "hyperparameters": np.nan,
+            "posteriorB": np.nan,
+        }
+    bConsider = sorted(fitted.keys())
+    results = [fitted[b] for b in bConsider]
+    ll = np.array([r["loglik"] for r in results])
+    iw = np.argmax(ll)
+    # over the branching points of the search, without the no-branching point
+    postB = GetPosteriorB(
+        ll[:-1], bConsider[:-1], weights=GetGridWeights(bConsider[:-1])
+    )
+    # the uniform grid and the no-branching point
+    numFitsUniformGrid = int(np.ceil((bRange[1] - bRange[0]) / tolerance)) + 2
+    if fDebug:
+        print(
+            "BGP Maximum at b=%.3f" % bConsider[iw],
+            "CI= [%.3f, %.3f]" % (postB["B_CI"][0], postB["B_CI"][1]),
+            "using %g fits, uniform grid needs %g" % (len(fitted), numFitsUniformGrid),
+        )
+    return {
+        "loglik": ll,
+        "bConsider": bConsider,
+        "Phi": results[iw]["Phi"],
+        "prediction": results[iw]["prediction"],
+        "hyperparameters": results[iw]["hyperparameters"],
+        "posteriorB": postB,
+        "iterations": np.array([r["iterations"] for r in results]),
+        "numFits": len(fitted),
+        "numFitsUniformGrid": numFitsUniformGrid,
+    }
+
+
+def FitModelSVI(
+    bConsider,
+    GPt,
+    GPy,
+    globalBranching,
+    priorConfidence=0.80,
+    M=10,
+    likvar=1.0,
+    kerlen=2.0,
+    kervar=5.0,
+    fDebug=False,
+    maxiter=1000,
+    fPredict=True,
+    fixHyperparameters=False,
+    seed=42,
+    batchSize=1000,
+    learningRate=0.01,
+    fPlaceInducingPoints=False,
+):
+    """
+    Fit BGP model to a very large number of cells with stochastic variational inference
+    (see assigngp_svi.AssignGPSVI). Every optimiser iteration uses a minibatch of batchSize
+    cells so its cost does not depend on the number of cells; the exact bound and the
+    assignment of every cell are only computed once per candidate branching point.
+    :param maxiter: number of Adam iterations per candidate branching point
+    :param batchSize: cells per minibatch, None to use every cell
+    :param learningRate: Adam learning rate
+    :param seed: random seed for the assignment prior and the minibatches
+    Other parameters are as for FitModel.
+    :return: dictionary as returned by FitModel. The log likelihood is the exact bound
+        plus the log prior of the hyperparameters.
+    """
+    assert isinstance(bConsider, list), "Candidate B must be list"
+    assert GPt.ndim == 1
+    assert GPy.ndim == 2
+    assert (
+        GPt.size == GPy.shape[0]
+    ), "pseudotime and gene expression data must be the same size"
+    assert (
+        globalBranching.size == GPt.size
+    ), "state space must be same size as number of cells"
+    assert M > 0, "stochastic inference needs inducing points"
+    _, phiPrior = GetInitialConditionsAndPrior(
+        globalBranching, priorConfidence, infPriorPhi=True, seed=seed
+    )
+    m = _BuildModelSVI(
+        GPt,
+        GPy,
+        globalBranching,
+        phiPrior,
+        M,
+        batchSize,
+        likvar,
+        kerlen,
+        kervar,
+        fDebug,
+        fixHyperparameters,
+        seed,
+        fPlaceInducingPoints,
+    )
+    # every candidate starts from the same hyperparameters so the bounds are comparable
+    initialState = GetModelState(m)
+    results = list()
+    for b in bConsider:
+        SetModelState(m, initialState)
+        m.UpdateBranchingPoint(np.ones((1, 1)) * b)
+        optResult = OptimiseSVI(m, maxiter=maxiter, learningRate=learningRate)
+        if fPredict:
+            ttestl, mul, varl = VBHelperFunctions.predictBranchingModel(m)
+        else:
+            ttestl, mul, varl = [], [], []
+        results.append(
+            {
+                "loglik": m.FullELBO() + m.log_prior_density().numpy(),
+                "Phi": m.GetPhi(),
+                "prediction": {"xtest": ttestl, "mu": mul, "var": varl},
+                "hyperparameters": {
+                    "likvar": m.likelihood.variance.numpy(),
+                    "kerlen": m.kernel.kernels[0].kern.lengthscales.numpy(),
+                    "kervar": m.kernel.kernels[0].kern.variance.numpy(),
+                },
+                "iterations": optResult.nit,
+            }
+        )
+        if fDebug:
+            print(
+                "b=%.2f bound %.2f, stochastic objective %.2f"
+                % (b, results[-1]["loglik"], -optResult.fun)
+            )
+    ll = np.array([r["loglik"] for r in results])
+    iw = np.argmax(ll)
+    postB = GetPosteriorB(ll, bConsider)
+    return {
+        "loglik": ll,
+        "Phi": results[iw]["Phi"],
+        "prediction": results[iw]["prediction"],
+        "hyperparameters": results[iw]["hyperparameters"],
+        "posteriorB": postB,
+        "iterations": np.array([r["iterations"] for r in results]),
+        "pruned": np.zeros(len(bConsider), dtype=bool),
+    }
+
+
+def GetGridWeights(BgridSearch):
+    """ Width of the cell around each point of a sorted, possibly non-uniform grid """
+    gr = np.asarray(BgridSearch, dtype=float)
+    if gr.size == 1:
+        return np.ones(1)
+    edges = np.concatenate([[gr[0]], 0.5 * (gr[1:] + gr[:-1]), [gr[-1]]])
+    return np.diff(edges)
+
+
+def _BuildModel(
+    GPt,
+    GPy,
+    globalBranching,
+    XExpanded,
+    indices,
+    phiInitial,
+    phiPrior,
+    M,
+    likvar,
+    kerlen,
+    kervar,
+    fDebug,
+    fixHyperparameters,
+    fPlaceInducingPoints=False,
+):
+    """ Create the dense (M=0) or sparse model fitted by FitModel and set its hyperparameters """
+    (kb, ptb) = _BuildKernel(GPt, globalBranching)
     if M == 0:
         m = assigngp_dense.AssignGP(
             GPt,
@@ -80,9 +729,7 @@ def FitModel(
             phiPrior=phiPrior,
         )
     else:
-        ZExpanded = np.ones((M, 2))
-        ZExpanded[:, 0] = np.linspace(0, 1, M, endpoint=False)
-        ZExpanded[:, 1] = np.array([i for j in range(M) for i in range(1, 4)])[:M]
+        ZExpanded = GetInducingPoints(M)
         m = assigngp_denseSparse.AssignGPSparse(
             GPt,
             XExpanded,
@@ -93,8 +740,37 @@ def FitModel(
             ZExpanded,
             phiInitial=phiInitial,
             phiPrior=phiPrior,
+            fPlaceInducingPoints=fPlaceInducingPoints,
         )
-    # Initialise hyperparameters
+    _InitialiseHyperparameters(m, likvar, kerlen, kervar, fDebug, fixHyperparameters)
+    return m
+
+
+def _BuildKernel(GPt, globalBranching):
+    """Branching kernel of a single branching point plus White jitter, and the earliest
+    branching time of the cell labels used as initial branching point"""
+    ptb = np.min([np.min(GPt[globalBranching == 2]), np.min(GPt[globalBranching == 3])])
+    return _BuildBranchingKernel(), ptb
+
+
+def _BuildBranchingKernel():
+    """ Branching kernel of a single branching point plus White jitter """
+    tree = bt.BinaryBranchingTree(0, 1, fDebug=False)
+    tree.add(None, 1, np.ones((1, 1)) * 0.5)  # B can be anything here
+    (fm, _) = tree.GetFunctionBranchTensor()
+
+    kb = bk.BranchKernelParam(
+        gpflow.kernels.Matern32(1), fm, b=np.zeros((1, 1))
+    ) + gpflow.kernels.White(1)
+    kb.kernels[1].variance.assign(
+        1e-6
+    )  # controls the discontinuity magnitude, the gap at the branching point
+    set_trainable(kb.kernels[1].variance, False)  # jitter for numerics
+    return kb
+
+
+def _InitialiseHyperparameters(m, likvar, kerlen, kervar, fDebug, fixHyperparameters):
+    """ Set initial hyperparameters of model m and either fix them or put priors on them """
     m.likelihood.variance.assign(likvar)
     m.kernel.kernels[0].kern.lengthscales.assign(kerlen)
     m.kernel.kernels[0].kern.variance.assign(kervar)
@@ -116,49 +792,621 @@ def FitModel(
             to_default_float(0.1), to_default_float(0.1)
         )
 
-    # optimization
-    ll = np.zeros(len(bConsider))
-    Phi_l = list()
-    ttestl_l, mul_l, varl_l = list(), list(), list()
-    hyps = list()
-    for ib, b in enumerate(bConsider):
-        m.UpdateBranchingPoint(np.ones((1, 1)) * b, phiInitial)
-        try:
-            opt = gpflow.optimizers.Scipy()
-            opt.minimize(
-                m.training_loss,
+
+def _BuildModelSVI(
+    GPt,
+    GPy,
+    globalBranching,
+    phiPrior,
+    M,
+    batchSize,
+    likvar,
+    kerlen,
+    kervar,
+    fDebug,
+    fixHyperparameters,
+    seed=42,
+    fPlaceInducingPoints=False,
+):
+    """ Create the stochastic variational model fitted by FitModelSVI and set its hyperparameters """
+    (kb, ptb) = _BuildKernel(GPt, globalBranching)
+    m = assigngp_svi.AssignGPSVI(
+        GPt,
+        GPy,
+        kb,
+        np.ones((1, 1)) * ptb,
+        GetInducingPoints(M),
+        batchSize=batchSize,
+        phiPrior=phiPrior,
+        seed=seed,
+        fPlaceInducingPoints=fPlaceInducingPoints,
+        fDebug=fDebug,
+    )
+    _InitialiseHyperparameters(m, likvar, kerlen, kervar, fDebug, fixHyperparameters)
+    return m
+
+
+def _FitBranchingPoint(
+    m, b, phiInitial, maxiter, fPredict, state=None, fCAVI=False, numRestarts=3
+):
+    """Optimise model m at branching point b starting from assignment phiInitial, or from
+    the trainable variables state (see GetModelState) of an earlier fit at b. In single
+    precision L-BFGS is restarted up to numRestarts times if it stops early.
+    Returns log posterior, Phi, prediction, hyperparameters and number of optimiser
+    iterations"""
+    m.UpdateBranchingPoint(np.ones((1, 1)) * b, phiInitial)
+    if state is not None:
+        SetModelState(m, state)
+    if fCAVI:
+        optResult = OptimiseCAVI(m, maxiter=maxiter)
+    else:
+        opt = gpflow.optimizers.Scipy()
+        # compiled loss is cached on the model so every branching point reuses one trace
+        optResult = opt.minimize(
+            m.training_loss_closure(),
+            variables=m.trainable_variables,
+            compile=False,
+            options=dict(disp=True, maxiter=maxiter),
+        )
+        # In single precision a step can leave the rounded bound unchanged, which L-BFGS
+        # takes for convergence, or the line search can fail on rounding noise. Restart
+        # it from where it stopped while that improves the bound.
+        nit = optResult.nit
+        for _ in range(numRestarts):
+            if gpflow.default_float() == np.float64 or nit >= maxiter:
+                break
+            previous = optResult.fun
+            optResult = opt.minimize(
+                m.training_loss_closure(),
                 variables=m.trainable_variables,
-                options=dict(disp=True, maxiter=maxiter),
+                compile=False,
+                options=dict(disp=True, maxiter=maxiter - nit),
             )
-            # remember winning hyperparameter
-            hyps.append(
-                {
-                    "likvar": m.likelihood.variance.numpy(),
-                    "kerlen": m.kernel.kernels[0].kern.lengthscales.numpy(),
-                    "kervar": m.kernel.kernels[0].kern.variance.numpy(),
-                }
+            nit += optResult.nit
+            if optResult.fun >= previous:
+                break
+        optResult.nit = nit
+    hyps = {
+        "likvar": m.likelihood.variance.numpy(),
+        "kerlen": m.kernel.kernels[0].kern.lengthscales.numpy(),
+        "kervar": m.kernel.kernels[0].kern.variance.numpy(),
+    }
+    ll = m.log_posterior_density().numpy()
+    # prediction
+    if fPredict:
+        ttestl, mul, varl = VBHelperFunctions.predictBranchingModel(m)
+    else:
+        ttestl, mul, varl = [], [], []
+    return {
+        "loglik": ll,
+        "Phi": m.GetPhi(),
+        "prediction": {"xtest": ttestl, "mu": mul, "var": varl},
+        "hyperparameters": hyps,
+        "iterations": optResult.nit,
+    }
+
+
+def OptimiseCAVI(m, maxiter=100, hyperIter=5, tolerance=1e-7):
+    """
+    Coordinate ascent on the bound of an AssignGP or AssignGPSparse model: alternate the
+    closed-form assignment update (AssignGP.UpdatePhi) with a few L-BFGS iterations on the
+    hyperparameters, holding Phi fixed.
+    :param maxiter: maximum number of alternations
+    :param hyperIter: L-BFGS iterations per hyperparameter step
+    :param tolerance: stop once the relative change of the objective is below tolerance
+    :return: scipy OptimizeResult with the number of alternations nit, final objective fun
+        and the objective after every alternation
+    """
+    loss = m.training_loss_closure()
+    opt = gpflow.optimizers.Scipy()
+    set_trainable(m.logPhi, False)
+    trajectory = [loss().numpy()]
+    nit = 0  # no alternation with maxiter=0
+    try:
+        for nit in range(1, maxiter + 1):
+            m.UpdatePhi()
+            if len(m.trainable_variables) > 0:
+                opt.minimize(
+                    loss,
+                    variables=m.trainable_variables,
+                    compile=False,
+                    options=dict(maxiter=hyperIter),
+                )
+            trajectory.append(loss().numpy())
+            if abs(trajectory[-2] - trajectory[-1]) <= tolerance * abs(trajectory[-2]):
+                break
+    finally:
+        set_trainable(m.logPhi, True)
+    return scipy.optimize.OptimizeResult(
+        nit=nit, fun=trajectory[-1], trajectory=np.array(trajectory)
+    )
+
+
+def OptimiseSVI(m, maxiter=1000, learningRate=0.01):
+    """
+    Maximise the stochastic bound of an AssignGPSVI model with Adam, one minibatch per
+    iteration. The whole optimisation loop is compiled into a single graph that is cached
+    on the model, and the Adam state is reset at every call.
+    :param maxiter: number of Adam iterations
+    :param learningRate: Adam learning rate, which may differ between calls on one model
+    :return: scipy OptimizeResult with the number of iterations nit, final objective fun
+        and the minibatch objective after every iteration
+    """
+    if m.compiledOptimiser is None:
+        loss = m.training_loss_closure(compile=False)
+        variables = m.trainable_variables
+        opt = tf.optimizers.Adam(learning_rate=learningRate)
+        # the optimiser state, learning rate included, must exist before the loop is
+        # traced. A step with zero gradients creates it and leaves the variables
+        # unchanged, with the optimiser API of every supported TensorFlow version
+        opt.apply_gradients([(tf.zeros_like(v), v) for v in variables])
+
+        @tf.function
+        def optimise(numIterations):
+            trajectory = tf.TensorArray(gpflow.default_float(), size=numIterations)
+            for i in tf.range(numIterations):
+                with tf.GradientTape() as tape:
+                    value = loss()
+                opt.apply_gradients(zip(tape.gradient(value, variables), variables))
+                trajectory = trajectory.write(i, value)
+            return trajectory.stack()
+
+        m.compiledOptimiser = (opt, optimise)
+    (opt, optimise) = m.compiledOptimiser
+    # a method before TensorFlow 2.11, a property after
+    optimiserVariables = opt.variables() if callable(opt.variables) else opt.variables
+    for v in optimiserVariables:
+        v.assign(tf.zeros_like(v))
+    # The compiled loop reads the learning rate from a variable of the optimiser, which
+    # must be assigned: from TensorFlow 2.11 a callable learning rate is evaluated once.
+    if isinstance(opt.learning_rate, tf.Variable):
+        opt.learning_rate.assign(learningRate)
+    else:
+        # legacy optimisers set the variable backing the hyperparameter
+        opt.learning_rate = learningRate
+    trajectory = optimise(tf.constant(maxiter)).numpy()
+    return scipy.optimize.OptimizeResult(
+        nit=maxiter, fun=trajectory[-1], trajectory=trajectory
+    )
+
+
+def OptimiseBatch(
+    m, maxiter=100, gtol=1e-5, ftol=2.220446049250313e-09, memory=10, maxls=20
+):
+    """
+    Minimise the training loss of every problem of an AssignGPBatch model on its own with
+    L-BFGS. The problems share the evaluations of the batched objective, but each keeps its
+    own curvature history, backtracking line search and stopping test, so problems do not
+    influence each other. The stopping tests are those of scipy's L-BFGS-B, which
+    gpflow.optimizers.Scipy uses: a problem has converged once its largest gradient entry
+    is below gtol or an iteration lowers its objective by less than ftol relative. A problem
+    whose line search finds no decrease in maxls steps stops as not converged.
+    The objective and gradients are compiled once and cached on the model.
+    :param maxiter: maximum number of L-BFGS iterations of every problem
+    :param memory: number of curvature pairs kept for every problem
+    :return: scipy OptimizeResult with, for every problem, the number of iterations nit,
+        the final objective fun and whether it converged
+    """
+    variables = m.trainable_variables
+    if m.compiledOptimiser is None:
+        sizes = [int(np.prod(v.shape[1:])) for v in variables]
+
+        @tf.function
+        def valueAndGradients(x):
+            for v, xv in zip(variables, tf.split(x, sizes, axis=1)):
+                v.assign(tf.reshape(xv, tf.shape(v)))
+            with tf.GradientTape() as tape:
+                value = -m.batch_log_posterior_density()
+            # the problems are independent, so the gradient of their sum is theirs
+            gradients = tape.gradient(value, variables)
+            return value, tf.concat([tf.reshape(g, [m.P, -1]) for g in gradients], 1)
+
+        m.compiledOptimiser = valueAndGradients
+
+    def Evaluate(x):
+        value, gradients = m.compiledOptimiser(tf.constant(x))
+        return value.numpy(), gradients.numpy()
+
+    x = np.concatenate([np.reshape(v.numpy(), [m.P, -1]) for v in variables], 1)
+    f, g = Evaluate(x)
+    # curvature pairs, oldest first; a pair with rho 0 is empty and has no effect
+    S = np.zeros((memory,) + x.shape, dtype=x.dtype)
+    Y = np.zeros_like(S)
+    rho = np.zeros((memory, m.P), dtype=x.dtype)
+    gamma = np.ones(m.P, dtype=x.dtype)
+    nit = np.zeros(m.P, dtype=int)
+    converged = np.max(np.abs(g), axis=1) <= gtol
+    failed = np.zeros(m.P, dtype=bool)
+    # line search state; problems do not wait for each other, every evaluation of the
+    # batch is the next trial step of each problem that is still optimising
+    searching = np.zeros(m.P, dtype=bool)
+    d = np.zeros_like(x)
+    slope = np.zeros(m.P, dtype=x.dtype)
+    step = np.zeros(m.P, dtype=x.dtype)
+    trials = np.zeros(m.P, dtype=int)
+    while True:
+        start = ~(converged | failed | searching) & (nit < maxiter)
+        if np.any(start):
+            # search direction by the two-loop recursion
+            q = g.copy()
+            alpha = np.zeros_like(rho)
+            for j in reversed(range(memory)):
+                alpha[j] = rho[j] * np.sum(S[j] * q, axis=1)
+                q -= alpha[j][:, None] * Y[j]
+            r = gamma[:, None] * q
+            for j in range(memory):
+                beta = rho[j] * np.sum(Y[j] * r, axis=1)
+                r += S[j] * (alpha[j] - beta)[:, None]
+            d[start] = -r[start]
+            slope[start] = np.sum(g[start] * d[start], axis=1)
+            ascent = start & (slope >= 0)
+            d[ascent] = -g[ascent]
+            slope[ascent] = -np.sum(g[ascent] ** 2, axis=1)
+            # without curvature pairs the first step is scaled as in scipy
+            step[start] = np.where(
+                np.any(rho != 0, axis=0),
+                1.0,
+                np.minimum(1.0, 1.0 / np.linalg.norm(g, axis=1)),
+            )[start]
+            trials[start] = 0
+            searching |= start
+        if not np.any(searching):
+            break
+        xTrial = np.where(searching[:, None], x + step[:, None] * d, x)
+        fTrial, gTrial = Evaluate(xTrial)
+        trials += searching
+        # backtracking line search to a sufficient decrease
+        accept = searching & (fTrial <= f + 1e-4 * step * slope)
+        s, y = xTrial - x, gTrial - g
+        sy, yy = np.sum(s * y, axis=1), np.sum(y * y, axis=1)
+        # keep pairs of positive curvature only so the inverse Hessian stays positive definite
+        keep = accept & (sy > np.finfo(x.dtype).eps * yy)
+        S[:, keep], Y[:, keep], rho[:, keep] = (
+            np.roll(S[:, keep], -1, axis=0),
+            np.roll(Y[:, keep], -1, axis=0),
+            np.roll(rho[:, keep], -1, axis=0),
+        )
+        S[-1, keep], Y[-1, keep], rho[-1, keep] = s[keep], y[keep], 1.0 / sy[keep]
+        gamma[keep] = sy[keep] / yy[keep]
+        scale = np.maximum(np.maximum(np.abs(f), np.abs(fTrial)), 1.0)
+        converged |= accept & (
+            (np.max(np.abs(gTrial), axis=1) <= gtol) | (f - fTrial <= ftol * scale)
+        )
+        x[accept], f[accept], g[accept] = xTrial[accept], fTrial[accept], gTrial[accept]
+        nit += accept
+        searching &= ~accept
+        # a problem whose line search finds no decrease stops
+        failed |= searching & (trials >= maxls)
+        searching &= ~failed
+        # minimum of the quadratic through f, slope and fTrial, kept in [0.1, 0.5] step
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shrink = -slope * step / (2 * (fTrial - f - slope * step))
+        shrink = np.clip(np.nan_to_num(shrink, nan=0.1), 0.1, 0.5)
+        step[searching] *= shrink[searching]
+    Evaluate(x)  # the last evaluation may be a trial step
+    return scipy.optimize.OptimizeResult(nit=nit, fun=f, success=converged)
+
+
+def GetModelState(m):
+    """ Values of the trainable variables of model m """
+    return [v.numpy() for v in m.trainable_variables]
+
+
+def SetModelState(m, state):
+    """ Restore trainable variables of model m saved by GetModelState """
+    for v, value in zip(m.trainable_variables, state):
+        v.assign(value)
+
+
+def GetModelRecord(m):
+    """
+    Plain arrays describing an AssignGP or AssignGPSparse model: its data, branching
+    point, compact N x 3 assignment logits, prior on assignments, hyperparameters,
+    whether they were fixed and inducing points (none for the dense model). See
+    BuildModelFromRecord.
+    """
+    return {
+        "GPt": np.array(m.t, dtype=float),
+        "GPy": np.array(m.Y, dtype=float),
+        "b": float(m.b.flatten()[0]),
+        "logPhi": m.logPhi.numpy().astype(float),
+        "phiPrior": m.eZ0[:, 1:].astype(float),
+        "likvar": float(m.likelihood.variance.numpy()),
+        "kerlen": float(m.kernel.kernels[0].kern.lengthscales.numpy()),
+        "kervar": float(m.kernel.kernels[0].kern.variance.numpy()),
+        "jitter": float(m.kernel.kernels[1].variance.numpy()),
+        "fixHyperparameters": not m.likelihood.variance.trainable,
+        "ZExpanded": (
+            m.ZExpanded.numpy().astype(float)
+            if isinstance(m, assigngp_denseSparse.AssignGPSparse)
+            else np.zeros((0, 2))
+        ),
+        "fPlaceInducingPoints": bool(getattr(m, "fPlaceInducingPoints", False)),
+    }
+
+
+def BuildModelFromRecord(record):
+    """Model ready to predict from a record of GetModelRecord, without optimising. The
+    hyperparameters have the priors of FitModel unless they were fixed."""
+    GPt = np.asarray(record["GPt"])
+    XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(GPt)
+    b = np.ones((1, 1)) * record["b"]
+    kb = _BuildBranchingKernel()
+    ZExpanded = np.asarray(record["ZExpanded"])
+    # any valid initial assignment, the fitted one is assigned below
+    phiInitial = np.ones((GPt.size, 2)) * 0.5
+    if ZExpanded.shape[0] == 0:
+        m = assigngp_dense.AssignGP(
+            GPt,
+            XExpanded,
+            np.asarray(record["GPy"]),
+            kb,
+            indices,
+            b,
+            phiInitial=phiInitial,
+            phiPrior=np.asarray(record["phiPrior"]),
+        )
+    else:
+        m = assigngp_denseSparse.AssignGPSparse(
+            GPt,
+            XExpanded,
+            np.asarray(record["GPy"]),
+            kb,
+            indices,
+            b,
+            ZExpanded,
+            phiInitial=phiInitial,
+            phiPrior=np.asarray(record["phiPrior"]),
+            fPlaceInducingPoints=bool(record["fPlaceInducingPoints"]),
+        )
+        m.ZExpanded.assign(ZExpanded)
+    m.logPhi.assign(record["logPhi"])
+    _InitialiseHyperparameters(
+        m,
+        record["likvar"],
+        record["kerlen"],
+        record["kervar"],
+        False,
+        bool(record["fixHyperparameters"]),
+    )
+    m.kernel.kernels[1].variance.assign(record["jitter"])
+    return m
+
+
+def SaveModel(path, m):
+    """ Write a model, or its record of GetModelRecord, to an npz file """
+    record = m if isinstance(m, dict) else GetModelRecord(m)
+    np.savez(path, **record)
+
+
+def LoadModel(path):
+    """ Model ready to predict from an npz file written by SaveModel """
+    with np.load(path) as z:
+        record = {k: z[k][()] if z[k].ndim == 0 else z[k] for k in z.files}
+    return BuildModelFromRecord(record)
+
+
+def _AddModelRecord(d, modelArgs):
+    """Add to the FitModel dictionary d the record of the model at its most likely
+    branching point, built from modelArgs with the winning Phi and hyperparameters"""
+    if not isinstance(d["posteriorB"], dict):
+        return d  # failed fit
+    m = _BuildModel(**modelArgs)
+    m.UpdateBranchingPoint(
+        np.ones((1, 1)) * d["posteriorB"]["Bmode"], modelArgs["phiInitial"]
+    )
+    # softmax(log Phi) = Phi, floored so that a zero probability stays finite
+    m.logPhi.assign(np.log(np.maximum(d["Phi"], np.finfo(float).tiny)))
+    hyps = d["hyperparameters"]
+    m.likelihood.variance.assign(hyps["likvar"])
+    m.kernel.kernels[0].kern.lengthscales.assign(hyps["kerlen"])
+    m.kernel.kernels[0].kern.variance.assign(hyps["kervar"])
+    d["modelRecord"] = GetModelRecord(m)
+    return d
+
+
+def _FitModelPruned(
+    m, bConsider, phiInitial, maxiter, fPredict, pruneIter, pruneRate, fCAVI=False
+):
+    """Successive halving over the candidate branching points. Every candidate is fitted
+    for pruneIter iterations from the same initial state; then only the best 1/pruneRate
+    candidates, and always the last one, are kept and their budget multiplied by
+    pruneRate, until every survivor has converged or used maxiter iterations. Returns the
+    results of every candidate and which of them were pruned."""
+    n = len(bConsider)
+    initialState = GetModelState(m)
+    states = [None] * n
+    results = [None] * n
+    iterations = np.zeros(n, dtype=int)
+    pruned = np.zeros(n, dtype=bool)
+    alive = list(range(n))
+    budget = pruneIter
+    while len(alive) > 0:
+        finished = list()
+        for ib in alive:
+            iters = min(budget, maxiter - iterations[ib])
+            if states[ib] is None:
+                # initial hyperparameters; the assignment is reset for the branching point
+                SetModelState(m, initialState)
+            r = _FitBranchingPoint(
+                m,
+                bConsider[ib],
+                phiInitial,
+                iters,
+                False,
+                state=states[ib],
+                fCAVI=fCAVI,
             )
-            ll[ib] = m.log_posterior_density()
+            states[ib] = GetModelState(m)
+            nit = r["iterations"]
+            iterations[ib] += nit
+            r["iterations"] = iterations[ib]
+            results[ib] = r
+            # optimiser stopped before the budget of this round: converged
+            if nit < iters or iterations[ib] >= maxiter:
+                finished.append(ib)
+        alive = [ib for ib in alive if ib not in finished]
+        ranked = sorted(alive, key=lambda ib: -results[ib]["loglik"])
+        keep = ranked[: int(np.ceil(len(alive) / pruneRate))]
+        if n - 1 in alive and n - 1 not in keep:
+            # the last candidate (no branching) is the reference of the Bayes factor
+            keep.append(n - 1)
+        pruned[[ib for ib in alive if ib not in keep]] = True
+        alive = keep
+        budget *= pruneRate
+    if fPredict:
+        # predictions of the winner, from its final state
+        iw = int(np.argmax([r["loglik"] for r in results]))
+        m.UpdateBranchingPoint(np.ones((1, 1)) * bConsider[iw], phiInitial)
+        SetModelState(m, states[iw])
+        ttestl, mul, varl = VBHelperFunctions.predictBranchingModel(m)
+        results[iw]["prediction"] = {"xtest": ttestl, "mu": mul, "var": varl}
+    return results, pruned
+
+
+def _FitModelGrowM(m, bConsider, modelArgs, maxiter, fPredict, fCAVI, MTolerance, MMax):
+    """Fit every candidate branching point with the sparse model m, then with models of
+    twice as many inducing points warm started from the previous optimum of each
+    candidate, until the log likelihoods change by at most MTolerance or MMax is
+    reached. Returns the results of the last model and the M and log likelihoods of
+    every step."""
+    phiInitial = modelArgs["phiInitial"]
+    M = modelArgs["M"]
+    states = [None] * len(bConsider)
+    iterations = np.zeros(len(bConsider), dtype=int)
+    trajectory = {"M": list(), "loglik": list()}
+    while True:
+        results = list()
+        for ib, b in enumerate(bConsider):
+            # hyperparameters and assignment do not depend on M
+            r = _FitBranchingPoint(
+                m, b, phiInitial, maxiter, False, state=states[ib], fCAVI=fCAVI
+            )
+            states[ib] = GetModelState(m)
+            iterations[ib] += r["iterations"]
+            r["iterations"] = iterations[ib]
+            results.append(r)
+        ll = np.array([r["loglik"] for r in results])
+        trajectory["M"].append(M)
+        trajectory["loglik"].append(ll)
+        if len(trajectory["M"]) > 1:
+            change = np.abs(ll - trajectory["loglik"][-2])
+            if np.all(change <= MTolerance):
+                break
+        if M >= MMax:
+            break
+        M = min(2 * M, MMax)
+        m = _BuildModel(**dict(modelArgs, M=M))
+    if fPredict:
+        # predictions of the winner, from its final state
+        iw = int(np.argmax(ll))
+        m.UpdateBranchingPoint(np.ones((1, 1)) * bConsider[iw], phiInitial)
+        SetModelState(m, states[iw])
+        ttestl, mul, varl = VBHelperFunctions.predictBranchingModel(m)
+        results[iw]["prediction"] = {"xtest": ttestl, "mu": mul, "var": varl}
+    trajectory = {
+        "M": np.array(trajectory["M"]),
+        "loglik": np.array(trajectory["loglik"]),
+    }
+    return results, trajectory
+
+
+def GetContinuationPhi(Phi, b, GPt, phiInitial):
+    """Initial N x 2 branch assignment for a branching point next to b, from the compact
+    N x 3 assignment Phi fitted at b. Cells on a branch at b keep their relative branch
+    probabilities; cells on the trunk at b, which may move onto a branch, fall back to
+    phiInitial."""
+    phiStart = phiInitial.copy()
+    fBranch = GPt > b
+    phiBranch = Phi[fBranch, 1] / Phi[fBranch, 1:].sum(1)
+    # keep away from 0 and 1 so the initial logits stay finite
+    phiBranch = np.clip(phiBranch, 1e-6, 1 - 1e-6)
+    phiStart[fBranch, 0] = phiBranch
+    phiStart[fBranch, 1] = 1 - phiBranch
+    return phiStart
+
+
+def _GetContinuationStart(m, b, phiWarm, phiInitial, coldState):
+    """Start of the fit at b in a continuation sweep: the warm start, i.e. the
+    hyperparameters of the previous fit with assignment phiWarm, unless the cold start,
+    i.e. the hyperparameters coldState with assignment phiInitial, has a higher bound at b.
+    Returns the assignment and the trainable variable state to pass to _FitBranchingPoint"""
+    loss = m.training_loss_closure()
+    m.UpdateBranchingPoint(np.ones((1, 1)) * b, phiWarm)
+    warm = (phiWarm, GetModelState(m))
+    warmLoss = loss().numpy()
+    SetModelState(m, coldState)
+    m.UpdateBranchingPoint(np.ones((1, 1)) * b, phiInitial)
+    if loss().numpy() < warmLoss:
+        return phiInitial, GetModelState(m)
+    return warm
+
+
+def _InitialiseWorker(numThreads):
+    """ Limit the TF threads of a pool worker so that the pool does not oversubscribe cores """
+    tf.config.threading.set_intra_op_parallelism_threads(numThreads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _FitBranchingPointTask(b, seed, modelArgs, maxiter, fPredict, fCAVI):
+    """ Worker task: fit a fresh model at a single branching point """
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+    m = _BuildModel(**modelArgs)
+    r = _FitBranchingPoint(
+        m, b, modelArgs["phiInitial"], maxiter, fPredict, fCAVI=fCAVI
+    )
+    # return plain arrays to the parent process
+    for k in ["mu", "var"]:
+        r["prediction"][k] = [np.asarray(a) for a in r["prediction"][k]]
+    return r
+
+
+def _FitModelParallel(
+    bConsider, modelArgs, n_jobs, seed, maxiter, fPredict, fDebug, fCAVI=False
+):
+    """Process-parallel version of FitModel. Every candidate branching point is fitted in
+    a pool worker from the same initial conditions and hyperparameters, as a separate
+    FitModel call per branching point would, rather than from the hyperparameters of the
+    previous branching point as the sequential path does."""
+    numCores = os.cpu_count() or 1
+    if n_jobs == -1:
+        n_jobs = numCores
+    n_jobs = min(n_jobs, len(bConsider))
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=context,
+        initializer=_InitialiseWorker,
+        initargs=(max(1, numCores // n_jobs),),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _FitBranchingPointTask,
+                b,
+                seed + ib,
+                modelArgs,
+                maxiter,
+                fPredict,
+                fCAVI,
+            )
+            for ib, b in enumerate(bConsider)
+        ]
+        try:
+            results = [f.result() for f in futures]
         except Exception as ex:
-            print(f"Unexpected error: {ex} {'-' * 60}\nCaused by model: {m} {'-' * 60}")
+            print(f"Unexpected error: {ex} {'-' * 60}")
+            ll = np.zeros(len(bConsider))
             ll[0] = np.nan
-            # return model so can inspect model
             return {
                 "loglik": ll,
-                "model": m,
+                "model": None,
                 "Phi": np.nan,
                 "prediction": {"xtest": np.nan, "mu": np.nan, "var": np.nan},
                 "hyperparameters": np.nan,
                 "posteriorB": np.nan,
             }
-        # prediction
-        Phi = m.GetPhi()
-        Phi_l.append(Phi)
-        if fPredict:
-            ttestl, mul, varl = VBHelperFunctions.predictBranchingModel(m)
-            ttestl_l.append(ttestl), mul_l.append(mul), varl_l.append(varl)
-        else:
-            ttestl_l.append([]), mul_l.append([]), varl_l.append([])
+    ll = np.array([r["loglik"] for r in results])
     iw = np.argmax(ll)
     postB = GetPosteriorB(ll, bConsider)
     if fDebug:
@@ -166,21 +1414,308 @@ def FitModel(
             "BGP Maximum at b=%.2f" % bConsider[iw],
             "CI= [%.2f, %.2f]" % (postB["B_CI"][0], postB["B_CI"][1]),
         )
-    assert np.allclose(bConsider[iw], postB["Bmode"]), "%s-%s" % str(
-        postB["B_CI"], bConsider[iw]
-    )
     return {
         "loglik": ll,
-        "Phi": Phi_l[iw],  # 'model': m,
-        "prediction": {"xtest": ttestl_l[iw], "mu": mul_l[iw], "var": varl_l[iw]},
-        "hyperparameters": hyps[iw],
+        "Phi": results[iw]["Phi"],
+        "prediction": results[iw]["prediction"],
+        "hyperparameters": results[iw]["hyperparameters"],
         "posteriorB": postB,
+        "iterations": np.array([r["iterations"] for r in results]),
+        "pruned": np.zeros(len(bConsider), dtype=bool),
+    }
+
+
+def _FitModelsBatch(
+    bConsider,
+    GPt,
+    GPy,
+    XExpanded,
+    indices,
+    phiInitial,
+    phiPrior,
+    M,
+    likvar,
+    kerlen,
+    kervar,
+    fDebug,
+    maxiter,
+    fPredict,
+    fixHyperparameters,
+    fPlaceInducingPoints=False,
+):
+    """Batched version of FitModel for the N x G expression matrix GPy: every (gene,
+    candidate branching point) pair is a problem of one model, optimised on its own by
+    OptimiseBatch from the initial hyperparameters. Returns a list of G dictionaries."""
+    nb = len(bConsider)
+    G = GPy.shape[1]
+    # problem g * nb + ib is gene g at branching point bConsider[ib]
+    b = np.tile(np.array(bConsider), G)
+    if M == 0:
+        ZExpanded = None
+    elif fPlaceInducingPoints:
+        ZExpanded = np.stack(
+            [VBHelperFunctions.GetBranchingInducingPoints(M, bp, GPt) for bp in b]
+        )
+    else:
+        ZExpanded = GetInducingPoints(M)
+    m = _BuildModelBatch(
+        GPt,
+        XExpanded,
+        np.repeat(GPy.T[:, :, None], nb, axis=0),
+        indices,
+        b,
+        ZExpanded,
+        phiInitial,
+        phiPrior,
+        likvar,
+        kerlen,
+        kervar,
+        fDebug,
+        fixHyperparameters,
+    )
+    try:
+        optResult = OptimiseBatch(m, maxiter=maxiter)
+        if fDebug:
+            print(
+                "%g of %g problems converged, iterations %s"
+                % (optResult.success.sum(), m.P, str(optResult.nit))
+            )
+        llAll = m.batch_log_posterior_density().numpy().reshape(G, nb)
+    except Exception as ex:
+        print(f"Unexpected error: {ex} {'-' * 60}\nCaused by model: {m} {'-' * 60}")
+        ll = np.zeros(nb)
+        ll[0] = np.nan
+        return [
+            {
+                "loglik": ll.copy(),
+                "model": m,
+                "Phi": np.nan,
+                "prediction": {"xtest": np.nan, "mu": np.nan, "var": np.nan},
+                "hyperparameters": np.nan,
+                "posteriorB": np.nan,
+            }
+            for _ in range(G)
+        ]
+    iws = np.argmax(llAll, axis=1)
+    Phi = m.GetPhi()
+    hyps = m.GetHyperparameters()
+    # predictions of every problem on the grid of each winning branching point
+    predictions = dict()
+    if fPredict:
+        for iw in np.unique(iws):
+            ttest, mu, var = VBHelperFunctions.predictBranchingModelGrid(
+                m, VBHelperFunctions.GetPredictionGrid(GPt, bConsider[iw])
+            )  # P x 3 x T x D
+            ttestl = [tt[:, None] for tt in ttest]
+            mul = [mu[:, f] for f in range(3)]
+            varl = [var[:, f] for f in range(3)]
+            predictions[iw] = (ttestl, mul, varl)
+    results = list()
+    for g in range(G):
+        iw = iws[g]
+        p = g * nb + iw
+        postB = GetPosteriorB(llAll[g], bConsider)
+        if fDebug:
+            print(
+                "Gene %g BGP Maximum at b=%.2f" % (g, bConsider[iw]),
+                "CI= [%.2f, %.2f]" % (postB["B_CI"][0], postB["B_CI"][1]),
+            )
+        if fPredict:
+            ttestl, mul, varl = predictions[iw]
+            prediction = {
+                "xtest": ttestl,
+                "mu": [mu[p] for mu in mul],
+                "var": [var[p] for var in varl],
+            }
+        else:
+            prediction = {"xtest": [], "mu": [], "var": []}
+        results.append(
+            {
+                "loglik": llAll[g],
+                "Phi": Phi[p],
+                "prediction": prediction,
+                "hyperparameters": {k: v[p] for k, v in hyps.items()},
+                "posteriorB": postB,
+                "iterations": optResult.nit[g * nb : (g + 1) * nb],
+                "pruned": np.zeros(nb, dtype=bool),
+            }
+        )
+    return results
+
+
+def _BuildModelBatch(
+    GPt,
+    XExpanded,
+    Y,
+    indices,
+    b,
+    ZExpanded,
+    phiInitial,
+    phiPrior,
+    likvar,
+    kerlen,
+    kervar,
+    fDebug,
+    fixHyperparameters,
+):
+    """ Create the batched model of the P x N x 1 expression Y and set its hyperparameters """
+    m = assigngp_batch.AssignGPBatch(
+        GPt,
+        XExpanded,
+        Y,
+        indices,
+        b,
+        ZExpanded=ZExpanded,
+        phiInitial=phiInitial,
+        phiPrior=phiPrior,
+        fDebug=fDebug,
+    )
+    # Initialise hyperparameters
+    m.likelihoodVariance.assign(np.ones(m.P) * likvar)
+    m.kernelLengthscales.assign(np.ones(m.P) * kerlen)
+    m.kernelVariance.assign(np.ones(m.P) * kervar)
+    if fixHyperparameters:
+        print("Fixing hyperparameters")
+        set_trainable(m.kernelLengthscales, False)
+        set_trainable(m.likelihoodVariance, False)
+        set_trainable(m.kernelVariance, False)
+    else:
+        m.kernelLengthscales.prior = tfp.distributions.Normal(
+            to_default_float(2.0), to_default_float(1.0)
+        )
+        m.kernelVariance.prior = tfp.distributions.Normal(
+            to_default_float(3.0), to_default_float(1.0)
+        )
+        m.likelihoodVariance.prior = tfp.distributions.Normal(
+            to_default_float(0.1), to_default_float(0.1)
+        )
+    return m
+
+
+def EstimateCost(N, M, numB, maxiter=100, fFloat32=False, flopRate=5e9):
+    """
+    Predict the resources FitModel needs before any model is built. The constants were
+    calibrated against peak resident memory and gradient timings of TensorFlow on CPU, so
+    take the estimates as a guide to the order of magnitude on other machines.
+    :param N: number of cells
+    :param M: number of inducing points, 0 for the dense model
+    :param numB: number of candidate branching points
+    :param maxiter: maximum number of optimiser iterations per branching point
+    :param fFloat32: single precision fit, see FitModel
+    :param flopRate: floating point operations per second of the machine
+    :return: dictionary of the peak memory in bytes that the fit adds to the process, the
+        floating point operations of one gradient evaluation and of the whole fit (one
+        evaluation per iteration) and the seconds the fit takes at flopRate, excluding
+        the few seconds spent tracing the model
+    """
+    bytesPerFloat = 4 if fFloat32 else 8
+    n = 3 * N  # entries of XExpanded
+    if M == 0:
+        # 3N x 3N kernel, Cholesky factors and their gradients
+        floats = 26 * n ** 2
+        flopsGradient = 8 * n ** 3
+    else:
+        # M x 3N cross covariances and their gradients; the elementwise branching kernel
+        # is memory bound and costs as much as about 900 operations per entry
+        floats = 23 * M * n + 10 * M ** 2
+        flopsGradient = n * (900 * M + 6 * M ** 2)
+    # fixed and per cell costs of the model, data and traced graph
+    memory = 65e6 + N * 1000 * bytesPerFloat + floats * bytesPerFloat
+    flops = flopsGradient * numB * maxiter
+    return {
+        "memory": memory,
+        "flopsGradient": flopsGradient,
+        "flops": flops,
+        "seconds": flops / flopRate,
     }
 
 
-def GetPosteriorB(objUnsorted, BgridSearch, ciLimits=[0.01, 0.99]):
+def ChooseModelSize(
+    N,
+    numB,
+    maxiter=100,
+    memoryBudget=None,
+    timeBudget=None,
+    fFloat32=False,
+    flopRate=5e9,
+    MMax=100,
+):
+    """
+    Choose the dense model if it fits the budgets, otherwise the sparse model with the
+    largest number of inducing points up to MMax that does, see EstimateCost.
+    :param memoryBudget: bytes the fit may add to the process, by default the physical
+        memory of the machine. Required where the platform does not report it (Windows).
+    :param timeBudget: seconds the fit may take, no limit if None
+    :return: the number of inducing points M, 0 for the dense model. Raises BudgetError
+        if no model with at least 3 inducing points (one per function) fits the budgets.
+    """
+    if memoryBudget is None:
+        memoryBudget = GetPhysicalMemory()
+        if memoryBudget is None:
+            raise BudgetError(
+                "The physical memory of this machine is unknown, pass memoryBudget"
+            )
+
+    def fits(M):
+        cost = EstimateCost(N, M, numB, maxiter, fFloat32, flopRate)
+        return cost["memory"] <= memoryBudget and (
+            timeBudget is None or cost["seconds"] <= timeBudget
+        )
+
+    if fits(0):
+        return 0
+    MMax = min(MMax, 3 * N)
+    if not fits(3):
+        cost = EstimateCost(N, 3, numB, maxiter, fFloat32, flopRate)
+        raise BudgetError(
+            "No model of %g cells fits a budget of %.3g GB and %s seconds. The smallest "
+            "sparse model (M=3) needs %.3g GB and %.3g seconds."
+            % (
+                N,
+                memoryBudget / 1e9,
+                "unlimited" if timeBudget is None else "%.3g" % timeBudget,
+                cost["memory"] / 1e9,
+                cost["seconds"],
+            )
+        )
+    # the cost grows with M, find the largest M that fits by bisection
+    lower, upper = 3, MMax
+    while lower < upper:
+        M = (lower + upper + 1) // 2
+        if fits(M):
+            lower = M
+        else:
+            upper = M - 1
+    return lower
+
+
+def GetPhysicalMemory():
+    """ Bytes of physical memory of the machine, None if the platform does not report it """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        # os.sysconf does not exist on Windows, or the name is not supported
+        return None
+
+
+def GetFloat32Config():
+    """ GPflow configuration of the current one with single precision floats """
+    return dataclasses.replace(gpflow.config.config(), float=np.float32)
+
+
+def GetInducingPoints(M):
+    """ M inducing points spread uniformly over [0, 1), cycling through functions 1, 2, 3 """
+    ZExpanded = np.ones((M, 2))
+    ZExpanded[:, 0] = np.linspace(0, 1, M, endpoint=False)
+    ZExpanded[:, 1] = np.array([i for j in range(M) for i in range(1, 4)])[:M]
+    return ZExpanded
+
+
+def GetPosteriorB(objUnsorted, BgridSearch, ciLimits=[0.01, 0.99], weights=None):
     """
     Return posterior on B for each experiment, confidence interval index, map index
+    weights are the grid cell widths (see GetGridWeights) of a non-uniform grid, in the
+    order of BgridSearch; a uniform grid needs none
     """
     # for each trueB calculate posterior over grid
     # ... in a numerically stable way
@@ -194,6 +1729,8 @@ def GetPosteriorB(objUnsorted, BgridSearch, ciLimits=[0.01, 0.99]):
     o = objUnsorted[isort].copy()  # sorted objective funtion
     imode = np.argmax(o)
     pn = np.exp(o - np.max(o))
+    if weights is not None:
+        pn = pn * np.asarray(weights)[isort]
     p = pn / pn.sum()
     assert np.any(~np.isnan(p)), "Nans in p! %s" % str(p)
     assert np.any(~np.isinf(p)), "Infinities in p! %s" % str(p)
@@ -222,13 +1759,13 @@ def GetPosteriorB(objUnsorted, BgridSearch, ciLimits=[0.01, 0.99]):
     }
 
 
-def GetInitialConditionsAndPrior(globalBranching, v, infPriorPhi):
-    # Setting initial phi
-    np.random.seed(42)  # UNDONE remove TODO
+def GetInitialConditionsAndPrior(globalBranching, v, infPriorPhi, seed=42):
+    # Setting initial phi, random state is local so that global seeding is left alone
+    rng = np.random.RandomState(seed)
     assert isinstance(v, float), "v should be scalar is %s" % str(type(v))
     N = globalBranching.size
     phiInitial = np.ones((N, 2)) * 0.5  # don't know anything
-    phiInitial[:, 0] = np.random.rand(N)
+    phiInitial[:, 0] = rng.rand(N)
     phiInitial[:, 1] = 1 - phiInitial[:, 0]
     phiPrior = np.ones_like(phiInitial) * 0.5  # don't know anything
     for i in range(N):
@@ -241,7 +1778,7 @@ def GetInitialConditionsAndPrior(globalBranching, v, infPriorPhi):
                 phiPrior[i, :] = 1 - v
                 phiPrior[i, int(iBranch)] = v
             phiInitial[i, int(iBranch)] = 0.5 + (
-                np.random.random() / 2.0
+                rng.random_sample() / 2.0
             )  # number between [0.5, 1]
             phiInitial[i, int(iBranch) != np.array([0, 1])] = (
                 1 - phiInitial[i, int(iBranch)]
@@ -0,0 +1,180 @@
+"""
+Fit results of many genes stored column by column in npz shards.
+
+Every call of ResultStore.Append writes one shard holding a batch of genes. A shard has
+one array per entry of the FitModel dictionaries, named by its path (loglik, Phi,
+posteriorB/Bmode, hyperparameters/kerlen, prediction/mu, ...), stacking that entry over
+the genes of the batch. Lists of arrays such as the predictions of the three functions
+are stored as one plain float array (functions x points x outputs). An entry that some
+genes of the batch lack, or hold with a different shape (the NaN placeholders of a failed
+fit, MTrajectory of different lengths), is stored per gene as <entry>#<row>.
+
+Shards are written atomically and never changed, so a store grows as genes are fitted
+and an interrupted run leaves every finished shard readable. Reading a gene loads only
+the shard holding it; reading an entry of every gene loads only that entry of each shard.
+"""
+import json
+import os
+import re
+
+import numpy as np
+
+_LIST = "[]"  # path component marking a list stacked into one array
+
+
+def _Flatten(d, prefix=""):
+    """ Flat dictionary of the numpy arrays of a nested result dictionary """
+    flat = dict()
+    for k, v in d.items():
+        key = prefix + str(k)
+        if isinstance(v, dict):
+            flat.update(_Flatten(v, key + "/"))
+        elif isinstance(v, (list, tuple)):
+            flat[key + "/" + _LIST] = (
+                np.stack([np.asarray(a) for a in v]) if len(v) > 0 else np.zeros(0)
+            )
+        else:
+            v = np.asarray(v)
+            if v.dtype == object:
+                continue  # models and other objects are not results
+            flat[key] = v
+    return flat
+
+
+def _Unflatten(flat):
+    """ Nested result dictionary of a flat one, as returned by FitModel """
+    d = dict()
+    for key, v in flat.items():
+        path = key.split("/")
+        node = d
+        for k in path[:-2]:
+            node = node.setdefault(k, dict())
+        if path[-1] == _LIST:
+            node[path[-2]] = list(v)
+        else:
+            if len(path) > 1:
+                node = node.setdefault(path[-2], dict())
+            node[path[-1]] = v[()] if v.ndim == 0 else v
+    return d
+
+
+def _IsColumn(values):
+    """ True if the values of genes stack into one array """
+    return all(v is not None for v in values) and all(
+        v.shape == values[0].shape for v in values
+    )
+
+
+class ResultStore:
+    """
+    Directory of npz shards holding FitModel results by gene
+    :param path: store directory, created if needed. Genes already in it are kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index = dict()  # gene -> (shard, row)
+        self.attributes = dict()
+        if os.path.exists(os.path.join(path, "attributes.json")):
+            with open(os.path.join(path, "attributes.json")) as f:
+                self.attributes = json.load(f)
+        for shard in self._GetShards():
+            with np.load(os.path.join(path, shard)) as z:
+                for row, gene in enumerate(z["gene"]):
+                    # a gene appended again is read from its latest shard
+                    self.index[str(gene)] = (shard, row)
+
+    def _GetShards(self):
+        """ Shard files in the order they were written """
+        return sorted(f for f in os.listdir(self.path) if re.match(r"^\d+\.npz$", f))
+
+    @property
+    def genes(self):
+        """ Genes in the store, in the order they were appended """
+        return list(self.index)
+
+    def __contains__(self, gene):
+        return str(gene) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def SetAttributes(self, **attributes):
+        """ Store JSON serialisable settings of the fits, such as the candidate branching points """
+        self.attributes.update(attributes)
+        tmp = os.path.join(self.path, "attributes.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.attributes, f)
+        os.replace(tmp, os.path.join(self.path, "attributes.json"))
+
+    def Append(self, genes, results):
+        """
+        Write the results of a batch of genes as a new shard
+        :param genes: gene names
+        :param results: FitModel dictionaries, one per gene. Tensors are stored as arrays
+            and models are dropped.
+        """
+        assert len(genes) == len(results), "need one result per gene"
+        assert len(genes) > 0, "nothing to append"
+        flat = [_Flatten(d) for d in results]
+        columns = {"gene": np.array([str(g) for g in genes])}
+        for key in sorted(set().union(*flat)):
+            values = [f.get(key) for f in flat]
+            if _IsColumn(values) and len(set(v.dtype.kind for v in values)) == 1:
+                columns[key] = np.stack(values)
+            else:
+                for row, v in enumerate(values):
+                    if v is not None:
+                        columns["%s#%d" % (key, row)] = v
+        shards = self._GetShards()
+        shard = "%06d.npz" % (int(shards[-1][:-4]) + 1 if len(shards) > 0 else 0)
+        tmp = os.path.join(self.path, shard + ".tmp.npz")
+        np.savez(tmp, **columns)
+        os.replace(tmp, os.path.join(self.path, shard))
+        for row, gene in enumerate(genes):
+            self.index[str(gene)] = (shard, row)
+
+    def Get(self, gene):
+        """ FitModel dictionary of a gene, with numpy arrays for tensors """
+        (shard, row) = self.index[str(gene)]
+        flat = dict()
+        with np.load(os.path.join(self.path, shard)) as z:
+            for key in z.files:
+                if key == "gene":
+                    continue
+                if "#" not in key:
+                    flat[key] = z[key][row]
+                elif key.endswith("#%d" % row):
+                    flat[key[: key.rindex("#")]] = z[key]
+        return _Unflatten(flat)
+
+    def GetEntry(self, key, genes=None):
+        """
+        One entry of many genes, such as "loglik", "posteriorB/Bmode" or "prediction/mu"
+        :param genes: genes to read, all genes of the store if None
+        :return: array stacking the entry over genes, or a list if shapes differ. Genes
+            without the entry give None.
+        """
+        if genes is None:
+            genes = self.genes
+        names = [key, key + "/" + _LIST]
+        values = []
+        columns = dict()  # entry of every shard read so far, without the list marker
+        for gene in genes:
+            (shard, row) = self.index[str(gene)]
+            if shard not in columns:
+                with np.load(os.path.join(self.path, shard)) as z:
+                    columns[shard] = {
+                        k.replace(names[1], key): z[k]
+                        for k in z.files
+                        if k.split("#")[0] in names
+                    }
+            column = columns[shard]
+            if key in column:
+                values.append(column[key][row])
+            else:
+                values.append(column.get("%s#%d" % (key, row)))
+        if _IsColumn(values):
+            return np.stack(values) if len(values) > 0 else np.zeros(0)
+        return values
@@ -1,4 +1,6 @@
+import gpflow
 import numpy as np
+import tensorflow as tf
 from matplotlib import pyplot as plt
 
 
@@ -11,6 +13,9 @@ def CalculateBranchingEvidence(d, Bsearch=None):
     """
     if Bsearch is None:
         Bsearch = list(np.linspace(0.05, 0.95, 5)) + [1.1]
+    if "pruned" in d and np.any(d["pruned"]):
+        # pruned candidates carry partial bounds, see FitModel fPrune
+        print("Pruned candidate branching points %s" % str(np.flatnonzero(d["pruned"])))
     # Calculate probability of branching at each point
     o = d["loglik"][:-1]
     pn = np.exp(o - np.max(o))
@@ -105,8 +110,8 @@ def plotBranchModel(
         fig = plt.gcf()
     d = 0  # constraint code to be 1D for now
     for f in range(3):
-        mu = mul[f].numpy()
-        var = varl[f].numpy()
+        mu = np.asarray(mul[f])
+        var = np.asarray(varl[f])
         ttest = ttestl[f]
         col = colorarray[f]  # mean.get_color()
         (mean,) = ax.plot(ttest, mu[:, d], linewidth=lw, color=col)
@@ -140,31 +145,59 @@ def plotBranchModel(
 
 def predictBranchingModel(m, full_cov=False):
     """ return prediction of branching model """
-    pt = m.t
-    B = m.kernel.kernels[0].Bv.flatten()
-    l = np.min(pt)
-    u = np.max(pt)
-    mul = list()
-    varl = list()
-    ttestl = list()
-    for f in range(1, 4):
-        if f == 1:
-            ttest = np.linspace(l, B, 100)  # [:, None]  # root
-        else:
-            ttest = np.linspace(B, u, 100)  # [:, None]
-        Xtest = np.hstack((ttest, ttest * 0 + f))
-        mu, var = m.predict_f(Xtest, full_cov=full_cov)
+    B = m.kernel.kernels[0].Bv.flatten()[0]
+    ttest, mu, var = predictBranchingModelGrid(
+        m, GetPredictionGrid(m.t, B), full_cov=full_cov
+    )
+    assert np.all(np.isfinite(mu)), "All elements should be finite but are " + str(mu)
+    assert np.all(np.isfinite(var)), "All elements should be finite but are " + str(var)
+    return [tt[:, None] for tt in ttest], list(mu), list(var)
 
-        assert np.all(np.isfinite(mu)), "All elements should be finite but are " + str(
-            mu
-        )
-        assert np.all(np.isfinite(var)), "All elements should be finite but are " + str(
-            var
-        )
-        mul.append(mu)
-        varl.append(var)
-        ttestl.append(ttest)
-    return ttestl, mul, varl
+
+def GetPredictionGrid(t, B, T=100):
+    """3 x T pseudotimes at which predictBranchingModel predicts the trunk (up to B)
+    and both branches (from B) for cells with pseudotime t"""
+    return np.stack(
+        [
+            np.linspace(np.min(t), B, T),
+            np.linspace(B, np.max(t), T),
+            np.linspace(B, np.max(t), T),
+        ]
+    )
+
+
+def predictBranchingModelGrid(m, ttest, full_cov=False):
+    """
+    Predict the trunk and both branches of a branching model with a single call to
+    m.predict_f, i.e. one kernel evaluation and no Python loop over functions.
+    :param m: AssignGP, AssignGPSparse or AssignGPBatch model. The batched model
+        predicts every problem (e.g. every gene) at once.
+    :param ttest: T pseudotimes at which every function is predicted or a 3 x T array,
+        row f - 1 holding the pseudotimes of function f (see GetPredictionGrid)
+    :param full_cov: also return the covariance between the T points of each function
+    :return: 3 x T pseudotimes and the mean and variance of each function, stacked as
+        3 x T x D, or 3 x T x T x D with full_cov. The batched model adds a leading
+        dimension of size P.
+    """
+    ttest = np.asarray(ttest, dtype=float)
+    if ttest.ndim == 1:
+        ttest = np.tile(ttest, (3, 1))
+    assert ttest.ndim == 2 and ttest.shape[0] == 3, "ttest must be T or 3 x T"
+    T = ttest.shape[1]
+    functions = np.repeat(np.arange(1.0, 4.0)[:, None], T, 1)
+    Xtest = np.stack([ttest, functions], -1).reshape(-1, 2)  # 3T x 2
+    mu, var = m.predict_f(Xtest, full_cov=full_cov)
+    mu = np.asarray(mu)
+    var = np.asarray(var)
+    batch = mu.shape[:-2]  # (P,) for the batched model
+    mu = mu.reshape(batch + (3, T, -1))
+    if full_cov:
+        # covariance within each function, the diagonal blocks of the 3T x 3T covariance
+        var = var.reshape(batch + (3, T, 3, T, -1))
+        var = np.stack([var[..., f, :, f, :, :] for f in range(3)], -4)
+    else:
+        var = var.reshape(batch + (3, T, -1))
+    return ttest, mu, var
 
 
 def GetFunctionIndexListGeneral(Xin):
@@ -205,3 +238,55 @@ def SetXExpandedBranchingPoint(XExpanded, B):
         np.logical_and(XExpanded[:, 0] > B, XExpanded[:, 1] != 1).flatten(), :
     ]
     return np.vstack([X1, X23])
+
+
+def GetBranchingInducingPoints(M, B, t):
+    """Place M inducing points for branching point B on the available branches only: the
+    trunk (function 1) up to B and both branches (functions 2 and 3) after it, see
+    SetXExpandedBranchingPoint. Points are shared between the trunk and each branch in
+    proportion to the number of cells they can explain and placed at quantiles of the
+    pseudotime t of those cells."""
+    assert M > 0, "need at least one inducing point"
+    B = np.asarray(B).flatten()[0]
+    fTrunk = t <= B
+    nTrunk = np.sum(fTrunk)
+    nBranch = t.size - nTrunk
+    MBranch = 0  # inducing points per branch
+    if nBranch > 0:
+        MBranch = int(np.clip(np.round(M * nBranch / (2.0 * t.size)), 1, M // 2))
+        if nTrunk > 0:
+            MBranch = min(MBranch, (M - 1) // 2)  # keep one trunk point
+    MTrunk = M - 2 * MBranch
+
+    def quantiles(x, n):
+        return np.quantile(x, (np.arange(n) + 0.5) / n)
+
+    # without trunk cells the trunk point sits at the branching point
+    tTrunk = quantiles(t[fTrunk], MTrunk) if nTrunk > 0 else np.ones(MTrunk) * B
+    tBranch = quantiles(t[~fTrunk], MBranch) if MBranch > 0 else np.zeros(0)
+    ZExpanded = np.zeros((M, 2))
+    ZExpanded[:, 0] = np.concatenate([tTrunk, tBranch, tBranch])
+    ZExpanded[:, 1] = np.repeat([1, 2, 3], [MTrunk, MBranch, MBranch])
+    return ZExpanded
+
+
+def GetJitter(K, float64Jitter=None):
+    """
+    Jitter to add to the diagonal of the square matrix K before its Cholesky factorisation
+    :param K: M x M matrix, or P x M x M batch of matrices
+    :param float64Jitter: jitter in float64, default gpflow.default_jitter()
+    :return: float64Jitter in float64. In lower precision the rounding error of the
+        factorisation grows with the size M and the magnitude of the entries of K, so the
+        jitter is max(gpflow.default_jitter(), M * machine epsilon) times the mean of the
+        diagonal of K; for a batch one jitter per matrix, as a P x 1 x 1 tensor.
+    """
+    if gpflow.default_float() == np.float64:
+        return gpflow.default_jitter() if float64Jitter is None else float64Jitter
+    M = tf.cast(tf.shape(K)[-1], K.dtype)
+    relative = tf.math.maximum(
+        gpflow.default_jitter(), M * np.finfo(K.dtype.as_numpy_dtype).eps
+    )
+    scale = tf.math.reduce_mean(tf.linalg.diag_part(K), -1)
+    if len(K.shape) > 2:
+        scale = scale[..., None, None]
+    return relative * scale
@@ -1,10 +1,15 @@
 # flake8: noqa
 from . import (
     BranchingTree,
+    ExpressionStore,
     FitBranchingModel,
+    ResultStore,
     VBHelperFunctions,
+    assigngp_batch,
     assigngp_dense,
     assigngp_denseSparse,
+    assigngp_svi,
     branch_kernParamGPflow,
+    cli,
     pZ_construction_singleBP,
 )
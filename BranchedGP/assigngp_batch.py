@@ -0,0 +1,305 @@
+# coding: utf-8
+import gpflow
+import numpy as np
+import tensorflow as tf
+from gpflow.utilities import positive
+
+from . import assigngp_dense, pZ_construction_singleBP
+
+
+class AssignGPBatch(
+    assigngp_dense.CompiledTrainingLossMixin,
+    gpflow.models.BayesianModel,
+    gpflow.models.InternalDataTrainingLossMixin,
+):
+    r"""
+    A batch of independent branching GP models (see AssignGP and AssignGPSparse) that
+    share the same pseudotime.
+
+    Each problem p in the batch has its own branching point b_p, gene expression Y_p,
+    kernel hyperparameters, noise variance, variational assignment and assignment
+    prior. The branching kernel, Cholesky factors and collapsed bound are evaluated as
+    batched tensor operations over a leading batch dimension of size P and the
+    objective is the sum of the P independent bounds. batch_log_posterior_density gives
+    the objective of every problem, which FitBranchingModel.OptimiseBatch optimises with a
+    line search and stopping test for each problem.
+
+    If ZExpanded is None the dense bound of AssignGP is used, otherwise the sparse bound
+    of AssignGPSparse with inducing points ZExpanded (M x 2, or P x M x 2 for inducing
+    points specific to each problem).
+
+    The model is limited to a single branching point (3 functions) with a White kernel
+    added for numerics, as built by FitBranchingModel.FitModel. The base kernel must be
+    an isotropic stationary kernel; its variance and lengthscale are held per problem.
+    """
+
+    def __init__(
+        self,
+        t,
+        XExpanded,
+        Y,
+        indices,
+        b,
+        ZExpanded=None,
+        phiPrior=None,
+        phiInitial=None,
+        kernelClass=gpflow.kernels.Matern32,
+        whiteVariance=1e-6,
+        fDebug=False,
+    ):
+        super().__init__()
+        assert len(indices) == t.size, "indices must be size N"
+        assert len(t.shape) == 1, "pseudotime should be 1D"
+        assert Y.ndim == 3, "Y must be P x N x D"
+        assert Y.shape[1] == t.size, "Y must be P x N x D"
+        assert np.all(
+            [len(i) == 3 for i in indices]
+        ), "each cell must map to exactly 3 entries of XExpanded"
+        b = np.asarray(b, dtype=gpflow.default_float()).flatten()
+        assert b.size == Y.shape[0], "need one branching point per problem"
+        self.P = Y.shape[0]
+        self.N = t.shape[0]
+        self.Y = Y.astype(gpflow.default_float())
+        self.X = XExpanded.astype(gpflow.default_float())
+        self.ZExpanded = (
+            None if ZExpanded is None else ZExpanded.astype(gpflow.default_float())
+        )
+        self.t = t.astype(gpflow.default_float())
+        self.indices = indices
+        # entry of XExpanded for every compact Phi entry
+        self.phiSegments = np.ravel(indices)
+        self.fDebug = fDebug
+        # compiled steps of FitBranchingModel.OptimiseBatch
+        self.compiledOptimiser = None
+        # kernel shape with unit variance and lengthscale; hyperparameters are held per problem
+        self.kern = kernelClass()
+        assert isinstance(
+            self.kern, gpflow.kernels.IsotropicStationary
+        ), "base kernel must be isotropic stationary"
+        gpflow.set_trainable(self.kern, False)
+        self.whiteVariance = whiteVariance
+        self.kernelVariance = gpflow.Parameter(np.ones(self.P), transform=positive())
+        self.kernelLengthscales = gpflow.Parameter(
+            np.ones(self.P), transform=positive()
+        )
+        # same lower bound as gpflow.likelihoods.Gaussian
+        self.likelihoodVariance = gpflow.Parameter(
+            np.ones(self.P), transform=positive(lower=1e-6)
+        )
+        self.BvVariable = tf.Variable(
+            b, dtype=gpflow.default_float(), trainable=False, name="Bv"
+        )
+        self.logPhi = gpflow.Parameter(np.random.randn(self.P, self.N, 3))
+        self.logpZ = tf.Variable(
+            np.zeros((self.P, self.N, 3)),
+            dtype=gpflow.default_float(),
+            trainable=False,
+        )
+        if phiInitial is None:
+            phiInitial = np.ones((self.N, 2)) * 0.5  # dont know anything
+            phiInitial[:, 0] = np.random.rand(self.N)
+            phiInitial[:, 1] = 1 - phiInitial[:, 0]
+        if phiPrior is None:
+            phiPrior = np.ones((self.N, 2)) * 0.5
+        self.UpdateBranchingPoint(b, phiInitial, prior=phiPrior)
+
+    @property
+    def b(self):
+        """ Branching point of every problem as a vector of size P. """
+        return self.BvVariable.numpy()
+
+    def UpdateBranchingPoint(self, b, phiInitial, prior=None):
+        """Update branching points (one per problem) and reset initial conditions for
+        variational phi. phiInitial and prior are N x 2 or P x N x 2."""
+        b = np.asarray(b, dtype=gpflow.default_float()).flatten()
+        assert b.size == self.P, "need one branching point per problem"
+        self.BvVariable.assign(b)
+        if prior is not None:
+            prior = np.broadcast_to(prior, (self.P, self.N, 2))
+            self.eZ0 = pZ_construction_singleBP.compact_pZ0Zeros(
+                prior.reshape(-1, 2)
+            ).reshape(self.P, self.N, 3)
+        self.logpZ.assign(
+            np.stack(
+                [
+                    pZ_construction_singleBP.compact_logpZ0PureNumpyZeros(
+                        self.eZ0[p], b[p], self.t
+                    )
+                    for p in range(self.P)
+                ]
+            )
+        )
+        self.InitialiseVariationalPhi(phiInitial)
+
+    def InitialiseVariationalPhi(self, phiInitialIn):
+        """ Set initial state for Phi of every problem, see AssignGP.InitialiseVariationalPhi. """
+        phiInitialIn = np.broadcast_to(phiInitialIn, (self.P, self.N, 2))
+        assert np.allclose(phiInitialIn.sum(-1), 1), "probs must sum to 1"
+        eps = 1e-9
+        fBranch = self.t[None, :] > self.b[:, None]  # P x N, after branching point
+        phiInitialEx = np.zeros((self.P, self.N, 3))
+        phiInitialEx[~fBranch, :] = [1 - 2 * eps, 0 + eps, 0 + eps]  # trunk
+        phiInitialEx[fBranch, 0] = eps
+        phiInitialEx[fBranch, 1:] = phiInitialIn[fBranch, :] - eps
+        assert not np.any(np.isnan(phiInitialEx)), "no nans please"
+        assert not np.any(phiInitialEx < -eps), "no negatives please"
+        self.logPhi.assign(np.log(phiInitialEx))
+
+    def GetPhi(self):
+        """ Get compact P x N x 3 assignment probabilities. """
+        return tf.nn.softmax(self.logPhi).numpy()
+
+    def GetHyperparameters(self):
+        """ Dictionary of hyperparameter vectors, one entry per problem. """
+        return {
+            "likvar": self.likelihoodVariance.numpy(),
+            "kerlen": self.kernelLengthscales.numpy(),
+            "kervar": self.kernelVariance.numpy(),
+        }
+
+    def BaseK(self, t1, t2):
+        """Base kernel with the hyperparameters of each problem. t1 and t2 are N and M
+        vectors, or P x N and P x M matrices. Returns P x N x M."""
+        r = tf.abs(tf.expand_dims(t1, -1) - tf.expand_dims(t2, -2))
+        r = r / self.kernelLengthscales[:, None, None]
+        return self.kernelVariance[:, None, None] * self.kern.K_r(r)
+
+    def K(self, X, X2=None):
+        """Batched single branching point kernel. X and X2 are N x 2 or P x N x 2, with
+        pseudotime in the first and function label (1, 2 or 3) in the second column."""
+        Y = X if X2 is None else X2
+        t1, t2 = X[..., 0], Y[..., 0]
+        B = self.BvVariable[:, None]  # P x 1
+        Ktts = self.BaseK(t1, t2)  # P x N x M
+        Kb1s = self.BaseK(t1, B)[..., 0]  # P x N
+        Kb2s = self.BaseK(t2, B)[..., 0]  # P x M
+        kbb = self.BaseK(B, B)[..., 0] + gpflow.default_jitter()  # P x 1
+        K_cross = Kb1s[:, :, None] * Kb2s[:, None, :] / kbb[:, :, None]
+        same_functions = tf.equal(
+            tf.expand_dims(X[..., 1], -1), tf.expand_dims(Y[..., 1], -2)
+        )
+        K_s = tf.where(same_functions, Ktts, K_cross)
+        if X2 is None:
+            K_s += self.whiteVariance * tf.eye(
+                tf.shape(K_s)[-1], dtype=gpflow.default_float()
+            )
+        return K_s
+
+    def K_diag(self, X):
+        """ Batched kernel diagonal, P x N. """
+        return (
+            self.kernelVariance[:, None] * tf.ones_like(X[..., 0]) + self.whiteVariance
+        )
+
+    def GetPhiStatistics(self, Phi):
+        """Column sums (P x 3N) and Phi^T Y (P x 3N x D) of the expanded assignment
+        matrices, from the compact P x N x 3 Phi with segment sums."""
+        numSegments = self.X.shape[0]
+        D = self.Y.shape[2]
+        PhiT = tf.transpose(tf.reshape(Phi, [self.P, -1]))  # 3N x P
+        A = tf.math.unsorted_segment_sum(PhiT, self.phiSegments, numSegments)
+        PhiY = tf.reshape(Phi[:, :, :, None] * self.Y[:, :, None, :], [self.P, -1, D])
+        PhiY = tf.math.unsorted_segment_sum(
+            tf.transpose(PhiY, [1, 0, 2]), self.phiSegments, numSegments
+        )
+        return tf.transpose(A), tf.transpose(PhiY, [1, 0, 2])
+
+    def BuildFactors(self):
+        """Factors of the collapsed bound shared by the objective and prediction. Returns
+        the inducing inputs, L, R, c, the column sums A and the scaled matrix W."""
+        Phi = tf.nn.softmax(self.logPhi)
+        # try squashing Phi to avoid numerical errors
+        Phi = (1 - 2e-6) * Phi + 1e-6
+        A, PhiY = self.GetPhiStatistics(Phi)
+        sigma2 = self.likelihoodVariance[:, None, None]
+        if self.ZExpanded is None:
+            Xu = self.X
+            (L, R, c, W) = assigngp_dense.GetBoundFactors(
+                self.K(self.X), A, PhiY, sigma2
+            )
+        else:
+            Xu = self.ZExpanded
+            (L, R, c, W) = assigngp_dense.GetBoundFactors(
+                self.K(self.ZExpanded),
+                A,
+                PhiY,
+                sigma2,
+                Kuf=self.K(self.ZExpanded, self.X),
+            )
+        return Xu, L, R, c, A, W, Phi
+
+    def batch_log_likelihood_objective(self):
+        """ Collapsed bound of every problem, a vector of size P. """
+        if self.fDebug:
+            print("assigngp_batch compiling model (build_likelihood)")
+        self.CountTrace()
+        N = tf.cast(self.N, dtype=gpflow.default_float())
+        D = tf.cast(self.Y.shape[2], dtype=gpflow.default_float())
+        _, _, R, c, A, W, Phi = self.BuildFactors()
+        sigma2 = self.likelihoodVariance
+        if self.ZExpanded is None:
+            traceTerm = tf.zeros_like(sigma2)
+        else:
+            Kdiag = self.K_diag(self.X)
+            traceTerm = -0.5 * tf.math.reduce_sum(
+                Kdiag * A, -1
+            ) / sigma2 + 0.5 * tf.math.reduce_sum(tf.math.square(W), [-2, -1])
+        KL = tf.math.reduce_sum(Phi * tf.math.log(Phi), [-2, -1]) - tf.math.reduce_sum(
+            Phi * self.logpZ, [-2, -1]
+        )
+        return (
+            traceTerm
+            - 0.5 * N * D * tf.math.log(2 * np.pi * sigma2)
+            - 0.5
+            * D
+            * tf.math.reduce_sum(
+                tf.math.log(tf.math.square(tf.linalg.diag_part(R))), -1
+            )
+            - 0.5 * tf.math.reduce_sum(tf.math.square(self.Y), [-2, -1]) / sigma2
+            + 0.5 * tf.math.reduce_sum(tf.math.square(c), [-2, -1])
+            - KL
+        )
+
+    def maximum_log_likelihood_objective(self):
+        return tf.math.reduce_sum(self.batch_log_likelihood_objective())
+
+    def batch_log_prior_density(self):
+        """ Log prior density of the hyperparameters of every problem, a vector of size P. """
+        log_prior = tf.zeros(self.P, dtype=gpflow.default_float())
+        for p in [
+            self.kernelVariance,
+            self.kernelLengthscales,
+            self.likelihoodVariance,
+        ]:
+            if p.prior is not None:
+                log_prior += p.prior.log_prob(p)
+        return log_prior
+
+    def batch_log_posterior_density(self):
+        """ Per problem equivalent of log_posterior_density, a vector of size P. """
+        return self.batch_log_likelihood_objective() + self.batch_log_prior_density()
+
+    def predict_f(self, Xnew, full_cov=False):
+        """ Predict every problem at Xnew (T x 2). Returns P x T x D mean and variance. """
+        Xnew = tf.cast(Xnew, gpflow.default_float())  # may be float64 in float32 mode
+        Xu, L, R, c, _, _, _ = self.BuildFactors()
+        Kus = self.K(Xu, Xnew)
+        tmp1 = tf.linalg.triangular_solve(L, Kus, lower=True)
+        tmp2 = tf.linalg.triangular_solve(R, tmp1, lower=True)
+        mean = tf.linalg.matmul(tmp2, c, transpose_a=True)
+        D = self.Y.shape[2]
+        if full_cov:
+            var = (
+                self.K(Xnew)
+                + tf.linalg.matmul(tmp2, tmp2, transpose_a=True)
+                - tf.linalg.matmul(tmp1, tmp1, transpose_a=True)
+            )
+            var = tf.tile(var[..., None], [1, 1, 1, D])
+        else:
+            var = (
+                self.K_diag(Xnew)
+                + tf.math.reduce_sum(tf.math.square(tmp2), -2)
+                - tf.math.reduce_sum(tf.math.square(tmp1), -2)
+            )
+            var = tf.tile(var[..., None], [1, 1, D])
+        return mean, var
@@ -4,11 +4,37 @@ import numpy as np
 import tensorflow as tf
 from gpflow.mean_functions import Zero
 
-from . import pZ_construction_singleBP
+from . import VBHelperFunctions, pZ_construction_singleBP
+
+
+class CompiledTrainingLossMixin:
+    """Compiled training loss cached on the model and a count of the traces of the
+    objective, shared by AssignGP, AssignGPBatch and AssignGPSVI"""
+
+    # number of times the objective has been traced into a graph
+    traceCount = 0
+    compiledTrainingLoss = None
+
+    def training_loss_closure(self, compile=True):
+        """Training loss closure. When compiled the tf.function is cached on the model, so
+        it is traced once and reused when variables of the model, such as the branching
+        point, prior or Phi, are reassigned."""
+        if not compile:
+            return self.training_loss
+        if self.compiledTrainingLoss is None:
+            self.compiledTrainingLoss = tf.function(self.training_loss)
+        return self.compiledTrainingLoss
+
+    def CountTrace(self):
+        """ Record a trace of the objective. Python side effects only run while tracing. """
+        if not tf.executing_eagerly():
+            self.traceCount += 1
 
 
 class AssignGP(
-    gpflow.models.model.GPModel, gpflow.models.InternalDataTrainingLossMixin
+    CompiledTrainingLossMixin,
+    gpflow.models.model.GPModel,
+    gpflow.models.InternalDataTrainingLossMixin,
 ):
     r"""
     Gaussian Process regression, but where the index to which the data are
@@ -30,6 +56,12 @@ class AssignGP(
 
     """
 
+    # the cached posterior holds a copy of the kernel whose variables are not the model's
+    _TF_MODULE_IGNORED_PROPERTIES = (
+        gpflow.models.model.GPModel._TF_MODULE_IGNORED_PROPERTIES
+        | {"posterior", "posteriorKey", "posteriorKernel"}
+    )
+
     def __init__(
         self,
         t,
@@ -51,14 +83,30 @@ class AssignGP(
         )
         assert len(indices) == t.size, "indices must be size N"
         assert len(t.shape) == 1, "pseudotime should be 1D"
-        self.Y = Y
-        self.X = XExpanded
+        assert np.all(
+            [len(i) == 3 for i in indices]
+        ), "each cell must map to exactly 3 entries of XExpanded"
+        self.Y = Y.astype(gpflow.default_float())
+        self.X = XExpanded.astype(gpflow.default_float())
         self.N = t.shape[0]
         self.t = t.astype(gpflow.default_float())  # could be DataHolder? advantages
         self.indices = indices
-        self.logPhi = gpflow.Parameter(
-            np.random.randn(t.shape[0], t.shape[0] * 3)
-        )  # 1 branch point => 3 functions
+        # (row, column) of each compact Phi entry in the N x 3N expanded layout
+        self.phiScatterIndices = np.stack(
+            [np.repeat(np.arange(self.N), 3), np.ravel(indices)], 1
+        )
+        # 1 branch point => 3 functions. Only the 3 entries of XExpanded a cell can be
+        # assigned to are parameterised, so Phi is stored as a compact N x 3 matrix.
+        self.logPhi = gpflow.Parameter(np.random.randn(t.shape[0], 3))
+        # compact N x 3 log prior on assignments, updated in place for each branching point
+        self.logpZ = tf.Variable(
+            np.zeros((self.N, 3)), dtype=gpflow.default_float(), trainable=False
+        )
+        # posterior cached by GetPosterior, the key of the variables it was built from
+        # and the kernel copy it predicts with, see GetPosteriorKey
+        self.posterior = None
+        self.posteriorKey = None
+        self.posteriorKernel = None
         if phiInitial is None:
             phiInitial = np.ones((self.N, 2)) * 0.5  # dont know anything
             phiInitial[:, 0] = np.random.rand(self.N)
@@ -68,7 +116,6 @@ class AssignGP(
         if phiPrior is None:
             phiPrior = np.ones((self.N, 2)) * 0.5
         # Fix prior term - this is without trunk
-        self.pZ = np.ones((t.shape[0], t.shape[0] * 3))
         self.UpdateBranchingPoint(b, phiInitial, prior=phiPrior)
         self.KConst = KConst
         if not fDebug:
@@ -85,8 +132,13 @@ class AssignGP(
             self.logPhi.trainable is True
         ), "Phi should not be constant when changing branching location"
         if prior is not None:
-            self.eZ0 = pZ_construction_singleBP.expand_pZ0Zeros(prior)
-        self.pZ = pZ_construction_singleBP.expand_pZ0PureNumpyZeros(self.eZ0, b, self.t)
+            self.eZ0 = pZ_construction_singleBP.compact_pZ0Zeros(prior)
+        # compact N x 3 log prior, computed once per branching point
+        self.logpZ.assign(
+            pZ_construction_singleBP.compact_logpZ0PureNumpyZeros(
+                self.eZ0, b, self.t
+            ).astype(gpflow.default_float())
+        )
         self.InitialiseVariationalPhi(phiInitial)
 
     def InitialiseVariationalPhi(self, phiInitialIn):
@@ -101,38 +153,24 @@ class AssignGP(
         N = self.Y.shape[0]
         assert phiInitialIn.shape[0] == N
         assert phiInitialIn.shape[1] == 2  # run OMGP with K=2 trajectories
-        phiInitialEx = np.zeros((N, 3 * N))
-        # large neg number makes exact zeros, make smaller for added jitter
-        phiInitial_invSoftmax = -9.0 * np.ones((N, 3 * N))
         eps = 1e-9
-        iterC = 0
-        for i, p in enumerate(self.t):
-            if p > self.b:  # before branching - it's the root
-                phiInitialEx[i, iterC : iterC + 3] = np.hstack(
-                    [eps, phiInitialIn[i, :] - eps]
-                )
-            else:
-                phiInitialEx[i, iterC : iterC + 3] = np.array(
-                    [1 - 2 * eps, 0 + eps, 0 + eps]
-                )
-            phiInitial_invSoftmax[i, iterC : iterC + 3] = np.log(
-                phiInitialEx[i, iterC : iterC + 3]
-            )
-            iterC += 3
+        fBranch = self.t > self.b.flatten()[0]  # after branching point - on a branch
+        phiInitialEx = np.zeros((N, 3))
+        phiInitialEx[~fBranch, :] = [1 - 2 * eps, 0 + eps, 0 + eps]  # trunk
+        phiInitialEx[fBranch, 0] = eps
+        phiInitialEx[fBranch, 1:] = phiInitialIn[fBranch, :] - eps
         assert not np.any(np.isnan(phiInitialEx)), "no nans please " + str(
             np.nonzero(np.isnan(phiInitialEx))
         )
         assert not np.any(phiInitialEx < -eps), "no negatives please " + str(
             np.nonzero(np.isnan(phiInitialEx))
         )
-        self.logPhi.assign(phiInitial_invSoftmax)
+        self.logPhi.assign(np.log(phiInitialEx))
 
     def GetPhi(self):
         """ Get Phi matrix, collapsed for each possible entry """
         assert self.b == self.kernel.kernels[0].Bv, "Need to call UpdateBranchingPoint"
-        phiExpanded = self.GetPhiExpanded().numpy()
-        l = [phiExpanded[i, self.indices[i]] for i in range(len(self.indices))]
-        phi = np.asarray(l)
+        phi = tf.nn.softmax(self.logPhi).numpy()
         tolError = 1e-6
         assert np.all(phi.sum(1) <= 1 + tolError)
         assert np.all(phi >= 0 - tolError)
@@ -140,8 +178,53 @@ class AssignGP(
         return phi
 
     def GetPhiExpanded(self):
-        """ Shortcut function to get Phi matrix out."""
-        return tf.nn.softmax(self.logPhi)
+        """Shortcut function to get Phi matrix out in the N x 3N layout of XExpanded.
+        Only meant for inspection as the matrix is quadratic in N."""
+        return self.ExpandPhi(tf.nn.softmax(self.logPhi))
+
+    def ExpandPhi(self, Phi):
+        """ Scatter compact N x 3 assignment probabilities into the N x 3N layout. """
+        return tf.scatter_nd(
+            self.phiScatterIndices,
+            tf.reshape(Phi, [-1]),
+            [self.N, self.X.shape[0]],
+        )
+
+    def GetPhiStatistics(self, Phi):
+        """Column sums and Phi^T Y of the N x 3N assignment matrix, computed from the
+        compact N x 3 Phi with segment sums over the entries of XExpanded."""
+        segments = self.phiScatterIndices[:, 1]
+        numSegments = self.X.shape[0]
+        A = tf.math.unsorted_segment_sum(tf.reshape(Phi, [-1]), segments, numSegments)
+        PhiY = tf.math.unsorted_segment_sum(
+            tf.reshape(Phi[:, :, None] * self.Y[:, None, :], [-1, self.Y.shape[1]]),
+            segments,
+            numSegments,
+        )
+        return A, PhiY
+
+    def UpdatePhi(self):
+        """Closed-form mean-field (CAVI) update of the assignment for the current
+        hyperparameters. Each cell is assigned to its 3 functions in proportion to
+        prior x exp(expected log likelihood) under the posterior of f given the current
+        Phi, so the bound cannot decrease."""
+        # Phi is about to change, so the posterior is not cached
+        posterior = AssignGPPosterior(self.kernel, *self.GetPosteriorFactors())
+        mu, var = posterior.predict_f(self.X)  # 3N x D
+        indices = np.asarray(self.indices)
+        mu = tf.gather(mu, indices)  # N x 3 x D
+        var = tf.gather(var, indices)
+        sigma2 = self.likelihood.variance
+        expectedLogLik = tf.math.reduce_sum(
+            -0.5 * tf.math.log(2.0 * np.pi * sigma2)
+            - 0.5 * (tf.math.square(self.Y[:, None, :] - mu) + var) / sigma2,
+            -1,
+        )
+        logPhi = self.logpZ + expectedLogLik
+        logPhi -= tf.math.reduce_max(logPhi, 1, keepdims=True)
+        # cells with zero prior mass on an entry keep a finite logit
+        logPhi = tf.maximum(logPhi, np.log(np.finfo(gpflow.default_float()).tiny))
+        self.logPhi.assign(logPhi)
 
     def objectiveFun(self):
         """Objective function to minimize - log likelihood -log prior.
@@ -150,35 +233,15 @@ class AssignGP(
 
     def maximum_log_likelihood_objective(self):
         print("assignegp_dense compiling model (build_likelihood)")
+        self.CountTrace()
         N = tf.cast(tf.shape(self.Y)[0], dtype=gpflow.default_float())
-        M = tf.shape(self.X)[0]
         D = tf.cast(tf.shape(self.Y)[1], dtype=gpflow.default_float())
-        if self.KConst is not None:
-            K = tf.cast(self.KConst, gpflow.default_float())
-        else:
-            K = self.kernel.K(self.X)
-        Phi = tf.nn.softmax(self.logPhi)
-        # try squashing Phi to avoid numerical errors
-        Phi = (1 - 2e-6) * Phi + 1e-6
+        Phi = self.GetSquashedPhi()
+        (_, _, R, c, _) = self.GetFactors(Phi)
         sigma2 = self.likelihood.variance
         tau = 1.0 / self.likelihood.variance
-        L = (
-            tf.linalg.cholesky(K)
-            + tf.eye(M, dtype=gpflow.default_float()) * gpflow.default_jitter()
-        )
-        W = tf.transpose(L) * tf.sqrt(tf.reduce_sum(Phi, 0)) / tf.sqrt(sigma2)
-        P = tf.linalg.matmul(W, tf.transpose(W)) + tf.eye(
-            M, dtype=gpflow.default_float()
-        )
-        R = tf.linalg.cholesky(P)
-        PhiY = tf.linalg.matmul(tf.transpose(Phi), self.Y)
-        LPhiY = tf.linalg.matmul(tf.transpose(L), PhiY)
         if self.fDebug:
-            tf.print(Phi, [tf.shape(P), P], name="P", summarize=10)
-            tf.print(Phi, [tf.shape(LPhiY), LPhiY], name="LPhiY", summarize=10)
-            tf.print(Phi, [tf.shape(K), K], name="K", summarize=10)
             tf.print(Phi, [tau], name="tau", summarize=10)
-        c = tf.linalg.triangular_solve(R, LPhiY, lower=True) / sigma2
         # compute KL
         KL = self.build_KL(Phi)
         a1 = -0.5 * N * D * tf.math.log(2.0 * np.pi / tau)
@@ -198,36 +261,157 @@ class AssignGP(
             tf.print(a5, [a5, Phi], name="a5 and Phi=", summarize=10)
         return a1 + a2 + a3 + a4 + a5
 
+    def GetSquashedPhi(self):
+        """ Compact N x 3 assignment probabilities, squashed to avoid numerical errors """
+        return (1 - 2e-6) * tf.nn.softmax(self.logPhi) + 1e-6
+
+    def GetFactors(self, Phi):
+        """Factors of the bound for assignment probabilities Phi, shared by the bound and
+        the posterior so that both are computed the same way: the inputs Z of the latent
+        function values the posterior is expressed in, L, R and c of AssignGPPosterior and
+        W, with P = W W^T + I factorised by R"""
+        if self.KConst is not None:
+            K = tf.cast(self.KConst, gpflow.default_float())
+        else:
+            K = self.kernel.K(self.X)
+        A, PhiY = self.GetPhiStatistics(Phi)
+        (L, R, c, W) = GetBoundFactors(K, A, PhiY, self.likelihood.variance)
+        if self.fDebug:
+            tf.print(Phi, [tf.shape(K), K], name="K", summarize=10)
+            tf.print(Phi, [tf.shape(c), c], name="c", summarize=10)
+        return self.X, L, R, c, W
+
+    def GetPosteriorFactors(self):
+        """Inputs Z of the latent function values the posterior is expressed in and its
+        factors L, R and c for the current parameters, see AssignGPPosterior"""
+        (Z, L, R, c, _) = self.GetFactors(self.GetSquashedPhi())
+        return Z, L, R, c
+
+    def GetPosteriorKey(self):
+        """Key of the variables the posterior depends on: copies of the values of the
+        kernel variables and of the other variables (noise variance, logPhi, logpZ,
+        inducing points). The variables are also assigned outside the model, e.g. by the
+        optimiser, so their values are compared rather than tracking their updates."""
+        kernelVariables = self.kernel.variables
+        other = [v for v in self.variables if not any(v is k for k in kernelVariables)]
+        return (
+            [v.numpy() for v in kernelVariables],
+            [v.numpy() for v in other],
+        )
+
+    def GetPosterior(self):
+        """Posterior of the latent functions for the current parameters. It is built once
+        and reused until a variable of the model changes (optimisation, UpdatePhi,
+        UpdateBranchingPoint, ...), see GetPosteriorKey, so repeated predictions only
+        cost the covariance with the test points.
+
+        The posterior is frozen: it holds a copy of the kernel and tensors computed when
+        it was built, so no gradient flows from its predictions to the model variables.
+        The kernel is only copied again once its hyperparameters change."""
+        key = self.GetPosteriorKey()
+        if self.posterior is not None and _KeysEqual(key, self.posteriorKey):
+            return self.posterior
+        if self.posteriorKey is None or not _KeysEqual(key[0], self.posteriorKey[0]):
+            self.posteriorKernel = gpflow.utilities.deepcopy(self.kernel)
+        self.posterior = AssignGPPosterior(
+            self.posteriorKernel, *self.GetPosteriorFactors()
+        )
+        self.posteriorKey = key
+        return self.posterior
+
     def predict_f(self, Xnew, full_cov=False):
-        M = tf.shape(self.X)[0]
-        K = self.kernel.K(self.X)
-        Phi = tf.nn.softmax(self.logPhi)
-        # try squashing Phi to avoid numerical errors
-        Phi = (1 - 2e-6) * Phi + 1e-6
-        sigma2 = self.likelihood.variance
+        """Predict with the cached posterior of GetPosterior when executing eagerly. Its
+        predictions carry no gradient with respect to the model variables, so to
+        differentiate predictions under a tf.GradientTape call predict_f in a tf.function
+        or use AssignGPPosterior(m.kernel, *m.GetPosteriorFactors()) directly."""
+        if not tf.executing_eagerly():
+            # traced into a graph: the variables cannot be compared to the cache
+            posterior = AssignGPPosterior(self.kernel, *self.GetPosteriorFactors())
+            return posterior.predict_f(Xnew, full_cov=full_cov)
+        return self.GetPosterior().predict_f(Xnew, full_cov=full_cov)
+
+    def build_KL(self, Phi):
+        """ KL between compact N x 3 assignment probabilities Phi and the prior pZ. """
+        return tf.math.reduce_sum(Phi * tf.math.log(Phi)) - tf.math.reduce_sum(
+            Phi * self.logpZ
+        )
+
+
+def GetBoundFactors(Kuu, A, PhiY, sigma2, Kuf=None):
+    """
+    Factors of the collapsed bound of AssignGP and AssignGPSparse and of every problem of
+    AssignGPBatch, broadcasting over leading problem axes, see AssignGPPosterior
+    :param Kuu: ... x M x M covariance of the latent function values u the bound is
+        expressed in
+    :param A: ... x 3N column sums of the expanded assignment Phi
+    :param PhiY: ... x 3N x D product Phi^T Y
+    :param sigma2: noise variance, a scalar or ... x 1 x 1
+    :param Kuf: ... x M x 3N covariance of u and the function values at XExpanded, None
+        for the dense bound where u are those function values
+    :return: L, R, c and W, with P = W W^T + I factorised by R
+    """
+    I = tf.eye(tf.shape(Kuu)[-1], dtype=Kuu.dtype)
+    if Kuf is None:
+        # the White kernel keeps K positive definite in float64, float32 needs jitter
         L = (
-            tf.linalg.cholesky(K)
-            + tf.eye(M, dtype=gpflow.default_float()) * gpflow.default_jitter()
-        )
-        W = tf.transpose(L) * tf.sqrt(tf.math.reduce_sum(Phi, 0)) / tf.sqrt(sigma2)
-        P = tf.linalg.matmul(W, tf.transpose(W)) + tf.eye(
-            M, dtype=gpflow.default_float()
-        )
-        R = tf.linalg.cholesky(P)
-        PhiY = tf.linalg.matmul(tf.transpose(Phi), self.Y)
-        LPhiY = tf.linalg.matmul(tf.transpose(L), PhiY)
-        c = tf.linalg.triangular_solve(R, LPhiY, lower=True) / sigma2
-        Kus = self.kernel.K(self.X, Xnew)
-        tmp1 = tf.linalg.triangular_solve(L, Kus, lower=True)
-        tmp2 = tf.linalg.triangular_solve(R, tmp1, lower=True)
-        mean = tf.linalg.matmul(tf.transpose(tmp2), c)
+            tf.linalg.cholesky(Kuu + I * VBHelperFunctions.GetJitter(Kuu, 0.0))
+            + I * gpflow.default_jitter()
+        )
+        LiKuf = tf.linalg.matrix_transpose(L)
+    else:
+        L = tf.linalg.cholesky(Kuu + I * VBHelperFunctions.GetJitter(Kuu))
+        LiKuf = tf.linalg.triangular_solve(L, Kuf)
+    W = LiKuf * tf.expand_dims(tf.sqrt(A), -2) / tf.sqrt(sigma2)
+    P = tf.linalg.matmul(W, W, transpose_b=True) + I
+    R = tf.linalg.cholesky(P + I * VBHelperFunctions.GetJitter(P, 0.0))
+    c = tf.linalg.triangular_solve(R, tf.linalg.matmul(LiKuf, PhiY)) / sigma2
+    return L, R, c, W
+
+
+def _KeysEqual(key1, key2):
+    """ Whether two nested lists of arrays, such as keys of GetPosteriorKey, are equal """
+    if isinstance(key1, (list, tuple)):
+        return len(key1) == len(key2) and all(
+            _KeysEqual(k1, k2) for k1, k2 in zip(key1, key2)
+        )
+    return np.array_equal(key1, key2)
+
+
+class AssignGPPosterior:
+    r"""
+    Posterior of the latent functions of AssignGP or AssignGPSparse, frozen at the
+    parameters it was built from. With Z the inputs of the latent function values u the
+    posterior is expressed in (XExpanded for AssignGP, the inducing points for
+    AssignGPSparse), A the column sums of the expanded assignment Phi and
+
+        L = chol(K(Z, Z)),  R = chol(I + L^-1 K(Z, X) A K(X, Z) L^-T / sigma^2),
+        c = R^-1 L^-1 K(Z, X) Phi^T Y / sigma^2
+
+    the predictive mean at X* is (R^-1 L^-1 K(Z, X*))^T c. L, R and c are computed once,
+    so each prediction only needs K(Z, X*) and two triangular solves.
+    """
+
+    def __init__(self, kernel, Z, L, R, c):
+        self.kernel = kernel
+        self.Z = Z
+        self.L = L
+        self.R = R
+        self.c = c
+
+    def predict_f(self, Xnew, full_cov=False):
+        Xnew = tf.cast(Xnew, self.c.dtype)  # test points may be float64 in float32 mode
+        D = tf.shape(self.c)[1]
+        Kus = self.kernel.K(self.Z, Xnew)
+        tmp1 = tf.linalg.triangular_solve(self.L, Kus, lower=True)
+        tmp2 = tf.linalg.triangular_solve(self.R, tmp1, lower=True)
+        mean = tf.linalg.matmul(tf.transpose(tmp2), self.c)
         if full_cov:
             var = (
                 self.kernel.K(Xnew)
                 + tf.linalg.matmul(tf.transpose(tmp2), tmp2)
                 - tf.linalg.matmul(tf.transpose(tmp1), tmp1)
             )
-            shape = tf.stack([1, 1, tf.shape(self.Y)[1]])
+            shape = tf.stack([1, 1, D])
             var = tf.tile(tf.expand_dims(var, 2), shape)
         else:
             var = (
@@ -235,11 +419,6 @@ class AssignGP(
                 + tf.math.reduce_sum(tf.math.square(tmp2), 0)
                 - tf.math.reduce_sum(tf.math.square(tmp1), 0)
             )
-            shape = tf.stack([1, tf.shape(self.Y)[1]])
+            shape = tf.stack([1, D])
             var = tf.tile(tf.expand_dims(var, 1), shape)
         return mean, var
-
-    def build_KL(self, Phi):
-        return tf.math.reduce_sum(Phi * tf.math.log(Phi)) - tf.math.reduce_sum(
-            Phi * tf.math.log(self.pZ)
-        )
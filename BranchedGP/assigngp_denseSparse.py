@@ -3,7 +3,7 @@ import gpflow
 import numpy as np
 import tensorflow as tf
 
-from . import assigngp_dense
+from . import VBHelperFunctions, assigngp_dense
 
 
 class AssignGPSparse(assigngp_dense.AssignGP):
@@ -25,6 +25,10 @@ class AssignGPSparse(assigngp_dense.AssignGP):
     over the Z matrix (i.e. we have narrowed down the choice of which function
     values each y is drawn from).
 
+    With fPlaceInducingPoints the M inducing points are moved to the branches available
+    at every branching point set by UpdateBranchingPoint, see
+    VBHelperFunctions.GetBranchingInducingPoints; ZExpanded then only sets M.
+
     """
 
     def __init__(
@@ -39,7 +43,16 @@ class AssignGPSparse(assigngp_dense.AssignGP):
         fDebug=False,
         phiInitial=None,
         phiPrior=None,
+        fPlaceInducingPoints=False,
     ):
+        assert ZExpanded.shape[1] == XExpanded.shape[1]
+        # Inducing points are not trained but live in a variable so that they can be moved
+        # for every branching point without retracing. Set before the base class calls
+        # UpdateBranchingPoint.
+        self.fPlaceInducingPoints = fPlaceInducingPoints
+        self.ZExpanded = tf.Variable(
+            ZExpanded, dtype=gpflow.default_float(), trainable=False
+        )
         assigngp_dense.AssignGP.__init__(
             self,
             t,
@@ -52,43 +65,33 @@ class AssignGPSparse(assigngp_dense.AssignGP):
             phiInitial=phiInitial,
             phiPrior=phiPrior,
         )
-        # Do not treat inducing points as parameters because they should always be fixed.
-        self.ZExpanded = ZExpanded  # inducing points for sparse GP. Same as XExpanded
-        assert ZExpanded.shape[1] == XExpanded.shape[1]
+
+    def UpdateBranchingPoint(self, b, phiInitial, prior=None):
+        """ Update branching point as AssignGP.UpdateBranchingPoint, placing inducing points for it """
+        if self.fPlaceInducingPoints:
+            self.ZExpanded.assign(
+                VBHelperFunctions.GetBranchingInducingPoints(
+                    self.ZExpanded.shape[0], b, self.t
+                )
+            )
+        assigngp_dense.AssignGP.UpdateBranchingPoint(self, b, phiInitial, prior=prior)
 
     def maximum_log_likelihood_objective(self):
         if self.fDebug:
             print("assignegp_denseSparse compiling model (build_likelihood)")
+        self.CountTrace()
         N = tf.cast(tf.shape(self.Y)[0], dtype=gpflow.default_float())
-        M = tf.shape(self.ZExpanded)[0]
         D = tf.cast(tf.shape(self.Y)[1], dtype=gpflow.default_float())
 
-        Phi = tf.nn.softmax(self.logPhi)
-        # try squashing Phi to avoid numerical errors
-        Phi = (1 - 2e-6) * Phi + 1e-6
+        Phi = self.GetSquashedPhi()
+        A, _ = self.GetPhiStatistics(Phi)
+        (_, _, R, c, W) = self.GetFactors(Phi)
 
         sigma2 = self.likelihood.variance
-        sigma = tf.sqrt(self.likelihood.variance)
-        Kuu = (
-            self.kernel.K(self.ZExpanded)
-            + tf.eye(M, dtype=gpflow.default_float()) * gpflow.default_jitter()
-        )
-        Kuf = self.kernel.K(self.ZExpanded, self.X)
-
         Kdiag = self.kernel.K_diag(self.X)
-        L = tf.linalg.cholesky(Kuu)
-        A = tf.math.reduce_sum(Phi, 0)
-        LiKuf = tf.linalg.triangular_solve(L, Kuf)
-        W = LiKuf * tf.sqrt(A) / sigma
-        P = tf.linalg.matmul(W, tf.transpose(W)) + tf.eye(
-            M, dtype=gpflow.default_float()
-        )
         traceTerm = -0.5 * tf.math.reduce_sum(
             Kdiag * A
         ) / sigma2 + 0.5 * tf.math.reduce_sum(tf.math.square(W))
-        R = tf.linalg.cholesky(P)
-        tmp = tf.linalg.matmul(LiKuf, tf.linalg.matmul(tf.transpose(Phi), self.Y))
-        c = tf.linalg.triangular_solve(R, tmp, lower=True) / sigma2
         if self.fDebug:
             # trace term should be 0 for Z=X (full data)
             tf.print([traceTerm], name="traceTerm", summarize=10)
@@ -106,50 +109,16 @@ class AssignGPSparse(assigngp_dense.AssignGP):
 
         return self.bound
 
-    def predict_f(self, Xnew, full_cov=False):
-        M = tf.shape(self.ZExpanded)[0]
-
-        Phi = tf.nn.softmax(self.logPhi)
-        # try squashing Phi to avoid numerical errors
-        Phi = (1 - 2e-6) * Phi + 1e-6
-
-        sigma2 = self.likelihood.variance
-        sigma = tf.sqrt(sigma2)
-        Kuu = (
-            self.kernel.K(self.ZExpanded)
-            + tf.eye(M, dtype=gpflow.default_float()) * gpflow.default_jitter()
+    def GetFactors(self, Phi):
+        """Factors of the bound and posterior as AssignGP.GetFactors, with the inducing
+        points as Z"""
+        A, PhiY = self.GetPhiStatistics(Phi)
+        (L, R, c, W) = assigngp_dense.GetBoundFactors(
+            self.kernel.K(self.ZExpanded),
+            A,
+            PhiY,
+            self.likelihood.variance,
+            Kuf=self.kernel.K(self.ZExpanded, self.X),
         )
-        Kuf = self.kernel.K(self.ZExpanded, self.X)
-        L = tf.linalg.cholesky(Kuu)
-
-        p = tf.math.reduce_sum(Phi, 0)
-        LiKuf = tf.linalg.triangular_solve(L, Kuf)
-        W = LiKuf * tf.sqrt(p) / sigma
-        P = tf.linalg.matmul(W, tf.transpose(W)) + tf.eye(
-            M, dtype=gpflow.default_float()
-        )
-        R = tf.linalg.cholesky(P)
-        tmp = tf.linalg.matmul(LiKuf, tf.linalg.matmul(tf.transpose(Phi), self.Y))
-        c = tf.linalg.triangular_solve(R, tmp, lower=True) / sigma2
-
-        Kus = self.kernel.K(self.ZExpanded, Xnew)
-        tmp1 = tf.linalg.triangular_solve(L, Kus, lower=True)
-        tmp2 = tf.linalg.triangular_solve(R, tmp1, lower=True)
-        mean = tf.linalg.matmul(tf.transpose(tmp2), c)
-        if full_cov:
-            var = (
-                self.kernel.K(Xnew)
-                + tf.linalg.matmul(tf.transpose(tmp2), tmp2)
-                - tf.linalg.matmul(tf.transpose(tmp1), tmp1)
-            )
-            shape = tf.stack([1, 1, tf.shape(self.Y)[1]])
-            var = tf.tile(tf.expand_dims(var, 2), shape)
-        else:
-            var = (
-                self.kernel.K_diag(Xnew)
-                + tf.math.reduce_sum(tf.math.square(tmp2), 0)
-                - tf.math.reduce_sum(tf.math.square(tmp1), 0)
-            )
-            shape = tf.stack([1, tf.shape(self.Y)[1]])
-            var = tf.tile(tf.expand_dims(var, 1), shape)
-        return mean, var
+        # the inducing points are a variable, moved by UpdateBranchingPoint
+        return tf.identity(self.ZExpanded), L, R, c, W
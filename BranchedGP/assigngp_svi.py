@@ -0,0 +1,206 @@
+# coding: utf-8
+import gpflow
+import numpy as np
+import tensorflow as tf
+from gpflow.mean_functions import Zero
+from gpflow.utilities import set_trainable, triangular
+
+from . import VBHelperFunctions, assigngp_dense
+
+
+class AssignGPSVI(
+    assigngp_dense.CompiledTrainingLossMixin,
+    gpflow.models.model.GPModel,
+    gpflow.models.InternalDataTrainingLossMixin,
+):
+    r"""
+    Stochastic variational counterpart of AssignGPSparse for very large numbers of cells.
+
+    The inducing outputs u = f(ZExpanded) have an explicit (uncollapsed) Gaussian posterior
+    q(u) = N(q_mu, q_sqrt q_sqrt^T), whitened by default, so the bound is a sum over cells
+
+        ELBO = sum_n E_q[log p(y_n | f, z_n)] - KL(q(z_n) || p(z_n)) - KL(q(u) || p(u))
+
+    Each cell n can only be assigned to its 3 entries of XExpanded (trunk and the two
+    branches at its pseudotime). The local assignment q(z_n) is not stored: it is set to
+    its closed-form optimum q(z_n = k) ~ p(z_n = k) exp(E_q[log p(y_n | f_k)]) for the
+    cells of each minibatch, which collapses the cell term to
+    logsumexp_k(log p(z_n = k) + E_q[log p(y_n | f_k)]).
+
+    maximum_log_likelihood_objective draws batchSize cells uniformly with replacement and
+    scales their sum by N / batchSize, an unbiased estimate of the bound whose cost does
+    not depend on N. Use FullELBO for the exact bound. If batchSize is None or not smaller
+    than N every cell is used and the objective is deterministic.
+
+    With fPlaceInducingPoints the inducing points are moved to the branches available at
+    every branching point, see VBHelperFunctions.GetBranchingInducingPoints.
+    """
+
+    def __init__(
+        self,
+        t,
+        Y,
+        kern,
+        b,
+        ZExpanded,
+        batchSize=1000,
+        phiPrior=None,
+        whiten=True,
+        seed=42,
+        fPlaceInducingPoints=False,
+        fDebug=False,
+    ):
+        super().__init__(
+            kernel=kern,
+            likelihood=gpflow.likelihoods.Gaussian(),
+            mean_function=Zero(),
+            num_latent_gps=Y.shape[-1],
+        )
+        assert len(t.shape) == 1, "pseudotime should be 1D"
+        assert Y.shape[0] == t.size, "Y must be N x D"
+        assert ZExpanded.shape[1] == 2, "inducing points must be M x 2"
+        self.N = t.shape[0]
+        self.t = t.astype(gpflow.default_float())
+        self.Y = Y.astype(gpflow.default_float())
+        if phiPrior is None:
+            phiPrior = np.ones((self.N, 2)) * 0.5
+        assert phiPrior.shape == (self.N, 2), "phiPrior must be N x 2"
+        assert np.allclose(phiPrior.sum(1), 1), "prior probabilities must sum to 1"
+        self.phiPrior = phiPrior.astype(gpflow.default_float())
+        if batchSize is not None and batchSize >= self.N:
+            batchSize = None
+        self.batchSize = batchSize
+        # minibatches are drawn from a generator local to the model
+        self.rng = tf.random.Generator.from_seed(seed)
+        self.whiten = whiten
+        self.fDebug = fDebug
+        self.fPlaceInducingPoints = fPlaceInducingPoints
+        # Do not treat inducing points as parameters because they should always be fixed.
+        self.inducing_variable = gpflow.inducing_variables.InducingPoints(ZExpanded)
+        set_trainable(self.inducing_variable, False)
+        M = ZExpanded.shape[0]
+        D = Y.shape[1]
+        self.q_mu = gpflow.Parameter(np.zeros((M, D)))
+        self.q_sqrt = gpflow.Parameter(
+            np.tile(np.eye(M)[None, :, :], [D, 1, 1]), transform=triangular()
+        )
+        # Adam optimiser and compiled optimisation loop, see FitBranchingModel.OptimiseSVI
+        self.compiledOptimiser = None
+        self.UpdateBranchingPoint(b)
+
+    def UpdateBranchingPoint(self, b):
+        """Update the branching point, placing inducing points for it if
+        fPlaceInducingPoints, and reset q(u) to its initial state"""
+        assert isinstance(b, np.ndarray)
+        assert b.size == 1, "Must have scalar branching point"
+        self.b = b.astype(gpflow.default_float())  # remember branching value
+        assert self.kernel.kernels[0].name == "branch_kernel_param"
+        self.kernel.kernels[0].Bv = b
+        if self.fPlaceInducingPoints:
+            self.inducing_variable.Z.assign(
+                VBHelperFunctions.GetBranchingInducingPoints(
+                    self.q_mu.shape[0], b, self.t
+                )
+            )
+        self.q_mu.assign(np.zeros(self.q_mu.shape))
+        self.q_sqrt.assign(
+            np.tile(np.eye(self.q_mu.shape[0])[None], [self.Y.shape[1], 1, 1])
+        )
+
+    def GetLogPrior(self, t, phiPrior):
+        """Compact B x 3 log prior on the assignment of cells with pseudotime t, see
+        pZ_construction_singleBP.compact_logpZ0PureNumpyZeros. Computed from the
+        branching point variable so that it follows UpdateBranchingPoint without retracing.
+        """
+        epsilon = 1e-6
+        eps = tf.fill([tf.shape(t)[0], 1], tf.cast(epsilon, gpflow.default_float()))
+        fTrunk = t <= self.kernel.kernels[0].BvVariable[0, 0]
+        trunk = tf.concat([tf.ones_like(eps), eps, eps], 1)
+        branch = tf.concat([eps, phiPrior], 1)
+        return tf.math.log(tf.where(fTrunk[:, None], trunk, branch))
+
+    def GetExpectedLogLik(self, t, Y):
+        """ B x 3 expected log likelihood of cells with pseudotime t under each of their functions """
+        B = tf.shape(t)[0]
+        X = tf.reshape(
+            tf.stack(
+                [
+                    tf.tile(t[:, None], [1, 3]),
+                    tf.tile(
+                        tf.constant([[1.0, 2.0, 3.0]], gpflow.default_float()), [B, 1]
+                    ),
+                ],
+                2,
+            ),
+            [-1, 2],
+        )  # 3B x 2, same layout as XExpanded
+        mu, var = self.predict_f(X)
+        mu = tf.reshape(mu, [B, 3, -1])
+        var = tf.reshape(var, [B, 3, -1])
+        sigma2 = self.likelihood.variance
+        return tf.math.reduce_sum(
+            -0.5 * tf.math.log(2.0 * np.pi * sigma2)
+            - 0.5 * (tf.math.square(Y[:, None, :] - mu) + var) / sigma2,
+            -1,
+        )
+
+    def GetUnnormalisedLogPhi(self, indices):
+        """ B x 3 log prior plus expected log likelihood of the cells indices """
+        t = tf.gather(self.t, indices)
+        logPhi = self.GetLogPrior(t, tf.gather(self.phiPrior, indices))
+        return logPhi + self.GetExpectedLogLik(t, tf.gather(self.Y, indices))
+
+    def GetDataTerm(self, indices):
+        """Sum over the cells indices of the bound with the assignment of each cell at its
+        closed-form optimum: expected log likelihood minus assignment KL"""
+        logPhi = self.GetUnnormalisedLogPhi(indices)
+        return tf.math.reduce_sum(tf.math.reduce_logsumexp(logPhi, 1))
+
+    def GetKL(self):
+        """ KL divergence between q(u) and the prior p(u) """
+        return gpflow.kullback_leiblers.prior_kl(
+            self.inducing_variable,
+            self.kernel,
+            self.q_mu,
+            self.q_sqrt,
+            whiten=self.whiten,
+        )
+
+    def maximum_log_likelihood_objective(self):
+        if self.fDebug:
+            print("assigngp_svi compiling model (build_likelihood)")
+        self.CountTrace()
+        if self.batchSize is None:
+            return self.GetDataTerm(tf.range(self.N)) - self.GetKL()
+        indices = self.rng.uniform([self.batchSize], 0, self.N, dtype=tf.int64)
+        scale = tf.cast(self.N / self.batchSize, gpflow.default_float())
+        return scale * self.GetDataTerm(indices) - self.GetKL()
+
+    def FullELBO(self, chunkSize=10000):
+        """ Exact bound over all cells, accumulated over chunks of chunkSize cells """
+        dataTerm = 0.0
+        for start in range(0, self.N, chunkSize):
+            indices = tf.range(start, min(start + chunkSize, self.N))
+            dataTerm += self.GetDataTerm(indices).numpy()
+        return dataTerm - self.GetKL().numpy()
+
+    def GetPhi(self, chunkSize=10000):
+        """ N x 3 closed-form assignment probabilities of all cells for the current q(u) """
+        Phi = []
+        for start in range(0, self.N, chunkSize):
+            indices = tf.range(start, min(start + chunkSize, self.N))
+            Phi.append(tf.nn.softmax(self.GetUnnormalisedLogPhi(indices)).numpy())
+        return np.vstack(Phi)
+
+    def predict_f(self, Xnew, full_cov=False, full_output_cov=False):
+        mu, var = gpflow.conditionals.conditional(
+            Xnew,
+            self.inducing_variable,
+            self.kernel,
+            self.q_mu,
+            q_sqrt=self.q_sqrt,
+            full_cov=full_cov,
+            white=self.whiten,
+            full_output_cov=full_output_cov,
+        )
+        return mu, var
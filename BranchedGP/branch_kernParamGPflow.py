@@ -1,4 +1,5 @@
-""" Module to replace branch_kern with parameterised version"""
+""" Module to replace branch_kern with parameterised version """
+
 import gpflow
 import numpy as np
 import tensorflow as tf
@@ -69,7 +70,33 @@ class BranchKernelParam(Kernel):
         assert isinstance(b, np.ndarray)
         assert self.fm.shape[0] == self.fm.shape[1]
         assert self.fm.shape[2] > 0
-        self.Bv = b
+        # Branching point values live in a variable and are updated in place so that compiled
+        # functions using the kernel are not retraced when they change.
+        self.BvVariable = tf.Variable(
+            b, dtype=gpflow.default_float(), trainable=False, name="Bv"
+        )
+        # Distinct sets of (0-based) branch point indices used between pairs of functions and,
+        # for every function pair, which set it uses. Entry 0 is reserved for same function pairs.
+        m = self.fm.shape[0]
+        setIds = {}
+        self.pairSetIndex = np.zeros((m, m), dtype=np.int32)
+        for fi in range(m):
+            for fj in range(m):
+                if fi != fj:
+                    # much easier to remove nans before tensorflow
+                    bnan = self.fm[fi, fj, ~np.isnan(self.fm[fi, fj, :])]
+                    bint = tuple(bnan.astype(int) - 1)
+                    self.pairSetIndex[fi, fj] = setIds.setdefault(bint, len(setIds) + 1)
+        self.branchPtSets = [np.array(bint) for bint in setIds]
+
+    @property
+    def Bv(self):
+        """ Branching point values as a B X 1 numpy array. """
+        return self.BvVariable.numpy()
+
+    @Bv.setter
+    def Bv(self, b):
+        self.BvVariable.assign(b)
 
     def SampleKernel(self, XExpanded, b=None, tol=1e-6):
         if b is not None:
@@ -85,6 +112,16 @@ class BranchKernelParam(Kernel):
         ), "Before branch point trunk is function 1."
         return SampleKernel(self, XTree, tol=tol)
 
+    def BaseK(self, t1, t2):
+        """Base kernel between N x 1 and M x 1 pseudotimes. Stationary kernels are evaluated
+        from the differences t1 - t2 as in AssignGPBatch.BaseK: the expansion
+        t1^2 + t2^2 - 2 t1 t2 of gpflow loses all precision in float32 when the
+        lengthscale is small compared to the pseudotimes."""
+        if isinstance(self.kern, gpflow.kernels.IsotropicStationary):
+            r = (t1 - tf.transpose(t2)) / self.kern.lengthscales
+            return self.kern.K_r2(tf.math.square(r))
+        return self.kern.K(t1, t2)
+
     def K(self, X, Y=None):
         if Y is None:
             Y = X  # hack to avoid duplicating code below
@@ -93,115 +130,51 @@ class BranchKernelParam(Kernel):
             print("Compiling kernel")
         t1s = tf.expand_dims(X[:, 0], 1)  # N X 1
         t2s = tf.expand_dims(Y[:, 0], 1)
-        i1s_r = tf.expand_dims(X[:, 1], 1)
-        i2s_r = tf.expand_dims(Y[:, 1], 1)
+        # zero based function indices
+        i1s = tf.cast(X[:, 1], tf.int32) - 1
+        i2s = tf.cast(Y[:, 1], tf.int32) - 1
         if self.fDebug:
             snl = 10  # how many entries to print
-            i1s = i1s_r
-            i2s = i2s_r
-
+            tf.print([tf.shape(i1s), i1s], name="i1sdebug", summarize=snl)
+            tf.print([tf.shape(i2s), i2s], name="i2sdebug", summarize=snl)
             tf.print(
-                [tf.shape(i1s_r), i1s_r], name="i1sdebug", summarize=snl
-            )  # will print message
-            tf.print(
-                [tf.shape(i2s_r), i2s_r], name="i2sdebug", summarize=snl
-            )  # will print message
-        else:
-            i1s = i1s_r
-            i2s = i2s_r
-
-        i1s_matrix = tf.tile(i1s, tf.reverse(tf.shape(i2s), [0]))
-        i2s_matrix = tf.tile(i2s, tf.reverse(tf.shape(i1s), [0]))
-        i2s_matrixT = tf.transpose(i2s_matrix)
-
-        Ktts = self.kern.K(t1s, t2s)  # N*M X N*M
-        with tf.name_scope("kttscope"):  # scope
-            same_functions = tf.equal(
-                i1s_matrix, tf.transpose(i2s_matrix), name="FiEQFj"
+                [tf.shape(self.BvVariable), self.BvVariable], name="Bv", summarize=3
             )
-            K_s = tf.where(
-                same_functions, Ktts, Ktts, name="selectFiEQFj"
-            )  # just setup matrix with block diagonal
 
-        m = self.fm.shape[0]
-        for fi in range(m):
-            for fj in range(m):
-                if fi != fj:
-                    with tf.name_scope("f" + str(fi) + "f" + str(fj)):  # scope
-                        # much easier to remove nans before tensorflow
-                        bnan = self.fm[fi, fj, ~np.isnan(self.fm[fi, fj, :])]
-                        fi_s = tf.constant(fi + 1, tf.int32, name="function" + str(fi))
-                        fj_s = tf.constant(fj + 1, tf.int32, name="function" + str(fj))
-
-                        i1s_matrixInt = tf.cast(i1s_matrix, tf.int32, name="casti1s")
-                        i2s_matrixTInt = tf.cast(i2s_matrixT, tf.int32, name="casti2s")
-
-                        fiFilter = fi_s * tf.ones_like(
-                            i1s_matrixInt, tf.int32, name="fiFilter"
-                        )
-                        fjFilter = fj_s * tf.ones_like(
-                            i2s_matrixTInt, tf.int32, name="fjFilter"
-                        )  # must be transpose
-
-                        f1F = tf.equal(i1s_matrixInt, fiFilter, name="indexF" + str(fi))
-                        f2F = tf.equal(
-                            i2s_matrixTInt, fjFilter, name="indexF" + str(fj)
-                        )
-
-                        t12F = tf.logical_and(
-                            f1F, f2F, name="F" + str(fi) + "andF" + str(fj)
-                        )
-
-                        # Get the actual values of the Bs = B[index of relevant branching points]
-                        bint = bnan.astype(int)  # convert to int - set of indexes
-                        if self.fDebug:
-                            Br = self.Bv
-                            tf.print(
-                                [tf.shape(self.Bv), self.Bv], name="Bv", summarize=3
-                            )  # will print message
-                        else:
-                            Br = self.Bv
-                        Bs = tf.concat(
-                            [tf.slice(Br, [i - 1, 0], [1, 1]) for i in bint], 0
-                        )
-
-                        kbb = (
-                            self.kern.K(Bs)
-                            + tf.linalg.diag(
-                                tf.ones(tf.shape(Bs)[:1], dtype=gpflow.default_float())
-                            )
-                            * gpflow.default_jitter()
-                        )
-                        if self.fDebug:
-                            tf.print([tf.shape(kbb), kbb], name="kbb", summarize=10)
-                            tf.print(
-                                [self.kern.lengthscales.numpy()],
-                                name="lenscales",
-                                summarize=10,
-                            )
-                            tf.print(
-                                [self.kern.variance.numpy()],
-                                name="lenscales",
-                                summarize=10,
-                            )
-                            tf.print([Bs], name="Bs", summarize=10)
-
-                        Kbbs_inv = tf.linalg.inv(kbb, name="invKbb")  # B X B
-                        Kb1s = self.kern.K(t1s, Bs)  # N*m X B
-                        Kb2s = self.kern.K(t2s, Bs)  # N*m X B
-
-                        a = tf.linalg.matmul(Kb1s, Kbbs_inv)
-                        K_crosss = tf.linalg.matmul(
-                            a, tf.transpose(Kb2s), name="Kt1_Bi_invBB_KBt2"
-                        )
-
-                        K_s = tf.where(t12F, K_crosss, K_s, name="selectIndex")
-        return K_s
+        # base kernel blocks are computed once for all function pairs
+        Ktts = self.BaseK(t1s, t2s)  # N*M X N*M
+        Kb1s = self.BaseK(t1s, self.BvVariable)  # N*m X B
+        Kb2s = self.BaseK(t2s, self.BvVariable)  # N*m X B
+        Kbbs = self.BaseK(self.BvVariable, self.BvVariable)  # B X B
+
+        # candidate covariance for every entry: same function first, then one per branch point set
+        K_candidates = [Ktts]
+        for bint in self.branchPtSets:
+            kbb = tf.gather(tf.gather(Kbbs, bint, axis=0), bint, axis=1)
+            kbb += tf.eye(
+                bint.size, dtype=gpflow.default_float()
+            ) * VBHelperFunctions.GetJitter(kbb)
+            if self.fDebug:
+                tf.print([tf.shape(kbb), kbb], name="kbb", summarize=10)
+            Lbb = tf.linalg.cholesky(kbb)
+            a1 = tf.linalg.triangular_solve(
+                Lbb, tf.transpose(tf.gather(Kb1s, bint, axis=1)), lower=True
+            )
+            a2 = tf.linalg.triangular_solve(
+                Lbb, tf.transpose(tf.gather(Kb2s, bint, axis=1)), lower=True
+            )
+            K_candidates.append(
+                tf.linalg.matmul(a1, a2, transpose_a=True, name="Kt1_Bi_invBB_KBt2")
+            )
+        # pick the candidate of the (fi, fj) function pair of each entry
+        pairIndex = tf.gather(
+            tf.gather(self.pairSetIndex, i1s, axis=0), i2s, axis=1
+        )  # N*M X N*M
+        return tf.gather(tf.stack(K_candidates, axis=-1), pairIndex, batch_dims=2)
 
     def K_diag(self, X):
-        return tf.linalg.diag_part(
-            self.kern.K(X)
-        )  # diagonal is just single point no branch point relevant
+        # diagonal is just single point no branch point relevant
+        return self.kern.K_diag(X[:, 0:1])
 
 
 class IndKern(Kernel):
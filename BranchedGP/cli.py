@@ -0,0 +1,385 @@
+"""
+Command line driver fitting a branching GP to every gene of an expression matrix.
+
+    BranchedGP expression.csv --output results --time-column Time --state-column MonocleState
+
+Genes are fitted one at a time with FitBranchingModel.FitModel, or with --batch together
+in batched models (see FitBranchingModel.FitModels), over a local pool of worker processes.
+Tasks of --genes-per-task genes are handed to the workers. Each gene is checkpointed to
+<output>/genes as its result is unpacked from its finished task, so an interrupted run
+resumes where it stopped when started again with the same output directory. The genes of
+tasks still being fitted are lost, so the task size (one gene by default, 10 with --batch
+and a pool of workers) bounds the work an interruption costs. The settings the genes are
+fitted with are saved in <output>/settings.json, and a run with different settings in the
+same output directory is refused, as its genes would not be comparable with those fitted.
+
+Large matrices are best converted once into an expression store (see ExpressionStore)
+with --store: workers then read the genes they fit from a memory map instead of every
+process holding the whole matrix, and later runs skip parsing the CSV.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import scipy.sparse
+
+from . import ExpressionStore, FitBranchingModel, VBHelperFunctions
+
+
+def GetCheckpointPath(output, gene):
+    """Checkpoint file of a gene. Characters unsafe in file names are replaced, and then a
+    hash of the name is appended so that e.g. gene/B and gene_B get different files."""
+    name = re.sub(r"[^\w.-]", "_", str(gene))
+    if name != str(gene):
+        name += "_" + hashlib.md5(str(gene).encode()).hexdigest()[:8]
+    return os.path.join(output, "genes", name + ".p")
+
+
+def SaveCheckpoint(output, gene, d):
+    """ Write the result of a gene atomically so that an interruption never leaves partial files """
+    path = GetCheckpointPath(output, gene)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump({"gene": gene, "result": d}, f)
+    os.replace(tmp, path)
+
+
+def LoadCheckpoint(output, gene):
+    """ Result of a gene from its checkpoint, None if the gene has not been fitted yet """
+    path = GetCheckpointPath(output, gene)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)["result"]
+
+
+def CheckSettings(output, settings):
+    """Save the fit settings of output on its first run, and raise an error if output holds
+    settings other than settings"""
+    path = os.path.join(output, "settings.json")
+    # as read back from the file, so that e.g. tuples compare equal to lists
+    settings = json.loads(json.dumps(settings, sort_keys=True, default=str))
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved != settings:
+            raise NameError(
+                "%s was fitted with settings %s, not %s. Use another output directory."
+                % (output, saved, settings)
+            )
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(settings, f, sort_keys=True, indent=1)
+    os.replace(tmp, path)
+
+
+def IterCheckpoints(output, genes):
+    """ Yield the gene and result of every checkpointed gene, loading one at a time """
+    for gene in genes:
+        d = LoadCheckpoint(output, gene)
+        if d is not None:
+            yield gene, d
+
+
+def ReadData(expression, cellInfo, timeColumn, stateColumn, center):
+    """Read the cells x genes expression matrix and the pseudotime and state of every cell.
+    Cell information comes from the columns of cellInfo, or of the expression file if
+    cellInfo is None, and is matched to the expression rows by position. If expression is
+    a store directory the returned matrix is the ExpressionStore, read lazily, and the
+    cell information is that of the store."""
+    import pandas as pd
+
+    if os.path.isdir(expression):
+        if cellInfo is not None:
+            raise NameError("Cell information of a store is set when it is written")
+        store = ExpressionStore.ExpressionStore(expression, center)
+        return store.genes, store.GPt, store, store.globalBranching
+
+    data = pd.read_csv(expression, index_col=[0])
+    info = data if cellInfo is None else pd.read_csv(cellInfo, index_col=[0])
+    for c in [timeColumn, stateColumn]:
+        if c not in info.columns:
+            raise NameError("Column %s not found in cell information" % c)
+    if info.shape[0] != data.shape[0]:
+        raise NameError(
+            "Cell information has %g cells, expression has %g"
+            % (info.shape[0], data.shape[0])
+        )
+    Y = data.drop(columns=[c for c in [timeColumn, stateColumn] if c in data.columns])
+    GPy = Y.values.astype(float)
+    if center:
+        GPy = GPy - GPy.mean(0)
+    GPt = info[timeColumn].values.astype(float)
+    globalBranching = info[stateColumn].values.astype(int)
+    return list(Y.columns), GPt, GPy, globalBranching
+
+
+def _UnpackResult(d):
+    """ FitModel result of a gene holding only numpy arrays, so that it can be pickled """
+    d.pop("model", None)  # the model cannot be pickled
+    for k in ["mu", "var"]:
+        if isinstance(d["prediction"][k], list):
+            d["prediction"][k] = [np.asarray(a) for a in d["prediction"][k]]
+    return d
+
+
+def _FitGenes(GPt, GPy, globalBranching, bConsider, fitArgs, task=None, fBatch=False):
+    """Worker task: fit the genes of GPy and return results holding only numpy arrays.
+    If task is given the genes are the columns task of GPy, read in the worker. With
+    fBatch the genes are fitted together by FitModels, otherwise one at a time by
+    FitModel."""
+    if task is not None:
+        GPy = GPy[:, task]
+    if fBatch:
+        results = FitBranchingModel.FitModels(
+            bConsider, GPt, GPy, globalBranching, **fitArgs
+        )
+    else:
+        results = [
+            FitBranchingModel.FitModel(
+                bConsider, GPt, GPy[:, [g]], globalBranching, **fitArgs
+            )
+            for g in range(GPy.shape[1])
+        ]
+    return [_UnpackResult(d) for d in results]
+
+
+def FitGenes(
+    genes,
+    GPt,
+    GPy,
+    globalBranching,
+    bConsider,
+    output,
+    n_jobs=1,
+    genesPerTask=None,
+    fitArgs=None,
+    fBatch=False,
+):
+    """
+    Fit every gene not already checkpointed in output and checkpoint results as they finish.
+    Every gene is checkpointed on its own as its result is unpacked, but a task only
+    returns once all its genes are fitted, so an interruption loses the tasks in progress:
+    at most genesPerTask genes per worker. bConsider, fitArgs and fBatch are saved in
+    output by the first run, and later runs with other values raise an error (see
+    CheckSettings) rather than mixing results fitted differently.
+    Results are read back one gene at a time with LoadCheckpoint or IterCheckpoints.
+    :param genes: gene names, one per column of GPy
+    :param GPy: cells x genes expression, an array, scipy.sparse matrix or ExpressionStore.
+        Genes of a store are read by the process fitting them, genes of a sparse matrix
+        are sent sparse and densified by the process fitting them.
+    :param output: output directory
+    :param n_jobs: number of worker processes, -1 for one per core
+    :param genesPerTask: number of genes of a task, fitted together in one batched model
+        with fBatch. Larger tasks fit faster but bound the work lost by an interruption. If
+        None, 10 with fBatch and a pool of workers, otherwise 1.
+    :param fitArgs: further keyword arguments of FitBranchingModel.FitModel, or of
+        FitBranchingModel.FitModels with fBatch
+    :param fBatch: fit the genes of a task in one batched model with FitModels rather than
+        one at a time with FitModel. Much faster, but every candidate branching point
+        starts from the initial hyperparameters rather than from the fit at the previous
+        one, which on genes with several local optima can give different results.
+    """
+    assert len(genes) == GPy.shape[1], "need one name per gene"
+    paths = [GetCheckpointPath(output, gene) for gene in genes]
+    # case insensitive file systems would merge names differing only in case
+    assert len(set(p.lower() for p in paths)) == len(genes), "gene names must be unique"
+    assert n_jobs == -1 or n_jobs >= 1, "n_jobs must be -1 or a positive integer"
+    if genesPerTask is None:
+        genesPerTask = 10 if fBatch and n_jobs != 1 else 1
+    assert genesPerTask >= 1, "genesPerTask must be a positive integer"
+    if fitArgs is None:
+        fitArgs = dict()
+    if scipy.sparse.issparse(GPy):
+        GPy = GPy.tocsc()  # cheap selection of genes
+    os.makedirs(os.path.join(output, "genes"), exist_ok=True)
+    bConsider = [float(b) for b in bConsider]
+    CheckSettings(output, dict(bConsider=bConsider, fitArgs=fitArgs, fBatch=fBatch))
+    todo = [g for g in range(len(genes)) if not os.path.exists(paths[g])]
+    print("%g genes, %g already fitted" % (len(genes), len(genes) - len(todo)))
+    tasks = [todo[i : i + genesPerTask] for i in range(0, len(todo), genesPerTask)]
+    numDone = 0
+    tstart = time.time()
+
+    def checkpoint(g, d):
+        nonlocal numDone
+        SaveCheckpoint(output, genes[g], d)
+        numDone += 1
+        elapsed = time.time() - tstart
+        print(
+            "%g/%g genes fitted, %.1f genes/minute"
+            % (numDone, len(todo), 60.0 * numDone / elapsed)
+        )
+        sys.stdout.flush()
+
+    if n_jobs == 1:
+        for task in tasks:
+            results = _FitGenes(
+                GPt, GPy[:, task], globalBranching, bConsider, fitArgs, fBatch=fBatch
+            )
+            for g, d in zip(task, results):
+                checkpoint(g, d)
+    elif len(tasks) > 0:
+        numCores = os.cpu_count() or 1
+        if n_jobs == -1:
+            n_jobs = numCores
+        n_jobs = min(n_jobs, len(tasks))
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=FitBranchingModel._InitialiseWorker,
+            initargs=(max(1, numCores // n_jobs),),
+        ) as executor:
+            futures = dict()
+            for task in tasks:
+                if isinstance(GPy, ExpressionStore.ExpressionStore):
+                    # only the path of the store is sent, the worker reads the genes
+                    (columns, index) = (GPy, task)
+                else:
+                    (columns, index) = (GPy[:, task], None)
+                future = executor.submit(
+                    _FitGenes,
+                    GPt,
+                    columns,
+                    globalBranching,
+                    bConsider,
+                    fitArgs,
+                    index,
+                    fBatch,
+                )
+                futures[future] = task
+            for future in as_completed(futures):
+                for g, d in zip(futures[future], future.result()):
+                    checkpoint(g, d)
+
+
+def WriteSummary(path, results, bConsider):
+    """CSV with the branching time estimate and log Bayes factor of branching of every gene
+    :param results: iterable of gene and FitModel result pairs, such as IterCheckpoints,
+        so that only one result is held in memory at a time
+    """
+    with open(path, "w") as f:
+        f.write("gene,Bmode,B_CI_lower,B_CI_upper,logBayesFactor\n")
+        for gene, d in results:
+            if np.any(np.isnan(d["loglik"])):
+                f.write("%s,nan,nan,nan,nan\n" % gene)
+                continue
+            bf = VBHelperFunctions.CalculateBranchingEvidence(d, bConsider)
+            postB = d["posteriorB"]
+            f.write(
+                "%s,%g,%g,%g,%g\n"
+                % (
+                    gene,
+                    postB["Bmode"],
+                    postB["B_CI"][0],
+                    postB["B_CI"][1],
+                    bf["logBayesFactor"],
+                )
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fit a branching Gaussian process to every gene of an expression matrix."
+    )
+    parser.add_argument(
+        "expression",
+        help="CSV of cells x genes, cell names first, or an expression store directory",
+    )
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument(
+        "--cell-info",
+        default=None,
+        help="CSV holding the time and state columns, if not in the expression file",
+    )
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="convert the expression CSV into a store in this directory, unless it "
+        "exists already, and fit from the store",
+    )
+    parser.add_argument("--time-column", default="Time")
+    parser.add_argument("--state-column", default="MonocleState")
+    parser.add_argument(
+        "--center", action="store_true", help="subtract the mean of every gene"
+    )
+    parser.add_argument(
+        "--bsearch",
+        type=float,
+        nargs="+",
+        default=list(np.linspace(0.05, 0.95, 5)) + [1.1],
+        help="candidate branching points, the last one meaning no branching",
+    )
+    parser.add_argument("--M", type=int, default=10, help="number of inducing points")
+    parser.add_argument("--maxiter", type=int, default=100)
+    parser.add_argument("--prior-confidence", type=float, default=0.80)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument(
+        "--genes-per-task",
+        type=int,
+        default=None,
+        help="genes of a task, bounding the genes an interruption loses; 1 by default, "
+        "10 with --batch and --n-jobs",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="fit the genes of a task together in one batched model: much faster, but "
+        "every candidate branching point starts from the initial hyperparameters",
+    )
+    parser.add_argument("--no-predict", action="store_true")
+    args = parser.parse_args(argv)
+    expression = args.expression
+    cellInfo = args.cell_info
+    if args.store is not None:
+        if not ExpressionStore.IsStore(args.store):
+            print("Converting %s into store %s" % (expression, args.store))
+            ExpressionStore.ConvertCSV(
+                expression, args.store, cellInfo, args.time_column, args.state_column
+            )
+        expression = args.store
+        cellInfo = None
+    genes, GPt, GPy, globalBranching = ReadData(
+        expression,
+        cellInfo,
+        args.time_column,
+        args.state_column,
+        args.center,
+    )
+    FitGenes(
+        genes,
+        GPt,
+        GPy,
+        globalBranching,
+        args.bsearch,
+        args.output,
+        n_jobs=args.n_jobs,
+        genesPerTask=args.genes_per_task,
+        fBatch=args.batch,
+        fitArgs=dict(
+            priorConfidence=args.prior_confidence,
+            M=args.M,
+            maxiter=args.maxiter,
+            fPredict=not args.no_predict,
+        ),
+    )
+    WriteSummary(
+        os.path.join(args.output, "summary.csv"),
+        IterCheckpoints(args.output, genes),
+        args.bsearch,
+    )
+    print("Summary written to %s" % os.path.join(args.output, "summary.csv"))
+
+
+if __name__ == "__main__":
+    main()
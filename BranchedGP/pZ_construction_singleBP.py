@@ -25,6 +25,27 @@ def expand_pZ0PureNumpyZeros(eZ0, BP, X, epsilon=1e-6):
     return r
 
 
+def compact_pZ0Zeros(pZ0, epsilon=1e-6):
+    """Compact N x 3 counterpart of expand_pZ0Zeros. Column 0 is the trunk and
+    columns 1-2 the two branches, i.e. the 3 entries of XExpanded each cell can take."""
+    assert pZ0.shape[1] == 2, "Should have exactly two cols got %g " % pZ0.shape[1]
+    assert np.all(pZ0.sum(1) == 1), "should sum to 1 is %s" % str(pZ0.sum(1))
+    r = np.zeros((pZ0.shape[0], 3)) + epsilon
+    r[:, 1:] = pZ0
+    return r
+
+
+def compact_logpZ0PureNumpyZeros(cZ0, BP, X, epsilon=1e-6):
+    """Log prior assignment probabilities as a compact N x 3 matrix.
+    Compact counterpart of expand_pZ0PureNumpyZeros: trunk cells (X <= BP) are [1, 0, 0]."""
+    r = cZ0.copy()
+    i = np.flatnonzero(X <= BP)
+    r[i, 0] = 1
+    r[i, 1:] = epsilon
+    with np.errstate(divide="ignore"):  # zero prior mass is allowed
+        return np.log(r)
+
+
 def expand_pZ0(pZ0):
     assert pZ0.shape[1] == 2, "Should have exactly two cols got %g " % pZ0.shape[1]
     num_columns = 3 * pZ0.shape[0]
@@ -0,0 +1,87 @@
+"""
+Benchmark FitModel fitting the branching-point grid in one batched model (fBatch=True)
+against fitting the grid points one after the other.
+
+Each configuration runs in a fresh process with the same data and initial conditions.
+Besides the time it reports the largest difference between the log likelihoods of the
+two fits over the grid and whether they agree on the modal branching point. Run from
+the repository root:
+
+    python benchmarks/benchmark_batch.py --N 100 300 --grid 6 11
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmark_svi_scaling import GetSyntheticData
+from BranchedGP import FitBranchingModel
+
+
+def RunConfiguration(fBatch, N, gridSize, M, maxiter):
+    """ Time a fit of a grid of gridSize points. Runs in a worker process. """
+    GPt, GPy, globalBranching = GetSyntheticData(N)
+    bConsider = list(np.linspace(0.05, 0.95, gridSize - 1)) + [1.1]
+    t = time.time()
+    d = FitBranchingModel.FitModel(
+        bConsider,
+        GPt,
+        GPy,
+        globalBranching,
+        M=M,
+        maxiter=maxiter,
+        fBatch=fBatch,
+        fPredict=False,
+    )
+    return {"fit_s": time.time() - t, "loglik": d["loglik"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--N", type=int, nargs="+", default=[100, 300])
+    parser.add_argument("--grid", type=int, nargs="+", default=[6, 11])
+    parser.add_argument("--M", type=int, default=0, help="inducing points, 0 dense")
+    parser.add_argument("--maxiter", type=int, default=100)
+    args = parser.parse_args()
+    print(
+        "%6s %5s %4s %12s %10s %8s %13s %9s"
+        % (
+            "N",
+            "grid",
+            "M",
+            "sequential_s",
+            "batched_s",
+            "speedup",
+            "max_dloglik",
+            "same_B",
+        )
+    )
+    context = multiprocessing.get_context("spawn")
+    for N in args.N:
+        for gridSize in args.grid:
+            r = dict()
+            for fBatch in [False, True]:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as ex:
+                    r[fBatch] = ex.submit(
+                        RunConfiguration, fBatch, N, gridSize, args.M, args.maxiter
+                    ).result()
+            ls, lb = (r[False]["loglik"], r[True]["loglik"])
+            print(
+                "%6d %5d %4d %12.2f %10.2f %7.2fx %13.3f %9s"
+                % (
+                    N,
+                    gridSize,
+                    args.M,
+                    r[False]["fit_s"],
+                    r[True]["fit_s"],
+                    r[False]["fit_s"] / r[True]["fit_s"],
+                    np.max(np.abs(ls - lb)),
+                    np.argmax(ls[:-1]) == np.argmax(lb[:-1]),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Benchmark the vectorised BranchKernelParam.K against the previous implementation,
+which looped over every pair of functions.
+
+Each configuration runs in a fresh process so that peak resident memory can be
+attributed to a single implementation. Run from the repository root:
+
+    python benchmarks/benchmark_branch_kernel.py --N 500
+
+A tree with a single function has no branching points and is not a valid
+BranchKernelParam, so the sweep covers trees with 1, 2 and 3 branching points
+(3, 5 and 7 functions).
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import gpflow
+import numpy as np
+import tensorflow as tf
+
+from BranchedGP import BranchingTree as bt
+from BranchedGP import branch_kernParamGPflow as bk
+
+
+class LoopBranchKernelParam(bk.BranchKernelParam):
+    """ Previous implementation of BranchKernelParam.K, kept for comparison. """
+
+    def K(self, X, Y=None):
+        if Y is None:
+            Y = X
+        t1s = tf.expand_dims(X[:, 0], 1)
+        t2s = tf.expand_dims(Y[:, 0], 1)
+        i1s = tf.expand_dims(X[:, 1], 1)
+        i2s = tf.expand_dims(Y[:, 1], 1)
+        i1s_matrix = tf.tile(i1s, tf.reverse(tf.shape(i2s), [0]))
+        i2s_matrix = tf.tile(i2s, tf.reverse(tf.shape(i1s), [0]))
+        i2s_matrixT = tf.transpose(i2s_matrix)
+        Ktts = self.kern.K(t1s, t2s)
+        same_functions = tf.equal(i1s_matrix, tf.transpose(i2s_matrix))
+        K_s = tf.where(same_functions, Ktts, Ktts)
+        m = self.fm.shape[0]
+        for fi in range(m):
+            for fj in range(m):
+                if fi != fj:
+                    bnan = self.fm[fi, fj, ~np.isnan(self.fm[fi, fj, :])]
+                    i1s_matrixInt = tf.cast(i1s_matrix, tf.int32)
+                    i2s_matrixTInt = tf.cast(i2s_matrixT, tf.int32)
+                    fiFilter = (fi + 1) * tf.ones_like(i1s_matrixInt, tf.int32)
+                    fjFilter = (fj + 1) * tf.ones_like(i2s_matrixTInt, tf.int32)
+                    t12F = tf.logical_and(
+                        tf.equal(i1s_matrixInt, fiFilter),
+                        tf.equal(i2s_matrixTInt, fjFilter),
+                    )
+                    bint = bnan.astype(int)
+                    Bs = tf.concat(
+                        [tf.slice(self.Bv, [i - 1, 0], [1, 1]) for i in bint], 0
+                    )
+                    kbb = (
+                        self.kern.K(Bs)
+                        + tf.linalg.diag(
+                            tf.ones(tf.shape(Bs)[:1], dtype=gpflow.default_float())
+                        )
+                        * gpflow.default_jitter()
+                    )
+                    Kbbs_inv = tf.linalg.inv(kbb)
+                    Kb1s = self.kern.K(t1s, Bs)
+                    Kb2s = self.kern.K(t2s, Bs)
+                    a = tf.linalg.matmul(Kb1s, Kbbs_inv)
+                    K_crosss = tf.linalg.matmul(a, tf.transpose(Kb2s))
+                    K_s = tf.where(t12F, K_crosss, K_s)
+        return K_s
+
+
+def GetTree(numBranchPts):
+    """ Binary tree with 1, 2 or 3 branching points (3, 5 or 7 functions). """
+    tree = bt.BinaryBranchingTree(0, 1, fDebug=False)
+    tree.add(None, 1, 0.2)
+    if numBranchPts > 1:
+        tree.add(1, 2, 0.4)
+    if numBranchPts > 2:
+        tree.add(1, 3, 0.6)
+    return tree
+
+
+def RunConfiguration(implementation, numBranchPts, N, repeats):
+    """ Time and memory profile a kernel evaluation and its gradient. Runs in a worker process. """
+    tree = GetTree(numBranchPts)
+    (fm, _) = tree.GetFunctionBranchTensor()
+    F = fm.shape[0]
+    Bvalues = np.expand_dims(np.asarray(tree.GetBranchValues()), 1)
+    kernelClass = {"loop": LoopBranchKernelParam, "vectorised": bk.BranchKernelParam}
+    kern = kernelClass[implementation](gpflow.kernels.Matern32(), fm, b=Bvalues)
+    np.random.seed(0)
+    X = np.hstack([np.random.rand(N, 1), np.random.randint(1, F + 1, (N, 1))])
+
+    def lossAndGradient():
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(kern.K(X))
+        return loss, tape.gradient(loss, kern.trainable_variables)
+
+    compiled = tf.function(lossAndGradient)
+    rssStart = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = time.time()
+    compiled()
+    compileTime = time.time() - t
+    t = time.time()
+    for _ in range(repeats):
+        compiled()
+    compiledTime = (time.time() - t) / repeats
+    t = time.time()
+    for _ in range(repeats):
+        lossAndGradient()
+    eagerTime = (time.time() - t) / repeats
+    rssPeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "implementation": implementation,
+        "functions": F,
+        "N": N,
+        "compile_s": compileTime,
+        "compiled_s": compiledTime,
+        "eager_s": eagerTime,
+        "peak_rss_mb": (rssPeak - rssStart) / 1024.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--N", type=int, default=500, help="number of kernel inputs")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    header = ("impl", "functions", "N", "compile_s", "compiled_s", "eager_s")
+    header += ("peak_rss_mb",)
+    print("%-11s %9s %6s %10s %11s %9s %12s" % header)
+    context = multiprocessing.get_context("spawn")
+    for numBranchPts in [1, 2, 3]:
+        for implementation in ["loop", "vectorised"]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                r = executor.submit(
+                    RunConfiguration, implementation, numBranchPts, args.N, args.repeats
+                ).result()
+            print(
+                "%-11s %9d %6d %10.3f %11.4f %9.4f %12.1f"
+                % (
+                    r["implementation"],
+                    r["functions"],
+                    r["N"],
+                    r["compile_s"],
+                    r["compiled_s"],
+                    r["eager_s"],
+                    r["peak_rss_mb"],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark FitModel with the compiled training loss cached on the model against compiling
+a new tf.function for every branching point, as before the cache.
+
+Each configuration runs in a fresh process, so the uncached closure does not leak into
+the cached run. Run from the repository root:
+
+    python benchmarks/benchmark_retracing.py --N 50 200
+
+The time of a fit is dominated by compilation for small genes, so the speedup is largest
+there and shrinks as N grows and the optimiser iterations dominate.
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from benchmark_svi_scaling import GetSyntheticData
+from BranchedGP import FitBranchingModel, assigngp_dense
+
+
+def UncachedTrainingLossClosure(self, compile=True):
+    """ Training loss closure without the cache, compiled anew on every call. """
+    if not compile:
+        return self.training_loss
+    return tf.function(self.training_loss)
+
+
+def RunConfiguration(fCache, N, M, maxiter):
+    """ Time a fit of the whole branching-point grid. Runs in a worker process. """
+    if not fCache:
+        assigngp_dense.CompiledTrainingLossMixin.training_loss_closure = (
+            UncachedTrainingLossClosure
+        )
+    GPt, GPy, globalBranching = GetSyntheticData(N)
+    bConsider = list(np.linspace(0.1, 0.9, 6)) + [1.1]
+    t = time.time()
+    d = FitBranchingModel.FitModel(
+        bConsider, GPt, GPy, globalBranching, M=M, maxiter=maxiter, fPredict=False
+    )
+    return {
+        "cache": fCache,
+        "N": N,
+        "M": M,
+        "fit_s": time.time() - t,
+        "iterations": int(np.sum(d["iterations"])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--N", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--M", type=int, default=0, help="inducing points, 0 dense")
+    parser.add_argument("--maxiter", type=int, default=100)
+    args = parser.parse_args()
+    print("%6s %6s %4s %8s %10s" % ("cache", "N", "M", "fit_s", "iterations"))
+    context = multiprocessing.get_context("spawn")
+    for N in args.N:
+        for fCache in [False, True]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                r = executor.submit(
+                    RunConfiguration, fCache, N, args.M, args.maxiter
+                ).result()
+            print(
+                "%6s %6d %4d %8.2f %10d"
+                % (r["cache"], r["N"], r["M"], r["fit_s"], r["iterations"])
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Micro-benchmarks of the hot paths of fitting, with stored baselines and regression flags.
+
+Times and memory-profiles BranchKernelParam.K and K_diag and the gradient of K, the bound
+(maximum_log_likelihood_objective) of AssignGP and AssignGPSparse and its gradient,
+building the cached posterior and predict_f, BinaryBranchingTree.GetFunctionBranchTensor
+and VBHelperFunctions.GetFunctionIndexListGeneral, sweeping the number of cells N,
+inducing points M and branching points. TensorFlow code is timed compiled with
+tf.function, as the optimiser runs it; the first call is reported as compile_s.
+
+Every configuration runs in a fresh process, so its peak_rss_mb is the resident memory
+the timed calls added to what the setup had allocated. Run from the repository root:
+
+    python benchmarks/benchmark_suite.py --save      # write benchmarks/baseline.json
+    python benchmarks/benchmark_suite.py             # compare against it
+
+Timings only compare on the machine and library versions that produced them, so
+baseline.json holds one baseline per machine, keyed by GetMachineKey, and --save
+replaces only the baseline of the machine it runs on. A rerun flags every configuration
+whose median time or peak memory exceeds the baseline of its machine by more than
+--threshold and by more than an absolute --min-time-s or --min-memory-mb, as short
+timings and peak memory are noisy at the scale of a few microseconds and pages, and
+exits with status 1. On a machine without a baseline the results are only reported.
+
+baseline.json is committed empty, as timings of one machine say nothing about another.
+To gate a machine on regressions, run --save on that machine with the library versions
+it tests, once for every CPU count it runs with (cpus is part of the key), check the
+recorded numbers are not outliers by rerunning without --save, and commit baseline.json.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import gpflow
+import numpy as np
+import tensorflow as tf
+
+from benchmark_branch_kernel import GetTree
+from benchmark_svi_scaling import GetSyntheticData
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from BranchedGP import branch_kernParamGPflow as bk
+
+
+def _Compiled(f, variables=None):
+    """ f compiled, or the compiled gradient of f with respect to variables """
+    if variables is None:
+        return tf.function(f)
+
+    def gradient():
+        with tf.GradientTape() as tape:
+            value = f()
+        return tape.gradient(value, variables)
+
+    return tf.function(gradient)
+
+
+def SetupKernel(case, N, branchPoints):
+    """ BranchKernelParam of a tree with branchPoints branching points on N inputs """
+    tree = GetTree(branchPoints)
+    fm, _ = tree.GetFunctionBranchTensor()
+    Bvalues = np.expand_dims(np.asarray(tree.GetBranchValues()), 1)
+    kern = bk.BranchKernelParam(gpflow.kernels.Matern32(), fm, b=Bvalues)
+    rng = np.random.RandomState(0)
+    X = np.hstack([rng.rand(N, 1), rng.randint(1, fm.shape[0] + 1, (N, 1))])
+    if case == "kernel_K":
+        return _Compiled(lambda: kern.K(X))
+    if case == "kernel_K_diag":
+        return _Compiled(lambda: kern.K_diag(X))
+    return _Compiled(lambda: tf.reduce_sum(kern.K(X)), kern.trainable_variables)
+
+
+def BuildModel(N, M):
+    """ Dense (M=0) or sparse model of synthetic data branching at 0.5 """
+    GPt, GPy, globalBranching = GetSyntheticData(N)
+    phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+        globalBranching, 0.8, True
+    )
+    XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(GPt)
+    m = FitBranchingModel._BuildModel(
+        GPt,
+        GPy,
+        globalBranching,
+        XExpanded,
+        indices,
+        phiInitial,
+        phiPrior,
+        M,
+        1.0,
+        2.0,
+        5.0,
+        False,
+        False,
+        True,
+    )
+    m.UpdateBranchingPoint(np.ones((1, 1)) * 0.5, phiInitial)
+    return m
+
+
+def SetupModel(case, N, M):
+    """ Bound, gradient or prediction of a dense (M=0) or sparse model of N cells """
+    m = BuildModel(N, M)
+    if case == "objective":
+        return _Compiled(m.maximum_log_likelihood_objective)
+    if case == "gradient":
+        return _Compiled(m.maximum_log_likelihood_objective, m.trainable_variables)
+    if case == "posterior":
+
+        def posterior():
+            m.posterior = None  # rebuild the factorisation every call
+            return m.GetPosterior()
+
+        return posterior
+    Xtest = np.hstack(
+        [
+            np.tile(np.linspace(0, 1, 100), 3)[:, None],
+            np.repeat([1, 2, 3], 100)[:, None],
+        ]
+    )
+    m.GetPosterior()
+    return lambda: m.predict_f(Xtest)
+
+
+def SetupTree(case, branchPoints):
+    """ Function branch tensor of a tree with branchPoints branching points """
+    return lambda: GetTree(branchPoints).GetFunctionBranchTensor()
+
+
+def SetupIndexList(case, N):
+    """ Expanded inputs and indices of N cells """
+    t = np.random.RandomState(0).rand(N)
+    return lambda: VBHelperFunctions.GetFunctionIndexListGeneral(t)
+
+
+# case name: (setup function, parameters of the sweep)
+CASES = {
+    "kernel_K": (SetupKernel, ["N", "branchPoints"]),
+    "kernel_K_diag": (SetupKernel, ["N", "branchPoints"]),
+    "kernel_K_gradient": (SetupKernel, ["N", "branchPoints"]),
+    "objective": (SetupModel, ["N", "M"]),
+    "gradient": (SetupModel, ["N", "M"]),
+    "posterior": (SetupModel, ["N", "M"]),
+    "predict_f": (SetupModel, ["N", "M"]),
+    "GetFunctionBranchTensor": (SetupTree, ["branchPoints"]),
+    "GetFunctionIndexListGeneral": (SetupIndexList, ["N"]),
+}
+
+
+def RunConfiguration(case, params, repeats):
+    """ Time and memory profile one configuration. Runs in a fresh worker process. """
+    f = CASES[case][0](case, **params)
+    rssStart = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = time.perf_counter()
+    f()
+    compileTime = time.perf_counter() - t
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    rssPeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "case": case,
+        "params": params,
+        "compile_s": compileTime,
+        "median_s": float(np.median(times)),
+        "min_s": float(np.min(times)),
+        "peak_rss_mb": (rssPeak - rssStart) / 1024.0,
+    }
+
+
+def GetConfigurations(args):
+    """ (case, parameters) of every configuration of the sweep """
+    configurations = []
+    for case in args.cases:
+        names = CASES[case][1]
+        sweep = [dict()]
+        for name in names:
+            values = {
+                "N": args.N,
+                "M": [0] + args.M,
+                "branchPoints": args.branch_points,
+            }
+            sweep = [dict(p, **{name: v}) for p in sweep for v in values[name]]
+        for params in sweep:
+            # the dense model is cubic in N
+            if params.get("M") == 0 and params["N"] > args.dense_max_N:
+                continue
+            configurations.append((case, params))
+    return configurations
+
+
+def GetKey(case, params):
+    """ Name of a configuration in the baseline """
+    return " ".join([case] + ["%s=%s" % (k, params[k]) for k in sorted(params)])
+
+
+def GetMachine():
+    """ Machine and library versions the results depend on """
+    return {
+        "node": platform.node(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "gpflow": gpflow.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def GetMachineKey(machine):
+    """ Name of the baseline of a machine returned by GetMachine """
+    return " ".join("%s=%s" % (k, machine[k]) for k in sorted(machine))
+
+
+def Compare(results, baseline, threshold, minTime, minMemory):
+    """Regressions of results against baseline: time or memory above (1 + threshold)
+    times the baseline and also more than minTime seconds or minMemory MB above it"""
+    regressions = []
+    for key, r in results.items():
+        if key not in baseline:
+            continue
+        b = baseline[key]
+        if (
+            r["median_s"] > (1 + threshold) * b["median_s"]
+            and r["median_s"] - b["median_s"] > minTime
+        ):
+            regressions.append((key, "median_s", b["median_s"], r["median_s"]))
+        if (
+            r["peak_rss_mb"] > (1 + threshold) * b["peak_rss_mb"]
+            and r["peak_rss_mb"] - b["peak_rss_mb"] > minMemory
+        ):
+            regressions.append((key, "peak_rss_mb", b["peak_rss_mb"], r["peak_rss_mb"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--N", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument(
+        "--M", type=int, nargs="+", default=[10, 40], help="M of sparse models"
+    )
+    parser.add_argument("--branch-points", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument(
+        "--dense-max-N",
+        type=int,
+        default=500,
+        help="largest N of dense models (M=0), whose cost is cubic in N",
+    )
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=list(CASES))
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument(
+        "--baseline",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+        ),
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="write the results as the new baseline"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="relative regression to flag"
+    )
+    parser.add_argument(
+        "--min-time-s",
+        type=float,
+        default=1e-4,
+        help="smallest increase of the median time to flag",
+    )
+    parser.add_argument(
+        "--min-memory-mb",
+        type=float,
+        default=10.0,
+        help="smallest increase of the peak memory to flag",
+    )
+    args = parser.parse_args()
+    baselines = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    machine = GetMachine()
+    machineKey = GetMachineKey(machine)
+    baseline = baselines.get(machineKey, {"machine": machine, "results": dict()})
+    if not args.save and len(baseline["results"]) == 0:
+        print(
+            "No baseline for this machine (%s), only reporting. Baselines exist for: %s"
+            % (machineKey, "; ".join(baselines) or "none")
+        )
+    print(
+        "%-58s %10s %10s %10s %8s %8s"
+        % ("configuration", "compile_s", "median_s", "min_s", "peak_MB", "vs_base")
+    )
+    context = multiprocessing.get_context("spawn")
+    results = dict()
+    for case, params in GetConfigurations(args):
+        # a new pool per configuration gives every configuration a fresh process
+        with ProcessPoolExecutor(1, mp_context=context) as ex:
+            r = ex.submit(RunConfiguration, case, params, args.repeats).result()
+        key = GetKey(case, params)
+        results[key] = r
+        b = baseline["results"].get(key)
+        print(
+            "%-58s %10.4f %10.6f %10.6f %8.1f %8s"
+            % (
+                key,
+                r["compile_s"],
+                r["median_s"],
+                r["min_s"],
+                r["peak_rss_mb"],
+                "-" if b is None else "%.2fx" % (r["median_s"] / b["median_s"]),
+            )
+        )
+        sys.stdout.flush()
+    if args.save:
+        # configurations not rerun keep their baseline, other machines keep theirs
+        baselines[machineKey] = {
+            "machine": machine,
+            "date": datetime.date.today().isoformat(),
+            "results": dict(baseline["results"], **results),
+        }
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print("Baseline written to %s" % args.baseline)
+        return
+    regressions = Compare(
+        results,
+        baseline["results"],
+        args.threshold,
+        args.min_time_s,
+        args.min_memory_mb,
+    )
+    for key, measure, before, after in regressions:
+        print("REGRESSION %s %s: %.6g -> %.6g" % (key, measure, before, after))
+    if len(regressions) > 0:
+        sys.exit(1)
+    if len(baseline["results"]) > 0:
+        print("No regressions beyond %g%%" % (100 * args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Scaling of the stochastic variational model (assigngp_svi.AssignGPSVI) with the number
+of cells, compared to the collapsed sparse model (assigngp_denseSparse.AssignGPSparse).
+
+For every number of cells N a synthetic data set branching at 0.5 is generated and
+the time per Adam iteration of FitBranchingModel.OptimiseSVI is measured, along with
+the time of one exact bound evaluation (FullELBO, linear in N) and of one gradient
+evaluation of the collapsed sparse bound. Each configuration runs in a fresh process
+so that peak resident memory can be attributed to it. Run from the repository root:
+
+    python benchmarks/benchmark_svi_scaling.py --N 10000 100000 1000000
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+
+
+def GetSyntheticData(N, seed=0):
+    """ Pseudotime, expression and cell labels of N cells branching at 0.5 """
+    rng = np.random.RandomState(seed)
+    GPt = rng.rand(N)
+    fBranch = GPt > 0.5
+    fUpper = rng.rand(N) < 0.5
+    GPy = np.where(fBranch, np.where(fUpper, 1, -1) * 2 * (GPt - 0.5), 0)
+    GPy = GPy[:, None] + 0.1 * rng.randn(N, 1)
+    globalBranching = np.ones(N, dtype=int)
+    globalBranching[fBranch] = np.where(fUpper[fBranch], 2, 3)
+    return GPt, GPy, globalBranching
+
+
+def RunSVI(N, M, batchSize, maxiter):
+    GPt, GPy, globalBranching = GetSyntheticData(N)
+    _, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+        globalBranching, 0.8, True
+    )
+    m = FitBranchingModel._BuildModelSVI(
+        GPt, GPy, globalBranching, phiPrior, M, batchSize, 1.0, 2.0, 5.0, False, False
+    )
+    m.UpdateBranchingPoint(np.ones((1, 1)) * 0.5)
+    FitBranchingModel.OptimiseSVI(m, maxiter=10)  # compile
+    t = time.time()
+    FitBranchingModel.OptimiseSVI(m, maxiter=maxiter)
+    iterationTime = (time.time() - t) / maxiter
+    t = time.time()
+    bound = m.FullELBO()
+    boundTime = time.time() - t
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return iterationTime, boundTime, bound / N, peak
+
+
+def RunSparse(N, M, repeats=3):
+    GPt, GPy, globalBranching = GetSyntheticData(N)
+    phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+        globalBranching, 0.8, True
+    )
+    XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(GPt)
+    m = FitBranchingModel._BuildModel(
+        GPt,
+        GPy,
+        globalBranching,
+        XExpanded,
+        indices,
+        phiInitial,
+        phiPrior,
+        M,
+        1.0,
+        2.0,
+        5.0,
+        False,
+        False,
+    )
+    m.UpdateBranchingPoint(np.ones((1, 1)) * 0.5, phiInitial)
+    loss = m.training_loss_closure()
+
+    @tf.function
+    def gradient():
+        with tf.GradientTape() as tape:
+            value = loss()
+        return tape.gradient(value, m.trainable_variables)
+
+    gradient()  # compile
+    t = time.time()
+    for _ in range(repeats):
+        gradient()
+    iterationTime = (time.time() - t) / repeats
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return iterationTime, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--N", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--M", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--maxiter", type=int, default=200)
+    parser.add_argument(
+        "--sparse-max",
+        type=int,
+        default=100000,
+        help="largest N for which the collapsed sparse model is timed",
+    )
+    args = parser.parse_args()
+    context = multiprocessing.get_context("spawn")
+    print(
+        "%9s %12s %10s %12s %10s %14s %10s"
+        % (
+            "N",
+            "svi_ms/iter",
+            "svi_MB",
+            "bound_s",
+            "bound/N",
+            "sparse_ms/grad",
+            "sparse_MB",
+        )
+    )
+    for N in args.N:
+        with ProcessPoolExecutor(1, mp_context=context) as ex:
+            (iterationTime, boundTime, bound, peak) = ex.submit(
+                RunSVI, N, args.M, args.batch_size, args.maxiter
+            ).result()
+        sparse = "%14s %10s" % ("-", "-")
+        if N <= args.sparse_max:
+            with ProcessPoolExecutor(1, mp_context=context) as ex:
+                (sparseTime, sparsePeak) = ex.submit(RunSparse, N, args.M).result()
+            sparse = "%14.1f %10.0f" % (1000 * sparseTime, sparsePeak)
+        print(
+            "%9d %12.2f %10.0f %12.2f %10.3f %s"
+            % (N, 1000 * iterationTime, peak, boundTime, bound, sparse)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compare the convergence of closed-form assignment updates (FitBranchingModel.OptimiseCAVI)
+with joint L-BFGS optimisation of assignment and hyperparameters (gpflow Scipy).
+
+Both optimisers start from the same initial state at every branching point. Run from the
+repository root:
+
+    python benchmarks/compare_cavi.py --maxiter 100
+
+Uses the bundled synthetic data and the hematopoiesis data (subsampled and centred as in
+the Hematopoiesis notebook).
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+
+
+def GetDatasets(numGenes, subsample):
+    """ (dataset name, gene name, pseudotime, expression, state) of the bundled datasets """
+    data = pd.read_csv("notebooks/syntheticdata/synthetic20.csv", index_col=[0])
+    GPt = data["Time"].values
+    state = data["MonocleState"].values.astype(int)
+    for g in data.columns[2:][:: (data.shape[1] - 2) // numGenes][:numGenes]:
+        yield "synthetic20", g, GPt, data[g].values[:, None], state
+    Y = pd.read_csv("notebooks/singlecelldata/hematoData.csv", index_col=[0])
+    monocle = pd.read_csv("notebooks/singlecelldata/hematoMonocle.csv", index_col=[0])
+    GPt = monocle["StretchedPseudotime"].values[::subsample]
+    state = monocle["State"].values[::subsample].astype(int)
+    for g in ["MPO", "CTSG", "ELANE", "GATA1"][:numGenes]:
+        y = Y[g].values[::subsample]
+        yield "hematoData", g, GPt, (y - y.mean())[:, None], state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--maxiter", type=int, default=100)
+    parser.add_argument(
+        "--M", type=int, default=10, help="inducing points, 0 for dense"
+    )
+    parser.add_argument("--genes", type=int, default=2, help="genes per dataset")
+    parser.add_argument("--subsample", type=int, default=20)
+    args = parser.parse_args()
+    bConsider = [0.15, 0.45, 0.75, 1.1]
+    print(
+        "%-12s %-8s %5s %10s %8s %5s %10s %8s %5s"
+        % (
+            "dataset",
+            "gene",
+            "B",
+            "scipy_ll",
+            "scipy_s",
+            "iter",
+            "cavi_ll",
+            "cavi_s",
+            "iter",
+        )
+    )
+    for dataset, gene, GPt, GPy, state in GetDatasets(args.genes, args.subsample):
+        phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+            state, 0.8, True
+        )
+        XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(GPt)
+        m = FitBranchingModel._BuildModel(
+            GPt,
+            GPy,
+            state,
+            XExpanded,
+            indices,
+            phiInitial,
+            phiPrior,
+            args.M,
+            1.0,
+            2.0,
+            5.0,
+            False,
+            False,
+        )
+        initialState = FitBranchingModel.GetModelState(m)
+        for b in bConsider:
+            row = [dataset, gene, b]
+            for fCAVI in [False, True]:
+                FitBranchingModel.SetModelState(m, initialState)
+                t = time.time()
+                r = FitBranchingModel._FitBranchingPoint(
+                    m, b, phiInitial, args.maxiter, False, fCAVI=fCAVI
+                )
+                row += [r["loglik"], time.time() - t, r["iterations"]]
+            print("%-12s %-8s %5.2f %10.1f %8.2f %5d %10.1f %8.2f %5d" % tuple(row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Accuracy and speed of single precision fits (FitModel(..., fFloat32=True)) against the
+default double precision.
+
+Every gene is fitted over the same candidate branching points in float64 and float32,
+dense (M=0) and sparse. The table reports the largest absolute difference of the log
+likelihood over the candidates, both modes of the posterior on the branching point and
+the fit times. Run from the repository root:
+
+    python benchmarks/compare_float32.py --M 0 10
+
+Uses the datasets of benchmarks/compare_cavi.py.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from BranchedGP import FitBranchingModel
+from compare_cavi import GetDatasets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--M", type=int, nargs="+", default=[0, 10])
+    parser.add_argument("--maxiter", type=int, default=100)
+    parser.add_argument("--genes", type=int, default=2, help="genes per dataset")
+    parser.add_argument("--subsample", type=int, default=20)
+    args = parser.parse_args()
+    bConsider = [0.15, 0.45, 0.75, 1.1]
+    print(
+        "%-12s %-8s %3s %9s %7s %7s %9s %9s"
+        % (
+            "dataset",
+            "gene",
+            "M",
+            "max|dll|",
+            "Bmode64",
+            "Bmode32",
+            "float64_s",
+            "float32_s",
+        )
+    )
+    for dataset, gene, GPt, GPy, state in GetDatasets(args.genes, args.subsample):
+        for M in args.M:
+            d = dict()
+            fitTime = dict()
+            for fFloat32 in [False, True]:
+                t = time.time()
+                d[fFloat32] = FitBranchingModel.FitModel(
+                    bConsider,
+                    GPt,
+                    GPy,
+                    state,
+                    M=M,
+                    maxiter=args.maxiter,
+                    fPredict=False,
+                    fFloat32=fFloat32,
+                )
+                fitTime[fFloat32] = time.time() - t
+                assert np.all(np.isfinite(d[fFloat32]["loglik"]))
+            print(
+                "%-12s %-8s %3d %9.3f %7.2f %7.2f %9.2f %9.2f"
+                % (
+                    dataset,
+                    gene,
+                    M,
+                    np.max(np.abs(d[True]["loglik"] - d[False]["loglik"])),
+                    d[False]["posteriorB"]["Bmode"],
+                    d[True]["posteriorB"]["Bmode"],
+                    fitTime[False],
+                    fitTime[True],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Accuracy of the sparse bound against the number of inducing points M, for the uniform
+inducing point layout (FitBranchingModel.GetInducingPoints) and for inducing points
+placed on the branches available at every branching point
+(VBHelperFunctions.GetBranchingInducingPoints).
+
+Every (gene, branching point) is fitted with the dense model and with the sparse model
+for each M and layout, from the same initial conditions. The summary reports, per
+dataset, the mean gap between the dense and the sparse log likelihood and the smallest M
+at which each layout does as well as the uniform layout with the largest M. Run from
+the repository root:
+
+    python benchmarks/compare_inducing_points.py --M 3 5 7 10 15 20 30
+
+Uses the datasets of benchmarks/compare_cavi.py.
+"""
+import argparse
+
+import numpy as np
+
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from compare_cavi import GetDatasets
+
+
+def FitBound(GPt, GPy, state, b, M, fPlaceInducingPoints, maxiter):
+    """ Log likelihood of the model with M inducing points (dense if 0) fitted at b """
+    phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+        state, 0.8, True
+    )
+    XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(GPt)
+    m = FitBranchingModel._BuildModel(
+        GPt,
+        GPy,
+        state,
+        XExpanded,
+        indices,
+        phiInitial,
+        phiPrior,
+        M,
+        1.0,
+        2.0,
+        5.0,
+        False,
+        False,
+        fPlaceInducingPoints,
+    )
+    return FitBranchingModel._FitBranchingPoint(m, b, phiInitial, maxiter, False)[
+        "loglik"
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--M", type=int, nargs="+", default=[3, 5, 7, 10, 15, 20, 30])
+    parser.add_argument("--maxiter", type=int, default=100)
+    parser.add_argument("--genes", type=int, default=2, help="genes per dataset")
+    parser.add_argument("--subsample", type=int, default=20)
+    args = parser.parse_args()
+    bConsider = [0.15, 0.45, 0.75, 1.1]
+    layouts = {"uniform": False, "placed": True}
+    gaps = dict()  # (dataset, layout) -> gap of every fit and M
+    for dataset, gene, GPt, GPy, state in GetDatasets(args.genes, args.subsample):
+        for b in bConsider:
+            dense = FitBound(GPt, GPy, state, b, 0, False, args.maxiter)
+            for layout, fPlace in layouts.items():
+                gap = [
+                    dense - FitBound(GPt, GPy, state, b, M, fPlace, args.maxiter)
+                    for M in args.M
+                ]
+                gaps.setdefault((dataset, layout), []).append(gap)
+                print(
+                    "%-12s %-8s b=%.2f %-8s dense %8.1f gap %s"
+                    % (dataset, gene, b, layout, dense, np.round(gap, 1))
+                )
+    print("\nMean dense - sparse log likelihood")
+    print(
+        "%-12s %-8s" % ("dataset", "M")
+        + "".join("%9d" % M for M in args.M)
+        + "   M matching uniform M=%g" % args.M[-1]
+    )
+    for (dataset, layout), gap in gaps.items():
+        meanGap = np.mean(gap, 0)
+        target = np.mean(gaps[(dataset, "uniform")], 0)[-1]
+        print(
+            "%-12s %-8s" % (dataset, layout)
+            + "".join("%9.1f" % g for g in meanGap)
+            + "   %g" % args.M[np.argmax(meanGap <= target)]
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -70,14 +70,13 @@ monocle.head()
 # Plot Monocle DDRTree space
 genelist = ["FLT3", "KLF1", "MPO"]
 f, ax = plt.subplots(1, len(genelist), figsize=(10, 5), sharex=True, sharey=True)
+# log(1 + y / max(y)) scaled to [0, 1], for all genes at once
+yt = BranchedGP.ExpressionStore.LogTransform(Y[genelist].values)
 for ig, g in enumerate(genelist):
-    y = Y[g].values
-    yt = np.log(1 + y / y.max())
-    yt = yt / yt.max()
     h = ax[ig].scatter(
         monocle["DDRTreeDim1"],
         monocle["DDRTreeDim2"],
-        c=yt,
+        c=yt[:, ig],
         s=50,
         alpha=1.0,
         vmin=0,
@@ -37,12 +37,11 @@
 # This notebook shows how to build a BGP model and plot the posterior model fit and posterior branching times.
 
 # %%
-import pickle
-
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 
+from BranchedGP import ResultStore
 from BranchedGP import VBHelperFunctions as bplot
 
 plt.style.use("ggplot")
@@ -81,29 +80,30 @@ f.suptitle("Branching genes, location=1.1 indicates no branching")
 
 # %% [markdown]
 # # Run the BGP model
-# Run script `runsyntheticData.py` to obtain a pickle file with results.
-# This script can take ~10 to 20 minutes depending on your hardware.
-# It performs a gene-by-gene branch model fitting.
+# Run script `runsyntheticData.py` to obtain a result store with the fit of every gene.
+# This script takes about a minute depending on your hardware.
+# It fits the genes in batches of 20 with `FitModels`, each batch one shard of the store.
 
 # %% [markdown]
 # # Plot BGP posterior fit
 # Plot posterior fit.
 
 # %%
-r = pickle.load(open("syntheticdata/syntheticDataRun.p", "rb"))
+r = ResultStore.ResultStore("syntheticdata/syntheticDataRun")
+Bsearch = r.attributes["Bsearch"]
 
 # %%
-r.keys()
+r.attributes
 
 # %%
 # plot fit for a gene
 g = 0
-GPy = Y.iloc[:, g][:, None]
+GPy = Y.iloc[:, g].values[:, None]
 GPt = data["Time"].values
 globalBranching = data["MonocleState"].values.astype(int)
-bmode = r["Bsearch"][np.argmax(r["gpmodels"][g]["loglik"])]
+bmode = Bsearch[np.argmax(r.Get(Y.columns[g])["loglik"])]
 print("True branching time", trueBranchingTimes[g], "BGP Maximum at b=%.2f" % bmode)
-_ = bplot.PlotBGPFit(GPy, GPt, r["Bsearch"], r["gpmodels"][g])
+_ = bplot.PlotBGPFit(GPy, GPt, Bsearch, r.Get(Y.columns[g]))
 
 # %% [markdown]
 # We can also plot with the predictive uncertainty of the GP.
@@ -111,8 +111,8 @@ _ = bplot.PlotBGPFit(GPy, GPt, r["Bsearch"], r["gpmodels"][g])
 
 # %%
 g = 0
-bmode = r["Bsearch"][np.argmax(r["gpmodels"][g]["loglik"])]
-pred = r["gpmodels"][g]["prediction"]  # prediction object from GP
+bmode = Bsearch[np.argmax(r.Get(Y.columns[g])["loglik"])]
+pred = r.Get(Y.columns[g])["prediction"]  # prediction object from GP
 _ = bplot.plotBranchModel(
     bmode,
     GPt,
@@ -120,7 +120,7 @@ _ = bplot.plotBranchModel(
     pred["xtest"],
     pred["mu"],
     pred["var"],
-    r["gpmodels"][g]["Phi"],
+    r.Get(Y.columns[g])["Phi"],
     fPlotPhi=True,
     fColorBar=True,
     fPlotVar=True,
@@ -133,7 +133,7 @@ _ = bplot.plotBranchModel(
 # %%
 fs, ax = plt.subplots(1, 1, figsize=(5, 5))
 for g in range(G):
-    bmode = r["Bsearch"][np.argmax(r["gpmodels"][g]["loglik"])]
+    bmode = Bsearch[np.argmax(r.Get(Y.columns[g])["loglik"])]
     ax.scatter(bmode, g, s=100, color="b")  # BGP mode
     ax.scatter(trueBranchingTimes[g] + 0.05, g, s=100, color="k")  # True
 
@@ -1,8 +1,8 @@
 """
-Run BGP on synthetic data. Will save results to pickle file which
-can then be examined in notebook.
+Run BGP on synthetic data. Will save results to a result store which
+can then be examined in notebook. Genes already in the store are not
+fitted again, so an interrupted run continues where it stopped.
 """
-import pickle
 import time
 
 import numpy as np
@@ -25,30 +25,28 @@ assert np.all(trueBranchingTimes > 0) and np.all(
 
 
 M = 10  # number of inducing points. Increase for better accuracy but at increased computational cose.
-maxiter = 20  # maximum number of optimisation. Increase for better parameter estimation
+maxiter = 100  # maximum number of optimisation iterations of every problem
+genesPerBatch = 20  # genes fitted together in one batched model and stored as one shard
 tallstart = time.time()
-gpmodels = []
 Bsearch = [0.1, 0.2, 0.3, 0.5, 0.8, 1.1]  # set of candidate branching points
-for g in range(G):
+GPt = data["Time"].values
+globalBranching = data["MonocleState"].values.astype(int)
+store = BranchedGP.ResultStore.ResultStore("syntheticdata/syntheticDataRun")
+store.SetAttributes(Bsearch=Bsearch, M=M, maxiter=maxiter)
+# FitModels optimises every gene and branching point of a batch on its own, from the
+# initial hyperparameters rather than from the fit at the previous branching point as
+# FitModel does, so on genes with several local optima the two can differ.
+genes = [gene for gene in Y.columns if gene not in store]
+for i in range(0, len(genes), genesPerBatch):
+    batch = genes[i : i + genesPerBatch]
     t = time.time()
-    GPy = Y.iloc[:, g][:, None]
-    GPt = data["Time"].values
-    globalBranching = data["MonocleState"].values.astype(int)
-    gpmodels.append(
-        BranchedGP.FitBranchingModel.FitModel(
-            Bsearch, GPt, GPy, globalBranching, maxiter=maxiter, M=M
-        )
-    )
-    bmode = Bsearch[np.argmax(gpmodels[g]["loglik"])]
-    print(
-        trueBranchingTimes[g],
-        "BGP Maximum at b=%.2f" % bmode,
-        "inference completed in %.1f seconds." % (time.time() - t),
+    results = BranchedGP.FitBranchingModel.FitModels(
+        Bsearch, GPt, Y[batch].values, globalBranching, maxiter=maxiter, M=M
     )
-    _ = gpmodels[g].pop("model")  # remove model which cannot be pickled
-pickle.dump(
-    {"gpmodels": gpmodels, "Bsearch": Bsearch, "M": M, "maxiter": maxiter},
-    open("syntheticdata/syntheticDataRun.p", "wb"),
-)
+    store.Append(batch, results)
+    print("%g genes fitted in %.1f seconds." % (len(batch), time.time() - t))
+bmode = np.array(Bsearch)[np.argmax(store.GetEntry("loglik", Y.columns), axis=1)]
+for g in range(G):
+    print(trueBranchingTimes[g], "BGP Maximum at b=%.2f" % bmode[g])
 tend = time.time()
 print("Done - total time %.1f secs" % (tend - tallstart))
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 DESCRIPTION = "Branching Gaussian process."
 LONG_DESCRIPTION = DESCRIPTION
@@ -30,6 +30,8 @@ setup(
         "tensorflow>=2.4,<3",
         "gpflow>=2,<3",
         "matplotlib",
+        "pandas",
     ],
+    entry_points={"console_scripts": ["BranchedGP=BranchedGP.cli:main"]},
     python_requires=">=3.5",
 )
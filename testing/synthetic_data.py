@@ -0,0 +1,29 @@
+import numpy as np
+import tensorflow as tf
+
+
+def GetBranchingData(N, b=0.4, noise=0.05, fShift=True, seed=43):
+    """
+    Synthetic gene that branches at b, shared by the tests
+    :param N: number of cells, on a uniform pseudotime grid over [0, 1]
+    :param b: branching point. Cells after it alternate between the branches 2(t - b)
+        and -2(t - b), or 2t and -2t without fShift; cells up to it are 0.
+    :param noise: standard deviation of the Gaussian noise added to every cell
+    :param seed: seed of NumPy and TensorFlow, set before the noise is drawn
+    :return: pseudotime t, N x 1 expression Y and cell labels globalBranching, 1 on the
+        trunk and 2 or 3 on the branches
+    """
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+    t = np.linspace(0, 1, N)
+    Y = np.zeros((N, 1))
+    idx = np.nonzero(t > b)[0]
+    offset = b if fShift else 0.0
+    Y[idx[::2], 0] = 2 * (t[idx[::2]] - offset)
+    Y[idx[1::2], 0] = -2 * (t[idx[1::2]] - offset)
+    if noise > 0:
+        Y += noise * np.random.randn(N, 1)
+    globalBranching = np.ones(N)
+    globalBranching[idx[::2]] = 2
+    globalBranching[idx[1::2]] = 3
+    return t, Y, globalBranching
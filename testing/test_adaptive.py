@@ -0,0 +1,77 @@
+# Generic libraries
+import unittest
+from unittest import mock
+
+import numpy as np
+
+# Branching files
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from synthetic_data import GetBranchingData
+
+
+class TestAdaptive(unittest.TestCase):
+    def test_grid_weights(self):
+        w = FitBranchingModel.GetGridWeights([0.0, 0.5, 1.0])
+        assert np.allclose(w, [0.25, 0.5, 0.25])
+        o = np.array([1.0, 3.0, 2.0, 0.5])
+        grid = [0.1, 0.2, 0.3, 0.4]
+        p = FitBranchingModel.GetPosteriorB(o, grid)
+        pw = FitBranchingModel.GetPosteriorB(o, grid, weights=np.ones(4))
+        assert np.all(p["B_CI"] == pw["B_CI"]) and p["Bmode"] == pw["Bmode"]
+
+    def test_search(self):
+        (t, Y, globalBranching) = GetBranchingData(30, b=0.6)
+        tolerance = 0.05
+        # uniform inducing points give a sharply peaked posterior over the branching point
+        d = FitBranchingModel.FitModelAdaptive(
+            t,
+            Y,
+            globalBranching,
+            tolerance=tolerance,
+            maxiter=20,
+            fPredict=False,
+            fPlaceInducingPoints=False,
+        )
+        bConsider = d["bConsider"]
+        assert d["numFits"] == len(bConsider) == d["loglik"].size
+        assert d["numFits"] < d["numFitsUniformGrid"] == 22
+        assert np.all(np.diff(bConsider) > 0)
+        # the no-branching point is fitted last, as by FitModel
+        assert np.isclose(bConsider[-1], 1.1) and bConsider[-2] <= t.max()
+        assert (
+            d["posteriorB"].keys()
+            == FitBranchingModel.GetPosteriorB(d["loglik"], bConsider).keys()
+        )
+        evidence = VBHelperFunctions.CalculateBranchingEvidence(d, bConsider)
+        assert evidence["logBayesFactor"] > 0, evidence
+        # the mode is resolved to within the tolerance
+        imode = d["posteriorB"]["idx_mode"]
+        assert np.allclose(d["posteriorB"]["Bmode"], bConsider[imode])
+        for i in [imode - 1, imode + 1]:
+            if 0 <= i < len(bConsider):
+                assert abs(bConsider[i] - bConsider[imode]) <= tolerance
+        assert abs(d["posteriorB"]["Bmode"] - 0.6) < 0.15, d["posteriorB"]["Bmode"]
+
+    def test_error(self):
+        (t, Y, globalBranching) = GetBranchingData(30, b=0.6)
+        fit = FitBranchingModel._FitBranchingPoint
+        calls = []
+
+        def fail(m, b, *args, **kwargs):
+            calls.append(b)
+            if len(calls) == 3:
+                raise ValueError("failed fit")
+            return fit(m, b, *args, **kwargs)
+
+        with mock.patch.object(FitBranchingModel, "_FitBranchingPoint", fail):
+            d = FitBranchingModel.FitModelAdaptive(
+                t, Y, globalBranching, maxiter=5, fPredict=False
+            )
+        # one log likelihood per candidate, nan for the failed one
+        assert d["loglik"].shape == (3,)
+        assert np.array_equal(np.isnan(d["loglik"]), [False, False, True])
+        assert d["bConsider"] == sorted(calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
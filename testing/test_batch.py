@@ -0,0 +1,196 @@
+# Generic libraries
+import unittest
+
+import gpflow
+import numpy as np
+
+# Branching files
+from BranchedGP import BranchingTree as bt
+from BranchedGP import (
+    FitBranchingModel,
+    VBHelperFunctions,
+    assigngp_batch,
+    assigngp_dense,
+    assigngp_denseSparse,
+)
+from BranchedGP import branch_kernParamGPflow as bk
+from synthetic_data import GetBranchingData
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        N = 20
+        self.t, self.Y, self.globalBranching = GetBranchingData(
+            N, b=0.5, noise=0.1, fShift=False
+        )
+        self.bConsider = [0.2, 0.5, 0.8]
+        self.XExpanded, self.indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(
+            self.t
+        )
+        self.phiPrior = np.ones((N, 2)) * 0.5
+        self.phiPrior[-1, :] = [0.9, 0.1]
+        self.phiInitial = np.ones((N, 2)) * 0.5
+        self.phiInitial[:, 0] = np.random.rand(N)
+        self.phiInitial[:, 1] = 1 - self.phiInitial[:, 0]
+
+    def checkBound(self, ZExpanded=None):
+        """ Bound and prediction of each problem must match the unbatched model """
+        nb = len(self.bConsider)
+        mb = assigngp_batch.AssignGPBatch(
+            self.t,
+            self.XExpanded,
+            np.tile(self.Y[None, :, :], [nb, 1, 1]),
+            self.indices,
+            np.array(self.bConsider),
+            ZExpanded=ZExpanded,
+            phiInitial=self.phiInitial,
+            phiPrior=self.phiPrior,
+        )
+        hyps = {
+            "likvar": [0.1, 0.2, 0.3],
+            "kerlen": [0.5, 1.0, 2.0],
+            "kervar": [1, 2, 3],
+        }
+        mb.likelihoodVariance.assign(hyps["likvar"])
+        mb.kernelLengthscales.assign(hyps["kerlen"])
+        mb.kernelVariance.assign(hyps["kervar"])
+        mb.logPhi.assign(np.random.randn(nb, self.t.size, 3))
+        bounds = mb.batch_log_likelihood_objective().numpy()
+        assert bounds.shape == (nb,)
+        self.assertTrue(
+            np.allclose(mb.maximum_log_likelihood_objective(), bounds.sum())
+        )
+        Xnew = np.array([[0.1, 1], [0.6, 2], [0.9, 3]], dtype=float)
+        mu, var = mb.predict_f(Xnew)
+        assert mu.shape == (nb, 3, 1) and var.shape == (nb, 3, 1)
+        for ib, b in enumerate(self.bConsider):
+            tree = bt.BinaryBranchingTree(0, 1, fDebug=False)
+            tree.add(None, 1, np.ones((1, 1)) * b)
+            fm, _ = tree.GetFunctionBranchTensor()
+            kern = (
+                bk.BranchKernelParam(
+                    gpflow.kernels.Matern32(), fm, b=np.ones((1, 1)) * b
+                )
+                + gpflow.kernels.White()
+            )
+            kern.kernels[1].variance.assign(1e-6)
+            kern.kernels[0].kern.lengthscales.assign(hyps["kerlen"][ib])
+            kern.kernels[0].kern.variance.assign(hyps["kervar"][ib])
+            if ZExpanded is None:
+                m = assigngp_dense.AssignGP(
+                    self.t,
+                    self.XExpanded,
+                    self.Y,
+                    kern,
+                    self.indices,
+                    np.ones((1, 1)) * b,
+                    phiInitial=self.phiInitial,
+                    phiPrior=self.phiPrior,
+                )
+            else:
+                m = assigngp_denseSparse.AssignGPSparse(
+                    self.t,
+                    self.XExpanded,
+                    self.Y,
+                    kern,
+                    self.indices,
+                    np.ones((1, 1)) * b,
+                    ZExpanded,
+                    phiInitial=self.phiInitial,
+                    phiPrior=self.phiPrior,
+                )
+            m.likelihood.variance.assign(hyps["likvar"][ib])
+            m.logPhi.assign(mb.logPhi[ib])
+            self.assertTrue(np.allclose(np.exp(m.logpZ), np.exp(mb.logpZ[ib])))
+            bound = m.maximum_log_likelihood_objective().numpy()
+            self.assertTrue(
+                np.allclose(bound, bounds[ib]), "%f-%f" % (bound, bounds[ib])
+            )
+            mu1, var1 = m.predict_f(Xnew)
+            self.assertTrue(np.allclose(mu1, mu[ib]))
+            self.assertTrue(np.allclose(var1, var[ib]))
+
+    def test_dense(self):
+        self.checkBound()
+
+    def test_sparse(self):
+        self.checkBound(ZExpanded=FitBranchingModel.GetInducingPoints(10))
+
+    def test_fit(self):
+        d = FitBranchingModel.FitModel(
+            self.bConsider,
+            self.t,
+            self.Y,
+            self.globalBranching,
+            maxiter=1000,
+            fBatch=True,
+        )
+        assert set(d.keys()) == {
+            "loglik",
+            "Phi",
+            "prediction",
+            "hyperparameters",
+            "posteriorB",
+            "iterations",
+            "pruned",
+        }
+        assert d["loglik"].shape == (len(self.bConsider),)
+        assert d["Phi"].shape == (self.t.size, 3)
+        assert len(d["prediction"]["mu"]) == 3
+        # every problem stops on its own criterion, before maxiter
+        assert np.all(d["iterations"] < 1000)
+        assert len(np.unique(d["iterations"])) > 1
+        # same optimum as fitting one branching point after the other
+        dSeq = FitBranchingModel.FitModel(
+            self.bConsider, self.t, self.Y, self.globalBranching, maxiter=1000
+        )
+        np.testing.assert_allclose(d["loglik"], dSeq["loglik"], rtol=0, atol=1e-5)
+        self.assertEqual(d["posteriorB"]["Bmode"], dSeq["posteriorB"]["Bmode"])
+
+    def test_genes(self):
+        GPy = np.hstack([self.Y, -self.Y[::-1] * 0.5])
+        dl = FitBranchingModel.FitModels(
+            self.bConsider, self.t, GPy, self.globalBranching, maxiter=1000
+        )
+        assert len(dl) == GPy.shape[1]
+        for g, d in enumerate(dl):
+            # same optimum as fitting the gene on its own
+            dg = FitBranchingModel.FitModel(
+                self.bConsider,
+                self.t,
+                GPy[:, g : g + 1],
+                self.globalBranching,
+                maxiter=1000,
+            )
+            assert d.keys() == dg.keys()
+            assert d["Phi"].shape == (self.t.size, 3)
+            np.testing.assert_allclose(d["loglik"], dg["loglik"], rtol=0, atol=1e-5)
+            for f in range(3):
+                assert np.shape(d["prediction"]["mu"][f]) == (100, 1)
+
+    def test_independent(self):
+        # a gene without signal in the same batch does not change the fit of the others
+        GPy = np.hstack([self.Y, -self.Y[::-1] * 0.5, 0.1 * np.random.randn(20, 1)])
+        dl = FitBranchingModel.FitModels(
+            self.bConsider,
+            self.t,
+            GPy,
+            self.globalBranching,
+            maxiter=1000,
+            fPredict=False,
+        )
+        for g in range(2):
+            d = FitBranchingModel.FitModels(
+                self.bConsider,
+                self.t,
+                GPy[:, g : g + 1],
+                self.globalBranching,
+                maxiter=1000,
+                fPredict=False,
+            )[0]
+            np.testing.assert_allclose(dl[g]["loglik"], d["loglik"], rtol=1e-10)
+            np.testing.assert_array_equal(dl[g]["iterations"], d["iterations"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+# Generic libraries
+import unittest
+
+import gpflow
+import numpy as np
+
+# Branching files
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from synthetic_data import GetBranchingData
+
+
+class TestCAVI(unittest.TestCase):
+    def setUp(self):
+        (self.t, self.Y, self.globalBranching) = GetBranchingData(30)
+
+    def buildModel(self, M):
+        phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+            self.globalBranching, 0.8, True
+        )
+        XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(self.t)
+        m = FitBranchingModel._BuildModel(
+            self.t,
+            self.Y,
+            self.globalBranching,
+            XExpanded,
+            indices,
+            phiInitial,
+            phiPrior,
+            M,
+            0.1,
+            1.0,
+            1.0,
+            False,
+            False,
+        )
+        m.UpdateBranchingPoint(np.ones((1, 1)) * 0.4, phiInitial)
+        return m, phiInitial
+
+    def checkUpdates(self, M):
+        m, phiInitial = self.buildModel(M)
+        bound = m.maximum_log_likelihood_objective().numpy()
+        for _ in range(3):
+            m.UpdatePhi()
+            newBound = m.maximum_log_likelihood_objective().numpy()
+            self.assertGreaterEqual(newBound, bound - 1e-4)
+            bound = newBound
+        Phi = m.GetPhi()
+        assert np.allclose(Phi.sum(1), 1)
+        trunk = self.t <= 0.4
+        assert np.all(Phi[trunk, 0] > 0.99), "trunk cells stay on the trunk"
+        # no alternation leaves the model unchanged
+        r = FitBranchingModel.OptimiseCAVI(m, maxiter=0)
+        assert r.nit == 0 and r.trajectory.size == 1
+        assert np.allclose(m.GetPhi(), Phi) and m.logPhi.trainable
+        # same optimum as joint L-BFGS optimisation
+        m.UpdateBranchingPoint(np.ones((1, 1)) * 0.4, phiInitial)
+        r = FitBranchingModel.OptimiseCAVI(m, maxiter=50)
+        assert m.logPhi.trainable, "assignment must be trainable again"
+        assert r.nit <= 50 and r.trajectory.size == r.nit + 1
+        assert np.all(np.diff(r.trajectory) <= 1e-4 * np.abs(r.trajectory[:-1]))
+        llCAVI = m.log_posterior_density().numpy()
+        m.UpdateBranchingPoint(np.ones((1, 1)) * 0.4, phiInitial)
+        gpflow.optimizers.Scipy().minimize(
+            m.training_loss_closure(),
+            variables=m.trainable_variables,
+            compile=False,
+            options=dict(maxiter=200),
+        )
+        llScipy = m.log_posterior_density().numpy()
+        self.assertTrue(
+            np.allclose(llCAVI, llScipy, rtol=1e-3) or llCAVI > llScipy,
+            "%f-%f" % (llCAVI, llScipy),
+        )
+
+    def test_dense(self):
+        self.checkUpdates(0)
+
+    def test_sparse(self):
+        self.checkUpdates(10)
+
+    def test_fit(self):
+        d = FitBranchingModel.FitModel(
+            [0.1, 0.4, 0.8],
+            self.t,
+            self.Y,
+            self.globalBranching,
+            maxiter=30,
+            fCAVI=True,
+        )
+        assert np.all(np.isfinite(d["loglik"]))
+        assert np.all(d["iterations"] <= 30)
+        self.assertEqual(d["posteriorB"]["Bmode"], 0.4)
+
+
+if __name__ == "__main__":
+    unittest.main()
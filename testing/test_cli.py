@@ -0,0 +1,169 @@
+# Generic libraries
+import io
+import json
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import numpy as np
+
+# Branching files
+from BranchedGP import cli
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(43)
+        N = 20
+        t = np.linspace(0, 1, N)
+        state = np.ones(N, dtype=int)
+        state[t > 0.5] = [2, 3] * 5
+        Y = 0.1 * np.random.randn(N, 3)
+        Y[state == 2, :] += t[state == 2, None]
+        Y[state == 3, :] -= t[state == 3, None]
+        self.dir = tempfile.TemporaryDirectory()
+        self.expression = os.path.join(self.dir.name, "expression.csv")
+        with open(self.expression, "w") as f:
+            f.write(",MonocleState,Time,geneA,gene/B,geneC\n")
+            for i in range(N):
+                f.write(
+                    "cell%g,%g,%f,%f,%f,%f\n"
+                    % (i, state[i], t[i], Y[i, 0], Y[i, 1], Y[i, 2])
+                )
+        self.output = os.path.join(self.dir.name, "results")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_cli(self, genesPerTask=2, batch=False, maxiter=5):
+        args = [
+            self.expression,
+            "--output",
+            self.output,
+            "--bsearch",
+            "0.2",
+            "0.5",
+            "1.1",
+            "--maxiter",
+            str(maxiter),
+        ]
+        if genesPerTask is not None:
+            args += ["--genes-per-task", str(genesPerTask)]
+        if batch:
+            args += ["--batch"]
+        out = io.StringIO()
+        with redirect_stdout(out):
+            cli.main(args)
+        return out.getvalue()
+
+    def run_interrupted(self, genesPerTask, numCalls, batch=False):
+        """Run the command line, interrupted at fit call numCalls + 1, a call of FitModel
+        per gene or with batch of FitModels per task"""
+        name = "FitModels" if batch else "FitModel"
+        fit = getattr(cli.FitBranchingModel, name)
+        calls = []
+
+        def interrupt(*args, **kwargs):
+            calls.append(args[2].shape[1])
+            if len(calls) > numCalls:
+                raise KeyboardInterrupt
+            return fit(*args, **kwargs)
+
+        with mock.patch.object(cli.FitBranchingModel, name, interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_cli(genesPerTask, batch)
+        return calls
+
+    def test_checkpoint_and_resume(self):
+        log = self.run_cli()
+        assert "3 genes, 0 already fitted" in log, log
+        assert "genes/minute" in log
+        genes = ["geneA", "gene/B", "geneC"]
+        for gene in genes:
+            d = cli.LoadCheckpoint(self.output, gene)
+            assert d is not None
+            assert d["loglik"].shape == (3,)
+            assert "model" not in d
+        with open(os.path.join(self.output, "summary.csv")) as f:
+            lines = f.read().splitlines()
+        assert lines[0].startswith("gene,Bmode")
+        assert [line.split(",")[0] for line in lines[1:]] == genes
+        # an interrupted run only refits the genes without a checkpoint
+        dA = cli.LoadCheckpoint(self.output, "geneA")
+        os.remove(cli.GetCheckpointPath(self.output, "gene/B"))
+        log = self.run_cli()
+        assert "3 genes, 2 already fitted" in log, log
+        assert "1/1 genes fitted" in log, log
+        assert np.all(
+            cli.LoadCheckpoint(self.output, "geneA")["loglik"] == dA["loglik"]
+        )
+        assert cli.LoadCheckpoint(self.output, "gene/B") is not None
+
+    def test_interrupt(self):
+        genes = ["geneA", "gene/B", "geneC"]
+        # one gene per task by default: only the gene being fitted is lost
+        calls = self.run_interrupted(None, 1)
+        assert calls == [1, 1], calls
+        fitted = [cli.LoadCheckpoint(self.output, g) is not None for g in genes]
+        assert fitted == [True, False, False], fitted
+        assert not any(
+            f.endswith(".tmp") for f in os.listdir(os.path.join(self.output, "genes"))
+        )
+        dA = cli.LoadCheckpoint(self.output, "geneA")
+        # the resumed run fits exactly the genes lost
+        log = self.run_cli(None)
+        assert "3 genes, 1 already fitted" in log, log
+        assert "2/2 genes fitted" in log, log
+        assert np.all(
+            cli.LoadCheckpoint(self.output, "geneA")["loglik"] == dA["loglik"]
+        )
+        assert all(cli.LoadCheckpoint(self.output, g) is not None for g in genes)
+
+    def test_interrupt_batch(self):
+        genes = ["geneA", "gene/B", "geneC"]
+        # a batch only returns once all its genes are fitted, so interrupting the first
+        # batch loses both of its genes
+        calls = self.run_interrupted(2, 0, batch=True)
+        assert calls == [2], calls
+        fitted = [cli.LoadCheckpoint(self.output, g) is not None for g in genes]
+        assert fitted == [False, False, False], fitted
+        calls = self.run_interrupted(2, 1, batch=True)
+        assert calls == [2, 1], calls
+        fitted = [cli.LoadCheckpoint(self.output, g) is not None for g in genes]
+        assert fitted == [True, True, False], fitted
+        log = self.run_cli(2, batch=True)
+        assert "3 genes, 2 already fitted" in log, log
+        assert all(cli.LoadCheckpoint(self.output, g) is not None for g in genes)
+
+    def test_settings(self):
+        self.run_cli()
+        with open(os.path.join(self.output, "settings.json")) as f:
+            settings = json.load(f)
+        assert settings["bConsider"] == [0.2, 0.5, 1.1]
+        assert settings["fitArgs"]["maxiter"] == 5
+        assert not settings["fBatch"]
+        # results fitted with other settings are not mixed with those in the output
+        for kwargs in [dict(maxiter=10), dict(batch=True)]:
+            with self.assertRaises(NameError):
+                self.run_cli(**kwargs)
+        log = self.run_cli()
+        assert "3 genes, 3 already fitted" in log, log
+
+    def test_checkpoint_names(self):
+        genes = ["gene/B", "gene_B", "gene B", "geneA"]
+        paths = [cli.GetCheckpointPath(self.output, gene) for gene in genes]
+        assert len(set(paths)) == len(genes), paths
+        assert paths[-1] == os.path.join(self.output, "genes", "geneA.p")
+        # results are read back one gene at a time, skipping genes not fitted
+        os.makedirs(os.path.join(self.output, "genes"))
+        for gene in genes[:2]:
+            cli.SaveCheckpoint(self.output, gene, {"gene": gene})
+        results = cli.IterCheckpoints(self.output, genes)
+        assert not isinstance(results, (list, dict))
+        assert [(g, d["gene"]) for g, d in results] == [(g, g) for g in genes[:2]]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+# Generic libraries
+import unittest
+
+import gpflow
+import numpy as np
+from scipy.linalg import solve_triangular
+
+# Branching files
+from BranchedGP import BranchingTree as bt
+from BranchedGP import VBHelperFunctions, assigngp_dense, assigngp_denseSparse
+from BranchedGP import branch_kernParamGPflow as bk
+from BranchedGP import pZ_construction_singleBP
+from synthetic_data import GetBranchingData
+
+
+def DenseReferenceBound(m, Phi, pZ, Z=None):
+    """Collapsed bound computed with the N x 3N assignment matrix, in plain numpy.
+    Phi and pZ are either the compact N x 3 (squashed) assignment and prior probabilities
+    or the full N x 3N matrices of the original construction."""
+    N, D = m.Y.shape
+    if Phi.shape[1] == 3:
+        PhiExpanded = np.zeros((N, m.X.shape[0]))
+        PhiExpanded[np.arange(N)[:, None], np.asarray(m.indices)] = Phi
+    else:
+        PhiExpanded = Phi
+    sigma2 = m.likelihood.variance.numpy()
+    A = PhiExpanded.sum(0)
+    PhiY = PhiExpanded.T.dot(m.Y)
+    if Z is None:
+        K = m.kernel.K(m.X).numpy()
+        L = np.linalg.cholesky(K) + np.eye(K.shape[0]) * gpflow.default_jitter()
+        W = L.T * np.sqrt(A) / np.sqrt(sigma2)
+        tmp = L.T.dot(PhiY)
+        traceTerm = 0.0
+    else:
+        Kuu = m.kernel.K(Z).numpy() + np.eye(Z.shape[0]) * gpflow.default_jitter()
+        Kuf = m.kernel.K(Z, m.X).numpy()
+        L = np.linalg.cholesky(Kuu)
+        LiKuf = solve_triangular(L, Kuf, lower=True)
+        W = LiKuf * np.sqrt(A) / np.sqrt(sigma2)
+        tmp = LiKuf.dot(PhiY)
+        Kdiag = m.kernel.K_diag(m.X).numpy()
+        traceTerm = -0.5 * np.sum(Kdiag * A) / sigma2 + 0.5 * np.sum(np.square(W))
+    R = np.linalg.cholesky(W.dot(W.T) + np.eye(W.shape[0]))
+    c = solve_triangular(R, tmp, lower=True) / sigma2
+    KL = np.sum(Phi * np.log(Phi)) - np.sum(Phi * np.log(pZ))
+    return (
+        traceTerm
+        - 0.5 * N * D * np.log(2 * np.pi * sigma2)
+        - 0.5 * D * np.sum(np.log(np.square(np.diag(R))))
+        - 0.5 * np.sum(np.square(m.Y)) / sigma2
+        + 0.5 * np.sum(np.square(c))
+        - KL
+    )
+
+
+def OriginalAssignment(m, logPhi, phiPrior):
+    """Phi and pZ as the original N x 3N construction builds them from the same logits:
+    a softmax over all 3N columns, with the infeasible columns at exactly zero, then squashed
+    over every entry, and the prior expanded by pZ_construction_singleBP."""
+    N = logPhi.shape[0]
+    logPhiExpanded = np.full((N, 3 * N), -np.inf)
+    logPhiExpanded[np.arange(N)[:, None], np.asarray(m.indices)] = logPhi
+    Phi = np.exp(logPhiExpanded - logPhiExpanded.max(1, keepdims=True))
+    Phi = Phi / Phi.sum(1, keepdims=True)
+    Phi = (1 - 2e-6) * Phi + 1e-6
+    pZ = pZ_construction_singleBP.expand_pZ0PureNumpyZeros(
+        pZ_construction_singleBP.expand_pZ0Zeros(phiPrior), m.b, m.t
+    )
+    return Phi, pZ
+
+
+class TestCompactAssignment(unittest.TestCase):
+    def setUp(self):
+        N = 20
+        self.t, self.Y, _ = GetBranchingData(N, b=0.5, noise=0, fShift=False)
+        self.B = np.ones((1, 1)) * 0.5
+        tree = bt.BinaryBranchingTree(0, 1, fDebug=False)
+        tree.add(None, 1, self.B)
+        fm, _ = tree.GetFunctionBranchTensor()
+        self.XExpanded, self.indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(
+            self.t
+        )
+        self.kern = (
+            bk.BranchKernelParam(gpflow.kernels.Matern32(), fm, b=self.B.copy())
+            + gpflow.kernels.White()
+        )
+        self.kern.kernels[1].variance.assign(1e-6)
+        gpflow.set_trainable(self.kern.kernels[1].variance, False)
+        self.phiPrior = np.ones((N, 2)) * 0.5
+        self.phiPrior[-1, :] = [0.9, 0.1]
+        self.phiInitial = np.ones((N, 2)) * 0.5
+        self.phiInitial[:, 0] = np.random.rand(N)
+        self.phiInitial[:, 1] = 1 - self.phiInitial[:, 0]
+
+    def checkModel(self, m, Z=None):
+        N = self.t.size
+        assert m.logPhi.shape == (N, 3), "assignment must be compact"
+        # move away from the initial conditions
+        m.logPhi.assign(np.random.randn(N, 3))
+        Phi = m.GetPhi()
+        assert np.allclose(Phi.sum(1), 1)
+        PhiExpanded = m.GetPhiExpanded().numpy()
+        assert PhiExpanded.shape == (N, 3 * N)
+        assert np.allclose(PhiExpanded.sum(1), 1), "only the feasible block is used"
+        for i, ind in enumerate(self.indices):
+            assert np.allclose(PhiExpanded[i, ind], Phi[i, :])
+        A, PhiY = m.GetPhiStatistics(Phi)
+        assert np.allclose(A, PhiExpanded.sum(0))
+        assert np.allclose(PhiY, PhiExpanded.T.dot(self.Y))
+        PhiSquashed = (1 - 2e-6) * Phi + 1e-6
+        pZ = np.exp(m.logpZ)
+        bound = m.maximum_log_likelihood_objective().numpy()
+        boundReference = DenseReferenceBound(m, PhiSquashed, pZ, Z=Z)
+        self.assertTrue(
+            np.allclose(bound, boundReference), "%f-%f" % (bound, boundReference)
+        )
+        PhiOriginal, pZOriginal = OriginalAssignment(m, m.logPhi.numpy(), self.phiPrior)
+        boundOriginal = DenseReferenceBound(m, PhiOriginal, pZOriginal, Z=Z)
+        # the original squash also puts 1e-6 on each of the 3N - 3 infeasible columns of
+        # every row, mass the compact assignment drops; the bound can only move by about that
+        squashMass = N * (3 * N - 3) * 1e-6
+        self.assertTrue(
+            np.abs(bound - boundOriginal) < squashMass,
+            "%f-%f" % (bound, boundOriginal),
+        )
+
+    def test_dense(self):
+        m = assigngp_dense.AssignGP(
+            self.t,
+            self.XExpanded,
+            self.Y,
+            self.kern,
+            self.indices,
+            self.B,
+            phiInitial=self.phiInitial,
+            phiPrior=self.phiPrior,
+        )
+        self.checkModel(m)
+
+    def test_sparse(self):
+        ZExpanded = self.XExpanded[::4, :]
+        m = assigngp_denseSparse.AssignGPSparse(
+            self.t,
+            self.XExpanded,
+            self.Y,
+            self.kern,
+            self.indices,
+            self.B,
+            ZExpanded,
+            phiInitial=self.phiInitial,
+            phiPrior=self.phiPrior,
+        )
+        self.checkModel(m, Z=ZExpanded)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# Generic libraries
+import unittest
+
+import numpy as np
+
+# Branching files
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from synthetic_data import GetBranchingData
+
+
+class TestContinuation(unittest.TestCase):
+    def setUp(self):
+        N = 20
+        self.t, self.Y, self.globalBranching = GetBranchingData(
+            N, b=0.5, noise=0.1, fShift=False
+        )
+
+    def test_phi(self):
+        N = self.t.size
+        Phi = np.random.rand(N, 3)
+        Phi[:, 1] = 0  # degenerate branch assignment must stay finite
+        Phi /= Phi.sum(1, keepdims=True)
+        phiInitial = np.ones((N, 2)) * 0.5
+        phiStart = FitBranchingModel.GetContinuationPhi(Phi, 0.5, self.t, phiInitial)
+        assert np.allclose(phiStart.sum(1), 1)
+        fBranch = self.t > 0.5
+        assert np.all(phiStart[~fBranch] == phiInitial[~fBranch])
+        assert np.all(phiStart[fBranch, 0] > 0) and np.all(phiStart[fBranch, 1] < 1)
+
+    def test_cold_start(self):
+        phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+            self.globalBranching, 0.8, True
+        )
+        XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(self.t)
+        m = FitBranchingModel._BuildModel(
+            self.t,
+            self.Y,
+            self.globalBranching,
+            XExpanded,
+            indices,
+            phiInitial,
+            phiPrior,
+            0,
+            0.1,
+            1.0,
+            1.0,
+            False,
+            False,
+        )
+        coldState = FitBranchingModel.GetModelState(m)
+        r = FitBranchingModel._FitBranchingPoint(m, 0.5, phiInitial, 20, False)
+        phiWarm = FitBranchingModel.GetContinuationPhi(
+            r["Phi"], 0.5, self.t, phiInitial
+        )
+        warmState = FitBranchingModel.GetModelState(m)
+        # a good neighbouring fit is a warm start
+        phiStart, state = FitBranchingModel._GetContinuationStart(
+            m, 0.6, phiWarm, phiInitial, coldState
+        )
+        assert phiStart is phiWarm
+        # hyperparameters, which follow the assignment logits
+        for a, b in zip(state[1:], warmState[1:]):
+            self.assertTrue(np.allclose(a, b))
+        # a neighbouring fit that bounds the data worse than the initial conditions is not
+        FitBranchingModel.SetModelState(m, warmState)
+        m.likelihood.variance.assign(100.0)
+        phiStart, state = FitBranchingModel._GetContinuationStart(
+            m, 0.6, phiWarm, phiInitial, coldState
+        )
+        assert phiStart is phiInitial
+        for a, b in zip(state[1:], coldState[1:]):
+            self.assertTrue(np.allclose(a, b))
+
+    def test_fit(self):
+        bConsider = [0.8, 0.2, 0.5]
+        d = {
+            fContinuation: FitBranchingModel.FitModel(
+                bConsider,
+                self.t,
+                self.Y,
+                self.globalBranching,
+                maxiter=50,
+                fContinuation=fContinuation,
+            )
+            for fContinuation in [False, True]
+        }
+        assert d[True].keys() == d[False].keys()
+        for r in d.values():
+            assert r["iterations"].shape == (len(bConsider),)
+            assert np.all(r["iterations"] > 0)
+        self.assertTrue(
+            np.allclose(d[True]["loglik"], d[False]["loglik"], rtol=0.05),
+            "%s-%s" % (d[True]["loglik"], d[False]["loglik"]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# Generic libraries
+import unittest
+from unittest import mock
+
+# Branching files
+from BranchedGP import FitBranchingModel
+from synthetic_data import GetBranchingData
+
+
+class TestCost(unittest.TestCase):
+    def setUp(self):
+        (self.t, self.Y, self.globalBranching) = GetBranchingData(40)
+
+    def test_estimate(self):
+        dense = [FitBranchingModel.EstimateCost(N, 0, 10)["memory"] for N in [2e3, 4e3]]
+        # the 3N x 3N kernel dominates, 26 matrices of them
+        self.assertAlmostEqual(dense[1] / dense[0], 4, delta=0.1)
+        assert dense[0] > 26 * 6000 ** 2 * 8
+        sparse = FitBranchingModel.EstimateCost(1e5, 20, 10)
+        assert sparse["memory"] < FitBranchingModel.EstimateCost(1e5, 40, 10)["memory"]
+        assert sparse["memory"] < dense[0]
+        single = FitBranchingModel.EstimateCost(1e5, 20, 10, fFloat32=True)
+        self.assertLess(single["memory"], 0.55 * sparse["memory"])
+        self.assertEqual(single["flops"], sparse["flops"])
+        cost = FitBranchingModel.EstimateCost(1e5, 20, 10, maxiter=50, flopRate=1e9)
+        self.assertEqual(cost["flops"], 500 * cost["flopsGradient"])
+        self.assertEqual(cost["seconds"], cost["flops"] / 1e9)
+
+    def test_choose(self):
+        N, numB = 10000, 10
+        # dense whenever it fits
+        assert FitBranchingModel.ChooseModelSize(100, numB) == 0
+        M = FitBranchingModel.ChooseModelSize(N, numB, memoryBudget=4e8)
+        assert 3 <= M < 100
+        self.assertLessEqual(FitBranchingModel.EstimateCost(N, M, numB)["memory"], 4e8)
+        assert FitBranchingModel.EstimateCost(N, M + 1, numB)["memory"] > 4e8
+        # a time budget only lowers M
+        timeBudget = FitBranchingModel.EstimateCost(N, M, numB)["seconds"] / 2
+        MTime = FitBranchingModel.ChooseModelSize(
+            N, numB, memoryBudget=4e8, timeBudget=timeBudget
+        )
+        assert 3 <= MTime < M
+        # ample memory: dense, unless time rules it out
+        assert FitBranchingModel.ChooseModelSize(N, numB, memoryBudget=1e12) == 0
+        assert (
+            FitBranchingModel.ChooseModelSize(
+                N, numB, memoryBudget=1e12, timeBudget=timeBudget * 2
+            )
+            == M
+        )
+        with self.assertRaises(FitBranchingModel.BudgetError):
+            FitBranchingModel.ChooseModelSize(N, numB, memoryBudget=1e6)
+        # without a budget the physical memory is used, where the platform reports it
+        with mock.patch.object(
+            FitBranchingModel, "GetPhysicalMemory", return_value=None
+        ):
+            with self.assertRaises(FitBranchingModel.BudgetError):
+                FitBranchingModel.ChooseModelSize(100, numB)
+            assert FitBranchingModel.ChooseModelSize(100, numB, memoryBudget=1e12) == 0
+
+    def test_fit(self):
+        bConsider = [0.1, 0.4, 0.8]
+        # a budget the dense model cannot meet
+        denseMemory = FitBranchingModel.EstimateCost(self.t.size, 0, 3, 30)["memory"]
+        d = FitBranchingModel.FitModel(
+            bConsider,
+            self.t,
+            self.Y,
+            self.globalBranching,
+            M="auto",
+            maxiter=30,
+            memoryBudget=denseMemory - 1,
+        )
+        assert 3 <= d["M"] <= 100
+        self.assertEqual(d["posteriorB"]["Bmode"], 0.4)
+        d = FitBranchingModel.FitModel(
+            bConsider, self.t, self.Y, self.globalBranching, M="auto", maxiter=30
+        )
+        assert d["M"] == 0
+        # budgets that cannot be met fail before fitting
+        for M in ["auto", 10]:
+            with self.assertRaises(FitBranchingModel.BudgetError):
+                FitBranchingModel.FitModel(
+                    bConsider,
+                    self.t,
+                    self.Y,
+                    self.globalBranching,
+                    M=M,
+                    memoryBudget=1e6,
+                )
+        with self.assertRaises(FitBranchingModel.BudgetError):
+            FitBranchingModel.FitModel(
+                bConsider, self.t, self.Y, self.globalBranching, M=0, timeBudget=1e-9
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
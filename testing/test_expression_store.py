@@ -0,0 +1,218 @@
+# Generic libraries
+import io
+import os
+import pickle
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import numpy as np
+import scipy.sparse
+
+# Branching files
+from BranchedGP import ExpressionStore, FitBranchingModel, cli
+
+
+class TestExpressionStore(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(43)
+        N = 20
+        self.t = np.linspace(0, 1, N)
+        self.state = np.ones(N, dtype=int)
+        self.state[self.t > 0.5] = [2, 3] * 5
+        self.Y = 0.1 * np.random.randn(N, 3) + 1
+        self.Y[self.state == 2, :] += self.t[self.state == 2, None]
+        self.Y[self.state == 3, :] -= self.t[self.state == 3, None]
+        self.genes = ["geneA", "gene/B", "geneC"]
+        self.dir = tempfile.TemporaryDirectory()
+        self.expression = os.path.join(self.dir.name, "expression.csv")
+        with open(self.expression, "w") as f:
+            f.write(",MonocleState,Time," + ",".join(self.genes) + "\n")
+            for i in range(N):
+                f.write(
+                    "cell%g,%g,%.17g,%s\n"
+                    % (
+                        i,
+                        self.state[i],
+                        self.t[i],
+                        ",".join("%.17g" % y for y in self.Y[i]),
+                    )
+                )
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def assertStoreEqual(self, store, Y):
+        """ Store holds Y, up to the rounding of parsing a CSV """
+        assert store.genes == self.genes and store.shape == Y.shape
+        assert np.allclose(store.GPt, self.t)
+        assert np.all(store.globalBranching == self.state)
+        assert np.allclose(store[:, [0, 2]], Y[:, [0, 2]])
+        assert np.allclose(store[:, 1], Y[:, 1])
+        assert np.allclose(store.GetGene("gene/B"), Y[:, [1]])
+        batches = list(store.IterGenes(2))
+        assert [names for names, _ in batches] == [self.genes[:2], self.genes[2:]]
+        assert np.allclose(np.hstack([GPy for _, GPy in batches]), Y)
+
+    def test_store(self):
+        path = os.path.join(self.dir.name, "store")
+        ExpressionStore.WriteStore(path, self.genes, self.t, self.Y, self.state)
+        assert ExpressionStore.IsStore(path)
+        store = ExpressionStore.ExpressionStore(path)
+        self.assertStoreEqual(store, self.Y)
+        assert isinstance(store.expression, np.memmap)
+        # centring is per gene, as over the whole matrix
+        store = ExpressionStore.ExpressionStore(path, center=True)
+        self.assertTrue(
+            np.allclose(store[:, [2]], self.Y[:, [2]] - self.Y[:, 2].mean())
+        )
+        # a pickled store is its path, not its data
+        assert len(pickle.dumps(store)) < 1000
+        unpickled = pickle.loads(pickle.dumps(store))
+        assert unpickled.center and np.all(unpickled[:, [0, 1]] == store[:, [0, 1]])
+        with self.assertRaises(NameError):
+            ExpressionStore.ExpressionStore(self.dir.name)
+
+    def test_convert(self):
+        path = os.path.join(self.dir.name, "store")
+        store = ExpressionStore.ConvertCSV(self.expression, path, chunkSize=7)
+        self.assertStoreEqual(store, self.Y)
+        genes, GPt, GPy, globalBranching = cli.ReadData(
+            self.expression, None, "Time", "MonocleState", True
+        )
+        genesStore, GPtStore, GPyStore, stateStore = cli.ReadData(
+            path, None, "Time", "MonocleState", True
+        )
+        assert isinstance(GPyStore, ExpressionStore.ExpressionStore)
+        assert genes == genesStore and np.all(GPt == GPtStore)
+        assert np.all(globalBranching == stateStore)
+        self.assertTrue(np.allclose(GPy, GPyStore[:, list(range(3))]))
+        with self.assertRaises(NameError):
+            ExpressionStore.ConvertCSV(self.expression, path, timeColumn="Pseudotime")
+
+    def test_cli(self):
+        store = os.path.join(self.dir.name, "store")
+        results = dict()
+        for expression, output, n_jobs in [
+            (self.expression, "results", "1"),
+            (store, "resultsStore", "2"),
+        ]:
+            out = io.StringIO()
+            with redirect_stdout(out):
+                cli.main(
+                    [
+                        expression,
+                        "--store",
+                        store,
+                        "--output",
+                        os.path.join(self.dir.name, output),
+                        "--bsearch",
+                        "0.2",
+                        "0.5",
+                        "1.1",
+                        "--maxiter",
+                        "5",
+                        "--genes-per-task",
+                        "2",
+                        "--n-jobs",
+                        n_jobs,
+                    ]
+                )
+            # converted once, then reused
+            assert ("Converting" in out.getvalue()) == (output == "results")
+            results[output] = out
+            for gene in self.genes:
+                assert cli.LoadCheckpoint(os.path.join(self.dir.name, output), gene)
+        for gene in self.genes:
+            d = [
+                cli.LoadCheckpoint(os.path.join(self.dir.name, output), gene)
+                for output in results
+            ]
+            self.assertTrue(np.allclose(d[0]["loglik"], d[1]["loglik"]))
+
+    def test_sparse(self):
+        counts = np.random.poisson(0.3, (20, 5)).astype(float)
+        counts[:, 4] = 0
+        for fmt in ["csc", "csr", "coo"]:
+            sparse = scipy.sparse.csc_matrix(counts).asformat(fmt)
+            for center in [False, True]:
+                self.assertTrue(
+                    np.allclose(
+                        ExpressionStore.GetGenes(sparse, [3, 1], center),
+                        ExpressionStore.GetGenes(counts, [3, 1], center),
+                    )
+                )
+            yt = ExpressionStore.LogTransform(sparse)
+            assert scipy.sparse.issparse(yt) and yt.nnz == np.sum(counts > 0)
+            self.assertTrue(
+                np.allclose(yt.toarray(), ExpressionStore.LogTransform(counts))
+            )
+        # the transform of the notebooks, gene by gene
+        yt = ExpressionStore.LogTransform(counts)
+        for g in range(4):
+            y = counts[:, g]
+            self.assertTrue(
+                np.allclose(yt[:, g], np.log(1 + y / y.max()) / np.log(2)),
+            )
+        assert np.all(yt[:, 4] == 0)
+
+    def test_sparse_fit(self):
+        bConsider = [0.2, 0.5, 1.1]
+        sparse = scipy.sparse.csr_matrix(self.Y * (self.Y > 1))
+        dense = sparse.toarray()
+        d = [
+            FitBranchingModel.FitModels(
+                bConsider,
+                self.t,
+                GPy,
+                self.state,
+                maxiter=5,
+                fPredict=False,
+                genesPerBatch=2,
+                center=True,
+            )
+            for GPy in [sparse, dense - dense.mean(0)]
+        ]
+        assert len(d[0]) == 3
+        for g in range(3):
+            self.assertTrue(np.allclose(d[0][g]["loglik"], d[1][g]["loglik"]))
+        d = [
+            FitBranchingModel.FitModel(
+                bConsider, self.t, GPy[:, [0]], self.state, maxiter=5, fPredict=False
+            )
+            for GPy in [sparse, dense]
+        ]
+        self.assertTrue(np.allclose(d[0]["loglik"], d[1]["loglik"]))
+
+    def test_sparse_batches(self):
+        # by default a sparse matrix is densified a bounded batch of genes at a time
+        G = 60
+        counts = np.random.poisson(0.5, (self.t.size, G)).astype(float)
+        sparse = scipy.sparse.csc_matrix(counts)
+        shapes = list()
+        GetGenes = ExpressionStore.GetGenes
+
+        def Record(GPy, genes, center=False):
+            Y = GetGenes(GPy, genes, center)
+            shapes.append(Y.shape)
+            return Y
+
+        ExpressionStore.GetGenes = Record
+        try:
+            d = FitBranchingModel.FitModels(
+                [0.5, 1.1],
+                self.t,
+                sparse,
+                self.state,
+                maxiter=1,
+                fPredict=False,
+            )
+        finally:
+            ExpressionStore.GetGenes = GetGenes
+        assert len(d) == G
+        assert len(shapes) > 1 and all(s[1] < G for s in shapes), shapes
+        assert sum(s[1] for s in shapes) == G
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# Generic libraries
+import unittest
+
+import gpflow
+import numpy as np
+import tensorflow as tf
+
+# Branching files
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from synthetic_data import GetBranchingData
+
+
+class TestFloat32(unittest.TestCase):
+    def setUp(self):
+        (self.t, self.Y, self.globalBranching) = GetBranchingData(40)
+
+    def test_jitter(self):
+        K = 5 * np.eye(100)
+        assert VBHelperFunctions.GetJitter(K) == gpflow.default_jitter()
+        assert VBHelperFunctions.GetJitter(K, 0.0) == 0.0
+        with gpflow.config.as_context(FitBranchingModel.GetFloat32Config()):
+            jitter = VBHelperFunctions.GetJitter(tf.constant(K, tf.float32)).numpy()
+            self.assertAlmostEqual(jitter, 5 * 100 * np.finfo(np.float32).eps)
+        assert gpflow.default_float() == np.float64
+
+    def test_kernel(self):
+        """ Single precision kernel is accurate for lengthscales much smaller than t """
+        X, _, _ = VBHelperFunctions.GetFunctionIndexListGeneral(self.t + 10)
+        K = dict()
+        for dtype in [np.float64, np.float32]:
+            with gpflow.config.as_context(
+                FitBranchingModel.GetFloat32Config()
+                if dtype == np.float32
+                else gpflow.config.config()
+            ):
+                (kb, _) = FitBranchingModel._BuildKernel(self.t, self.globalBranching)
+                kb.kernels[0].Bv = np.ones((1, 1)) * 10.4
+                kb.kernels[0].kern.lengthscales.assign(0.01)
+                K[dtype] = kb.K(X.astype(dtype)).numpy()
+                assert K[dtype].dtype == dtype
+        self.assertTrue(np.allclose(K[np.float32], K[np.float64], atol=1e-4))
+
+    def test_fit(self):
+        bConsider = [0.1, 0.4, 0.8]
+        # the batched model shares the factorisation and jitter of the other models
+        for M, fBatch in [(0, False), (6, False), (0, True), (6, True)]:
+            d = {
+                fFloat32: FitBranchingModel.FitModel(
+                    bConsider,
+                    self.t,
+                    self.Y,
+                    self.globalBranching,
+                    M=M,
+                    maxiter=30,
+                    fBatch=fBatch,
+                    fFloat32=fFloat32,
+                )
+                for fFloat32 in [False, True]
+            }
+            assert d[True]["loglik"].dtype == np.float32
+            assert gpflow.default_float() == np.float64
+            self.assertEqual(d[True]["posteriorB"]["Bmode"], 0.4)
+            self.assertTrue(
+                np.allclose(d[True]["loglik"], d[False]["loglik"], atol=1.0),
+                "%s-%s" % (d[True]["loglik"], d[False]["loglik"]),
+            )
+            for f in range(3):
+                assert np.all(np.isfinite(d[True]["prediction"]["mu"][f]))
+
+
+if __name__ == "__main__":
+    unittest.main()
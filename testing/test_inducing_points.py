@@ -0,0 +1,124 @@
+# Generic libraries
+import unittest
+
+import numpy as np
+
+# Branching files
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from synthetic_data import GetBranchingData
+
+
+class TestInducingPoints(unittest.TestCase):
+    def setUp(self):
+        (self.t, self.Y, self.globalBranching) = GetBranchingData(40)
+
+    def test_placement(self):
+        for M in [1, 2, 5, 10]:
+            for b in [-0.1, 0.2, 0.5, 0.9, 1.1]:
+                Z = VBHelperFunctions.GetBranchingInducingPoints(M, b, self.t)
+                assert Z.shape == (M, 2)
+                trunk = Z[:, 1] == 1
+                assert np.all(Z[trunk, 0] <= b), "trunk points after b"
+                assert np.all(Z[~trunk, 0] > b), "branch points before b"
+                # both branches share the same pseudotimes
+                self.assertTrue(np.allclose(Z[Z[:, 1] == 2, 0], Z[Z[:, 1] == 3, 0]))
+                if b > 1:
+                    assert np.all(trunk), "no branch without branch cells"
+                elif b > 0 and M > 2:
+                    assert np.any(trunk) and np.any(~trunk)
+        # points follow the density of the cells
+        t = np.concatenate([np.linspace(0, 0.1, 90), np.linspace(0.1, 1, 10)])
+        Z = VBHelperFunctions.GetBranchingInducingPoints(10, 1.1, t)
+        assert np.sum(Z[:, 0] <= 0.1) >= 8
+
+    def test_model(self):
+        phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+            self.globalBranching, 0.8, True
+        )
+        XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(self.t)
+        m = FitBranchingModel._BuildModel(
+            self.t,
+            self.Y,
+            self.globalBranching,
+            XExpanded,
+            indices,
+            phiInitial,
+            phiPrior,
+            6,
+            0.1,
+            1.0,
+            1.0,
+            False,
+            True,
+            True,
+        )
+        loss = m.training_loss_closure()
+        for b in [0.2, 0.6]:
+            m.UpdateBranchingPoint(np.ones((1, 1)) * b, phiInitial)
+            self.assertTrue(
+                np.allclose(
+                    m.ZExpanded.numpy(),
+                    VBHelperFunctions.GetBranchingInducingPoints(6, b, self.t),
+                )
+            )
+            loss()
+        assert m.traceCount == 1, "moving inducing points must not retrace"
+
+    def test_fit(self):
+        bConsider = [0.1, 0.4, 0.8]
+        dl = [
+            FitBranchingModel.FitModel(
+                bConsider,
+                self.t,
+                self.Y,
+                self.globalBranching,
+                M=6,
+                maxiter=30,
+                fBatch=fBatch,
+                fPlaceInducingPoints=True,
+            )
+            for fBatch in [False, True]
+        ]
+        for d in dl:
+            self.assertEqual(d["posteriorB"]["Bmode"], 0.4)
+        self.assertTrue(
+            np.allclose(dl[0]["loglik"], dl[1]["loglik"], rtol=0.05),
+            "%s-%s" % (dl[0]["loglik"], dl[1]["loglik"]),
+        )
+
+    def test_grow(self):
+        bConsider = [0.1, 0.4, 0.8]
+        d = FitBranchingModel.FitModel(
+            bConsider,
+            self.t,
+            self.Y,
+            self.globalBranching,
+            M=3,
+            maxiter=30,
+            MTolerance=0.5,
+            MMax=64,
+            fPlaceInducingPoints=True,
+        )
+        trajectory = d["MTrajectory"]
+        assert trajectory["M"][0] == 3 and d["M"] == trajectory["M"][-1]
+        assert np.all(trajectory["M"][1:] == np.minimum(2 * trajectory["M"][:-1], 64))
+        assert trajectory["loglik"].shape == (trajectory["M"].size, len(bConsider))
+        self.assertTrue(np.allclose(trajectory["loglik"][-1], d["loglik"]))
+        change = np.abs(trajectory["loglik"][-1] - trajectory["loglik"][-2])
+        assert np.all(change <= 0.5) or d["M"] == 64
+        # stopped before the largest M on this easy problem
+        assert d["M"] < 64
+        self.assertEqual(d["posteriorB"]["Bmode"], 0.4)
+        for f in range(3):
+            assert np.shape(d["prediction"]["mu"][f]) == (100, 1)
+        dDense = FitBranchingModel.FitModel(
+            bConsider, self.t, self.Y, self.globalBranching, M=0, maxiter=30
+        )
+        self.assertTrue(
+            np.allclose(d["loglik"], dDense["loglik"], atol=2.0),
+            "%s-%s" % (d["loglik"], dDense["loglik"]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -55,6 +55,41 @@ class TestKernelSampling(unittest.TestCase):
         # plt.scatter(XForKernel[:, 0], samples, s=200)
         #
 
+    def test_multiple_branch_points(self):
+        # compare against the definition of the branching kernel, entry by entry
+        np.random.seed(43)
+        tree = bt.BinaryBranchingTree(0, 1, fDebug=False)
+        tree.add(None, 1, 0.2)
+        tree.add(1, 2, 0.4)
+        tree.add(1, 3, 0.6)
+        (fm, _) = tree.GetFunctionBranchTensor()
+        F = fm.shape[0]
+        assert F == 7
+        Bvalues = np.expand_dims(np.asarray(tree.GetBranchValues()), 1)
+        KbranchParam = bk.BranchKernelParam(gpflow.kernels.Matern32(), fm, b=Bvalues)
+        X = np.hstack([np.random.rand(15, 1), np.random.randint(1, F + 1, (15, 1))])
+        X2 = np.hstack([np.random.rand(10, 1), np.random.randint(1, F + 1, (10, 1))])
+        for Y in [X, X2]:
+            K = KbranchParam.K(X, Y).numpy()
+            assert K.shape == (X.shape[0], Y.shape[0])
+            for n in range(X.shape[0]):
+                for m in range(Y.shape[0]):
+                    fi, fj = int(X[n, 1]) - 1, int(Y[m, 1]) - 1
+                    tn, tm = X[n : n + 1, :1], Y[m : m + 1, :1]
+                    if fi == fj:
+                        Kexpected = KbranchParam.kern.K(tn, tm).numpy()
+                    else:
+                        bint = fm[fi, fj, ~np.isnan(fm[fi, fj, :])].astype(int) - 1
+                        Bs = Bvalues[bint, :]
+                        kbb = (
+                            KbranchParam.kern.K(Bs).numpy()
+                            + np.eye(bint.size) * gpflow.default_jitter()
+                        )
+                        Kb1 = KbranchParam.kern.K(tn, Bs).numpy()
+                        Kb2 = KbranchParam.kern.K(Bs, tm).numpy()
+                        Kexpected = Kb1.dot(np.linalg.inv(kbb)).dot(Kb2)
+                    assert np.allclose(K[n, m], Kexpected), (n, m, fi, fj)
+
 
 if __name__ == "__main__":
     unittest.main()
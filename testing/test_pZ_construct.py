@@ -96,6 +96,19 @@ class TestpZ(unittest.TestCase):
             r = pZ_construction_singleBP.expand_pZ0PureNumpyZeros(eZ0z, 0.3, X)
             assert np.allclose(r, pZ, atol=1e-5)
 
+    def test_compact(self):
+        X = np.array([0.1, 0.2, 0.3, 0.4])
+        pZ0 = np.array([[0.7, 0.3], [0.1, 0.9], [0.5, 0.5], [0.85, 0.15]])
+        eZ0z = pZ_construction_singleBP.expand_pZ0Zeros(pZ0)
+        cZ0z = pZ_construction_singleBP.compact_pZ0Zeros(pZ0)
+        indices = np.arange(3 * X.size).reshape(X.size, 3)
+        assert np.allclose(np.take_along_axis(eZ0z, indices, 1), cZ0z)
+        for BP in [0, 0.2, 0.3, 1]:
+            r = pZ_construction_singleBP.expand_pZ0PureNumpyZeros(eZ0z, BP, X)
+            logr = pZ_construction_singleBP.compact_logpZ0PureNumpyZeros(cZ0z, BP, X)
+            assert logr.shape == (X.size, 3)
+            assert np.allclose(np.log(np.take_along_axis(r, indices, 1)), logr)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,78 @@
+# Generic libraries
+import unittest
+
+import numpy as np
+
+# Branching files
+from BranchedGP import FitBranchingModel
+from synthetic_data import GetBranchingData
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        N = 20
+        self.t, self.Y, self.globalBranching = GetBranchingData(
+            N, b=0.5, noise=0.1, fShift=False
+        )
+
+    def test_initial_conditions(self):
+        np.random.seed(0)
+        state = np.random.get_state()[1].copy()
+        phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+            self.globalBranching, 0.8, True
+        )
+        assert np.all(state == np.random.get_state()[1]), "global seed is left alone"
+        phiInitial2, _ = FitBranchingModel.GetInitialConditionsAndPrior(
+            self.globalBranching, 0.8, True
+        )
+        assert np.allclose(phiInitial, phiInitial2)
+        phiInitial3, phiPrior3 = FitBranchingModel.GetInitialConditionsAndPrior(
+            self.globalBranching, 0.8, True, seed=1
+        )
+        assert not np.allclose(phiInitial, phiInitial3)
+        assert np.allclose(phiPrior, phiPrior3)
+
+    def test_n_jobs(self):
+        bConsider = [0.2, 0.5, 0.8]
+        d = {
+            n_jobs: FitBranchingModel.FitModel(
+                bConsider,
+                self.t,
+                self.Y,
+                self.globalBranching,
+                maxiter=20,
+                n_jobs=n_jobs,
+            )
+            for n_jobs in [1, 2]
+        }
+        assert d[1].keys() == d[2].keys()
+        assert d[1]["posteriorB"].keys() == d[2]["posteriorB"].keys()
+        assert d[1]["hyperparameters"].keys() == d[2]["hyperparameters"].keys()
+        assert d[2]["loglik"].shape == (len(bConsider),)
+        assert d[2]["Phi"].shape == d[1]["Phi"].shape
+        for k in ["xtest", "mu", "var"]:
+            assert len(d[2]["prediction"][k]) == len(d[1]["prediction"][k]) == 3
+            for a1, a2 in zip(d[1]["prediction"][k], d[2]["prediction"][k]):
+                assert np.shape(a1) == np.shape(a2)
+        self.assertTrue(np.all(np.isfinite(d[2]["loglik"])))
+        # the first branching point starts from the same state in both paths
+        self.assertTrue(np.allclose(d[1]["loglik"][0], d[2]["loglik"][0]))
+        # workers start every branching point from the initial hyperparameters, as a
+        # separate fit of each branching point does; only the threading of reductions
+        # may differ
+        ll = np.array(
+            [
+                FitBranchingModel.FitModel(
+                    [b], self.t, self.Y, self.globalBranching, maxiter=20
+                )["loglik"][0]
+                for b in bConsider
+            ]
+        )
+        self.assertTrue(np.allclose(d[2]["loglik"], ll), "%s-%s" % (d[2]["loglik"], ll))
+        postB = FitBranchingModel.GetPosteriorB(ll, bConsider)
+        for k in ["B_CI", "Bmode", "idx_confInt", "idx_mode"]:
+            self.assertTrue(np.allclose(d[2]["posteriorB"][k], postB[k]), k)
+
+
+if __name__ == "__main__":
+    unittest.main()
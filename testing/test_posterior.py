@@ -0,0 +1,158 @@
+# Generic libraries
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+# Branching files
+from BranchedGP import (
+    FitBranchingModel,
+    VBHelperFunctions,
+    assigngp_batch,
+    assigngp_dense,
+)
+from synthetic_data import GetBranchingData
+
+
+class TestPosterior(unittest.TestCase):
+    def setUp(self):
+        (self.t, self.Y, self.globalBranching) = GetBranchingData(40)
+        self.Xtest = np.hstack((np.linspace(0, 1, 7)[:, None], np.ones((7, 1)) * 2))
+
+    def buildModel(self, M):
+        self.phiInitial, phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+            self.globalBranching, 0.8, True
+        )
+        XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(self.t)
+        m = FitBranchingModel._BuildModel(
+            self.t,
+            self.Y,
+            self.globalBranching,
+            XExpanded,
+            indices,
+            self.phiInitial,
+            phiPrior,
+            M,
+            0.1,
+            1.0,
+            1.0,
+            False,
+            False,
+            True,
+        )
+        m.UpdateBranchingPoint(np.ones((1, 1)) * 0.4, self.phiInitial)
+        return m
+
+    def assertPredictionsEqual(self, p1, p2):
+        for a, b in zip(p1, p2):
+            self.assertTrue(np.allclose(a, b, rtol=1e-10, atol=1e-12))
+
+    def uncachedPrediction(self, m, X, full_cov=False):
+        posterior = assigngp_dense.AssignGPPosterior(m.kernel, *m.GetPosteriorFactors())
+        return posterior.predict_f(X, full_cov=full_cov)
+
+    def test_cache(self):
+        for M in [0, 6]:
+            m = self.buildModel(M)
+            nVariables = len(m.trainable_variables)
+            posterior = m.GetPosterior()
+            assert len(m.trainable_variables) == nVariables
+            assert m.GetPosterior() is posterior, "unchanged model must reuse the cache"
+            for full_cov in [False, True]:
+                self.assertPredictionsEqual(
+                    m.predict_f(self.Xtest, full_cov=full_cov),
+                    self.uncachedPrediction(m, self.Xtest, full_cov),
+                )
+            prediction = posterior.predict_f(self.Xtest)
+            compensating = np.zeros((m.N, 3))
+            compensating[:2, :2] = [[1e-3, -1e-3], [-1e-3, 1e-3]]
+            # every way of changing the model invalidates the cache, the kernel is only
+            # copied again when its hyperparameters change
+            changes = [
+                (lambda: m.likelihood.variance.assign(0.05), False),
+                (lambda: m.kernel.kernels[0].kern.lengthscales.assign(0.5), True),
+                (m.UpdatePhi, False),
+                (
+                    lambda: m.UpdateBranchingPoint(
+                        np.ones((1, 1)) * 0.6, self.phiInitial
+                    ),
+                    True,
+                ),
+                (lambda: m.logPhi.assign(m.logPhi.numpy()[::-1]), False),
+                # a change keeping the row and column sums of logPhi, and one by an ulp
+                (lambda: m.logPhi.assign(m.logPhi.numpy() + compensating), False),
+                (lambda: m.logPhi.assign(np.nextafter(m.logPhi.numpy(), 0)), False),
+            ]
+            for change, fKernelChanged in changes:
+                previous = m.posterior
+                change()
+                assert m.posterior is previous, "changes do not build the posterior"
+                assert m.GetPosterior() is not previous
+                self.assertEqual(
+                    m.posterior.kernel is not previous.kernel, fKernelChanged
+                )
+                self.assertPredictionsEqual(
+                    m.predict_f(self.Xtest), self.uncachedPrediction(m, self.Xtest)
+                )
+            # a posterior stays frozen at the parameters it was built from
+            self.assertPredictionsEqual(posterior.predict_f(self.Xtest), prediction)
+
+    def test_gradient(self):
+        m = self.buildModel(6)
+        m.GetPosterior()
+        variance = m.likelihood.variance.unconstrained_variable
+        with tf.GradientTape(persistent=True) as tape:
+            cached, _ = m.predict_f(self.Xtest)
+            uncached, _ = self.uncachedPrediction(m, self.Xtest)
+        # the cached posterior is frozen, the factors of the bound are differentiable
+        assert tape.gradient(cached, variance) is None
+        gradient = tape.gradient(uncached, variance)
+        assert gradient is not None and np.isfinite(gradient.numpy())
+        self.assertPredictionsEqual((cached,), (uncached,))
+
+    def test_predict(self):
+        m = self.buildModel(6)
+        ttestl, mul, varl = VBHelperFunctions.predictBranchingModel(m)
+        posterior = m.GetPosterior()
+        for f, ttest in enumerate(ttestl):
+            X = np.hstack((ttest, ttest * 0 + f + 1))
+            self.assertPredictionsEqual(
+                (mul[f], varl[f]), self.uncachedPrediction(m, X)
+            )
+        assert m.GetPosterior() is posterior
+
+    def test_grid(self):
+        ttest = np.linspace(0, 1, 11)
+        for M in [0, 6]:
+            m = self.buildModel(M)
+            for grid in [ttest, np.stack([ttest, ttest ** 2, ttest + 0.1])]:
+                for full_cov in [False, True]:
+                    ttestGrid, mu, var = VBHelperFunctions.predictBranchingModelGrid(
+                        m, grid, full_cov=full_cov
+                    )
+                    assert ttestGrid.shape == (3, 11) and mu.shape == (3, 11, 1)
+                    assert var.shape == ((3, 11, 11, 1) if full_cov else (3, 11, 1))
+                    for f in range(3):
+                        X = np.stack([ttestGrid[f], ttestGrid[f] * 0 + f + 1], 1)
+                        self.assertPredictionsEqual(
+                            (mu[f], var[f]), m.predict_f(X, full_cov=full_cov)
+                        )
+        # one call predicts every problem of the batched model
+        XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(self.t)
+        mb = assigngp_batch.AssignGPBatch(
+            self.t,
+            XExpanded,
+            np.tile(self.Y[None], [2, 1, 1]),
+            indices,
+            np.array([0.2, 0.4]),
+            phiInitial=self.phiInitial,
+        )
+        ttestGrid, mu, var = VBHelperFunctions.predictBranchingModelGrid(mb, ttest)
+        assert mu.shape == (2, 3, 11, 1) and var.shape == (2, 3, 11, 1)
+        for f in range(3):
+            X = np.stack([ttest, ttest * 0 + f + 1], 1)
+            self.assertPredictionsEqual((mu[:, f], var[:, f]), mb.predict_f(X))
+
+
+if __name__ == "__main__":
+    unittest.main()
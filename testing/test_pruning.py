@@ -0,0 +1,83 @@
+# Generic libraries
+import unittest
+
+import numpy as np
+
+# Branching files
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from synthetic_data import GetBranchingData
+
+
+class TestPruning(unittest.TestCase):
+    def setUp(self):
+        (self.t, self.Y, self.globalBranching) = GetBranchingData(30)
+
+    def test_prune(self):
+        (t, Y, globalBranching) = (self.t, self.Y, self.globalBranching)
+        bConsider = [0.1, 0.4, 0.7, 0.9, 1.1]
+        maxiter = 40
+        d = {
+            fPrune: FitBranchingModel.FitModel(
+                bConsider,
+                t,
+                Y,
+                globalBranching,
+                maxiter=maxiter,
+                fPrune=fPrune,
+                pruneIter=5,
+            )
+            for fPrune in [False, True]
+        }
+        assert d[True].keys() == d[False].keys()
+        assert not np.any(d[False]["pruned"])
+        pruned = d[True]["pruned"]
+        assert pruned.shape == (len(bConsider),) and np.any(pruned)
+        assert d[True]["loglik"].shape == (len(bConsider),)
+        assert np.all(np.isfinite(d[True]["loglik"]))
+        assert np.all(d[True]["iterations"] <= maxiter)
+        assert np.all(d[True]["iterations"][pruned] < maxiter)
+        assert d[True]["iterations"].sum() < d[False]["iterations"].sum()
+        iw = d[True]["posteriorB"]["idx_mode"]
+        assert not pruned[d[True]["posteriorB"]["isort"][iw]], "winner is never pruned"
+        self.assertEqual(
+            d[True]["posteriorB"]["Bmode"], d[False]["posteriorB"]["Bmode"]
+        )
+        # still usable for the Bayes factor
+        assert not pruned[-1], "no-branching reference is never pruned"
+        bf = VBHelperFunctions.CalculateBranchingEvidence(d[True], bConsider)
+        assert np.isfinite(bf["logBayesFactor"])
+
+    def test_converged_not_refitted(self):
+        bConsider = [0.2, 0.4, 0.6, 0.8, 1.1]
+        calls = list()  # (b, iteration budget, iterations used) of every round
+        FitBranchingPoint = FitBranchingModel._FitBranchingPoint
+
+        def Record(m, b, phiInitial, maxiter, *args, **kwargs):
+            r = FitBranchingPoint(m, b, phiInitial, maxiter, *args, **kwargs)
+            calls.append((b, maxiter, r["iterations"]))
+            return r
+
+        FitBranchingModel._FitBranchingPoint = Record
+        try:
+            d = FitBranchingModel.FitModel(
+                bConsider,
+                self.t,
+                self.Y,
+                self.globalBranching,
+                maxiter=1000,
+                fPrune=True,
+                pruneIter=3,
+                fPredict=False,
+            )
+        finally:
+            FitBranchingModel._FitBranchingPoint = FitBranchingPoint
+        assert not d["pruned"][-1]
+        for b in bConsider:
+            rounds = [(budget, nit) for (c, budget, nit) in calls if c == b]
+            # only the last round of a candidate may stop before its budget
+            assert all(nit == budget for (budget, nit) in rounds[:-1]), rounds
+            assert d["iterations"][bConsider.index(b)] == sum(n for _, n in rounds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# Generic libraries
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+# Branching files
+from BranchedGP import FitBranchingModel, ResultStore
+
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(43)
+        N = 20
+        self.t = np.linspace(0, 1, N)
+        self.state = np.ones(N, dtype=int)
+        self.state[self.t > 0.5] = [2, 3] * 5
+        self.Y = 0.1 * np.random.randn(N, 3)
+        self.Y[self.state == 2, :] += self.t[self.state == 2, None]
+        self.Y[self.state == 3, :] -= self.t[self.state == 3, None]
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def assertResultEqual(self, d, expected):
+        """ Nested dictionaries hold the same arrays """
+        assert set(d) == set(k for k in expected if k != "model"), d.keys()
+        for k, v in expected.items():
+            if k == "model":
+                continue
+            if isinstance(v, dict):
+                self.assertResultEqual(d[k], v)
+            elif isinstance(v, list):
+                assert isinstance(d[k], list) and len(d[k]) == len(v)
+                for a, b in zip(d[k], v):
+                    assert np.all(a == np.asarray(b)) and not tf.is_tensor(a)
+            else:
+                np.testing.assert_array_equal(d[k], v)
+
+    def test_store(self):
+        bConsider = [0.2, 0.5, 1.1]
+        results = FitBranchingModel.FitModels(
+            bConsider, self.t, self.Y, self.state, maxiter=5, M=6
+        )
+        results[1]["MTrajectory"] = {"M": np.array([3, 6]), "loglik": np.zeros((2, 3))}
+        # a failed fit holds NaN placeholders and its model
+        failed = {
+            "loglik": np.array([np.nan, 0.0, 0.0]),
+            "model": object(),
+            "Phi": np.nan,
+            "prediction": {"xtest": np.nan, "mu": np.nan, "var": np.nan},
+            "hyperparameters": np.nan,
+            "posteriorB": np.nan,
+        }
+        path = os.path.join(self.dir.name, "results")
+        store = ResultStore.ResultStore(path)
+        store.SetAttributes(bConsider=bConsider)
+        store.Append(["geneA", "geneB"], results[:2])
+        store.Append(["geneC", "geneD"], [results[2], failed])
+        # reopened, every gene is read back from its shard
+        store = ResultStore.ResultStore(path)
+        assert store.genes == ["geneA", "geneB", "geneC", "geneD"] and "geneB" in store
+        assert store.attributes == {"bConsider": bConsider}
+        for gene, expected in zip(store.genes, results + [failed]):
+            self.assertResultEqual(store.Get(gene), expected)
+        assert np.all(np.isnan(store.Get("geneD")["Phi"]))
+        # entries of many genes are stacked
+        loglik = store.GetEntry("loglik")
+        assert loglik.shape == (4, 3)
+        np.testing.assert_array_equal(loglik[:3], [d["loglik"] for d in results])
+        mu = store.GetEntry("prediction/mu", ["geneC", "geneA"])
+        assert mu.shape == (2, 3, 100, 1) and mu.dtype == np.float64
+        np.testing.assert_array_equal(mu[0], np.stack(results[2]["prediction"]["mu"]))
+        Bmode = store.GetEntry("posteriorB/Bmode")
+        assert isinstance(Bmode, list) and Bmode[:3] == [
+            d["posteriorB"]["Bmode"] for d in results
+        ]
+        assert store.GetEntry("MTrajectory/M", ["geneA", "geneB"])[0] is None
+        # a gene appended again is read from the latest shard
+        store.Append(["geneA"], [results[2]])
+        self.assertResultEqual(ResultStore.ResultStore(path).Get("geneA"), results[2])
+        assert len(ResultStore.ResultStore(path)) == 4
+        # shards hold plain arrays only
+        for shard in store._GetShards():
+            with np.load(os.path.join(path, shard), allow_pickle=False) as z:
+                for k in z.files:
+                    assert z[k].dtype != object
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# Generic libraries
+import unittest
+
+import gpflow
+import numpy as np
+
+# Branching files
+from BranchedGP import BranchingTree as bt
+from BranchedGP import VBHelperFunctions, assigngp_dense, assigngp_denseSparse
+from BranchedGP import branch_kernParamGPflow as bk
+from synthetic_data import GetBranchingData
+
+
+class TestRetracing(unittest.TestCase):
+    def runModel(self, M=None):
+        N = 20
+        t, Y, _ = GetBranchingData(N, b=0.5, noise=0, fShift=False)
+        tree = bt.BinaryBranchingTree(0, 1, fDebug=False)
+        tree.add(None, 1, 0.5)
+        fm, _ = tree.GetFunctionBranchTensor()
+        XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(t)
+        kern = (
+            bk.BranchKernelParam(gpflow.kernels.Matern32(), fm, b=np.zeros((1, 1)))
+            + gpflow.kernels.White()
+        )
+        kern.kernels[1].variance.assign(1e-6)
+        gpflow.set_trainable(kern.kernels[1].variance, False)
+        phiInitial = np.ones((N, 2)) * 0.5
+        if M is None:
+            m = assigngp_dense.AssignGP(
+                t, XExpanded, Y, kern, indices, np.ones((1, 1)) * 0.5
+            )
+        else:
+            m = assigngp_denseSparse.AssignGPSparse(
+                t, XExpanded, Y, kern, indices, np.ones((1, 1)) * 0.5, XExpanded[::M]
+            )
+        loss = m.training_loss_closure()
+        assert loss is m.training_loss_closure(), "compiled closure must be cached"
+        traceCount = m.traceCount
+        for b in [0.1, 0.5, 0.8, 1.1]:
+            m.UpdateBranchingPoint(np.ones((1, 1)) * b, phiInitial)
+            assert m.kernel.kernels[0].Bv == b
+            self.assertTrue(np.allclose(loss(), m.training_loss()))
+            opt = gpflow.optimizers.Scipy()
+            opt.minimize(
+                loss,
+                variables=m.trainable_variables,
+                compile=False,
+                options=dict(maxiter=2),
+            )
+        self.assertEqual(m.traceCount, traceCount + 1, "objective must be traced once")
+
+    def test_dense(self):
+        self.runModel()
+
+    def test_sparse(self):
+        self.runModel(M=4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+# Generic libraries
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+# Branching files
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from synthetic_data import GetBranchingData
+
+
+class TestSaveModel(unittest.TestCase):
+    def setUp(self):
+        (self.t, self.Y, self.globalBranching) = GetBranchingData(40)
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def assertPredictionEqual(self, m, d, rtol=1e-8, atol=1e-10):
+        """ Model m predicts the prediction of the FitModel dictionary d """
+        _, mul, varl = VBHelperFunctions.predictBranchingModel(m)
+        for f in range(3):
+            self.assertTrue(
+                np.allclose(mul[f], d["prediction"]["mu"][f], rtol=rtol, atol=atol)
+            )
+            self.assertTrue(
+                np.allclose(varl[f], d["prediction"]["var"][f], rtol=rtol, atol=atol)
+            )
+
+    def test_save_and_load(self):
+        bConsider = [0.1, 0.4, 0.8]
+        for M in [0, 6]:
+            d = FitBranchingModel.FitModel(
+                bConsider,
+                self.t,
+                self.Y,
+                self.globalBranching,
+                M=M,
+                maxiter=20,
+                fReturnModel=True,
+            )
+            record = d["modelRecord"]
+            assert record["b"] == d["posteriorB"]["Bmode"]
+            assert record["ZExpanded"].shape == (M, 2)
+            m = FitBranchingModel.BuildModelFromRecord(record)
+            self.assertPredictionEqual(m, d)
+            iw = np.argmax(d["loglik"])
+            self.assertAlmostEqual(
+                m.log_posterior_density().numpy(), d["loglik"][iw], places=6
+            )
+            self.assertTrue(np.allclose(m.GetPhi(), d["Phi"]))
+            # saved and loaded again without optimising
+            path = os.path.join(self.dir.name, "model%g.npz" % M)
+            FitBranchingModel.SaveModel(path, record)
+            start = time.time()
+            mLoaded = FitBranchingModel.LoadModel(path)
+            assert time.time() - start < 5
+            self.assertPredictionEqual(mLoaded, d)
+            # a live model saves the same record
+            FitBranchingModel.SaveModel(path, mLoaded)
+            for k, v in FitBranchingModel.GetModelRecord(
+                FitBranchingModel.LoadModel(path)
+            ).items():
+                np.testing.assert_array_equal(v, record[k])
+
+    def test_models(self):
+        bConsider = [0.1, 0.4, 0.8]
+        Y = np.hstack([self.Y, -self.Y])
+        dl = FitBranchingModel.FitModels(
+            bConsider,
+            self.t,
+            Y,
+            self.globalBranching,
+            M=6,
+            maxiter=20,
+            fReturnModel=True,
+        )
+        for g, d in enumerate(dl):
+            m = FitBranchingModel.BuildModelFromRecord(d["modelRecord"])
+            assert np.all(m.Y.flatten() == Y[:, g])
+            # the batched model computes the same posterior up to its jitter
+            self.assertPredictionEqual(m, d, rtol=1e-3, atol=1e-4)
+        assert (
+            "modelRecord"
+            not in FitBranchingModel.FitModels(
+                bConsider, self.t, Y, self.globalBranching, M=6, maxiter=2
+            )[0]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+# Generic libraries
+import unittest
+
+import numpy as np
+import tensorflow as tf
+from gpflow.utilities import set_trainable
+
+# Branching files
+from BranchedGP import FitBranchingModel, VBHelperFunctions
+from synthetic_data import GetBranchingData
+
+
+class TestSVI(unittest.TestCase):
+    def setUp(self):
+        (self.t, self.Y, self.globalBranching) = GetBranchingData(60)
+        self.phiInitial, self.phiPrior = FitBranchingModel.GetInitialConditionsAndPrior(
+            self.globalBranching, 0.8, True
+        )
+
+    def buildModel(self, batchSize):
+        m = FitBranchingModel._BuildModelSVI(
+            self.t,
+            self.Y,
+            self.globalBranching,
+            self.phiPrior,
+            10,
+            batchSize,
+            0.1,
+            1.0,
+            1.0,
+            False,
+            True,
+        )
+        m.UpdateBranchingPoint(np.ones((1, 1)) * 0.4)
+        return m
+
+    def test_unbiased(self):
+        m = self.buildModel(batchSize=20)
+        m.q_mu.assign(np.random.randn(*m.q_mu.shape))
+        bound = m.FullELBO(chunkSize=7)
+        # average of the minibatch estimates over a partition of the cells is exact
+        estimates = [
+            3.0 * m.GetDataTerm(tf.range(i, i + 20)).numpy() - m.GetKL().numpy()
+            for i in range(0, 60, 20)
+        ]
+        self.assertTrue(np.allclose(np.mean(estimates), bound))
+        # random minibatches of the objective are centred on the bound
+        objective = tf.function(m.maximum_log_likelihood_objective)
+        samples = np.array([objective().numpy() for _ in range(500)])
+        assert samples.std() > 0, "minibatch objective should be stochastic"
+        stderr = samples.std() / np.sqrt(samples.size)
+        self.assertLess(abs(samples.mean() - bound), 4 * stderr)
+        assert m.traceCount == 1
+
+    def test_collapsed_bound(self):
+        """ Optimising q(u) over every cell recovers the collapsed bound of AssignGPSparse """
+        XExpanded, indices, _ = VBHelperFunctions.GetFunctionIndexListGeneral(self.t)
+        ms = FitBranchingModel._BuildModel(
+            self.t,
+            self.Y,
+            self.globalBranching,
+            XExpanded,
+            indices,
+            self.phiInitial,
+            self.phiPrior,
+            10,
+            0.1,
+            1.0,
+            1.0,
+            False,
+            True,
+        )
+        ms.UpdateBranchingPoint(np.ones((1, 1)) * 0.4, self.phiInitial)
+        for _ in range(50):
+            ms.UpdatePhi()
+        collapsed = ms.maximum_log_likelihood_objective().numpy()
+        m = self.buildModel(batchSize=None)
+        set_trainable(m.likelihood, False)
+        set_trainable(m.kernel, False)
+        assert m.FullELBO() < collapsed
+        r = FitBranchingModel.OptimiseSVI(m, maxiter=1000, learningRate=0.05)
+        assert r.trajectory.size == 1000
+        bound = m.FullELBO()
+        self.assertTrue(np.allclose(bound, -r.fun))
+        self.assertTrue(
+            np.allclose(bound, collapsed, atol=0.05), "%f-%f" % (bound, collapsed)
+        )
+        self.assertTrue(np.allclose(m.GetPhi(), ms.GetPhi(), atol=1e-3))
+
+    def test_learning_rate(self):
+        """ Every call of OptimiseSVI on a model uses its own learning rate """
+        m = self.buildModel(batchSize=20)
+        FitBranchingModel.OptimiseSVI(m, maxiter=20, learningRate=0.05)
+        state = FitBranchingModel.GetModelState(m)
+        FitBranchingModel.OptimiseSVI(m, maxiter=20, learningRate=0.0)
+        for v, value in zip(FitBranchingModel.GetModelState(m), state):
+            self.assertTrue(np.array_equal(v, value), "zero learning rate moved %s" % v)
+        FitBranchingModel.OptimiseSVI(m, maxiter=20, learningRate=0.05)
+        assert not np.array_equal(FitBranchingModel.GetModelState(m)[0], state[0])
+        assert m.traceCount == 1
+
+    def test_fit(self):
+        bConsider = [0.1, 0.4, 0.8]
+        d = FitBranchingModel.FitModelSVI(
+            bConsider,
+            self.t,
+            self.Y,
+            self.globalBranching,
+            maxiter=500,
+            batchSize=20,
+            learningRate=0.02,
+        )
+        dFull = FitBranchingModel.FitModel(
+            bConsider, self.t, self.Y, self.globalBranching, maxiter=20
+        )
+        assert d.keys() == dFull.keys()
+        assert np.all(np.isfinite(d["loglik"]))
+        assert np.all(d["iterations"] == 500)
+        self.assertEqual(d["posteriorB"]["Bmode"], 0.4)
+        Phi = d["Phi"]
+        assert Phi.shape == (self.t.size, 3)
+        assert np.allclose(Phi.sum(1), 1)
+        assert np.all(Phi[self.t <= 0.4, 0] > 0.99), "trunk cells stay on the trunk"
+        for f in range(3):
+            assert np.shape(d["prediction"]["mu"][f]) == (100, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()